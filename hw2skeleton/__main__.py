@@ -1,63 +1,218 @@
+import os
 import sys
-from .io import read_active_sites, write_clustering, write_mult_clusterings
+from .io import read_active_sites, read_active_site, write_clustering, write_mult_clusterings, write_cuts, \
+        read_similarity_matrix, write_similarity_matrix, write_site_store, read_site_store, write_cluster_model, \
+        read_cluster_model
 from .cluster import cluster_by_partitioning, cluster_hierarchically, create_similarity_matrix, \
-        convert_indices_to_active_sites
+        update_similarity_matrix, convert_indices_to_active_sites, cut_tree
 from .compare_clusters import sum_of_distances, rand_index, benchmark_clusters, benchmark_rand, rand_versus
+from .cache import cached_similarity_matrix, DEFAULT_CACHE_DIR
+from .index import knn_graph
+from .query import SiteSearch
+from .model import ClusterModel
+from .utils import set_coordinate_cache_size
 import pickle as pic
 
+
+def pop_option(flag, default, type=str):
+    # Removes "FLAG VALUE" from the command line, returning VALUE (or DEFAULT if FLAG is absent)
+    if flag not in sys.argv:
+        return default
+
+    i = sys.argv.index(flag)
+    value = type(sys.argv[i + 1])
+    del sys.argv[i:i + 2]
+
+    return value
+
+
+# Find the sites of a library (pdb directory or site store) most similar to new structures:
+#   python -m hw2skeleton query <pdb> [<pdb> ...] --library <library> [-k 10] [--metric RMSD]
+#                                 [--prefilter METRIC --candidates N]
+if len(sys.argv) > 1 and sys.argv[1] == "query":
+    library = pop_option("--library", None)
+    k = pop_option("-k", 10, int)
+    query_metric = pop_option("--metric", "RMSD")
+    prefilter = pop_option("--prefilter", None)
+    n_candidates = pop_option("--candidates", None, int)
+
+    if library is None or len(sys.argv) < 3:
+        print("Usage: python -m hw2skeleton query <pdb> [<pdb> ...] --library <pdb directory or site store> [-k K] "
+              "[--metric METRIC] [--prefilter METRIC --candidates N]")
+        sys.exit(0)
+
+    search = SiteSearch(read_active_sites(library), query_metric, prefilter)
+
+    for filepath in sys.argv[2:]:
+        print("Closest sites to %s" % filepath)
+        for name, score in search.query(read_active_site(filepath), k, n_candidates):
+            print("%s\t%f" % (name, score))
+
+    sys.exit(0)
+
+# Place new sites into the clustering saved by -P with --model, comparing them to the medoids only:
+#   python -m hw2skeleton assign <pdb or pdb directory> [...] --model <model file> [--library <library>] [--update]
+if len(sys.argv) > 1 and sys.argv[1] == "assign":
+    model_file = pop_option("--model", None)
+    library = pop_option("--library", None)
+    update = "--update" in sys.argv
+    if update:
+        sys.argv.remove("--update")
+
+    if model_file is None or len(sys.argv) < 3:
+        print("Usage: python -m hw2skeleton assign <pdb or pdb directory> [...] --model <model file> "
+              "[--library <pdb directory or site store>] [--update]")
+        sys.exit(0)
+
+    model = read_cluster_model(model_file)
+    library = library or model.library
+
+    if library is None:
+        print("The model does not record the library holding its medoid sites; give one with --library.")
+        sys.exit(1)
+
+    # only the medoid sites are read from the library
+    if os.path.isfile(library):
+        medoids = read_site_store(library)
+    else:
+        medoids = {name: read_active_site(os.path.join(library, name + ".pdb")) for name in model.medoids}
+
+    new_sites = []
+    for path in sys.argv[2:]:
+        new_sites.extend(read_active_sites(path, lazy=True) if os.path.isdir(path) else [read_active_site(path)])
+
+    labels, scores = model.assign(new_sites, medoids)
+    for site, label, score in zip(new_sites, labels, scores):
+        print("%s\t%d\t%f" % (site.name, label, score))
+
+    if update:
+        write_cluster_model(model_file, model)
+
+    sys.exit(0)
+
+# Number of processes used to build similarity matrices
+n_jobs = pop_option("--workers", 1, int)
+
+# Directory of the similarity matrix cache
+cache_dir = pop_option("--cache", DEFAULT_CACHE_DIR)
+
+# Stored similarity matrix to update with -U, or to cluster on with -P/-H, and its metric
+matrix_file = pop_option("--matrix", None)
+metric = pop_option("--metric", "hydrophobicity")
+
+# Numbers of clusters to cut the -H tree at, e.g. "2,5,10"
+cuts = pop_option("--cuts", None)
+
+# Cluster with -P/-H on a sparse graph of every site's nearest neighbors under --metric, instead of a full matrix
+knn = pop_option("--knn", None, int)
+
+# File to save the -P clustering to as a model, so that new sites can be assigned to it
+model_file = pop_option("--model", None)
+
+# Most active sites allowed to keep their coordinates in memory at once (coordinates are read on first use)
+set_coordinate_cache_size(pop_option("--resident", None, int))
+
 # Some quick stuff to make sure the program is called correctly
 if len(sys.argv) < 4:
-    print("Usage: python -m hw2skeleton [-P| -H] <pdb directory> <output file>")
+    print("Usage: python -m hw2skeleton [-P| -H] <pdb directory> <output file> [--workers N] [--cache DIR] "
+          "[--matrix FILE --metric METRIC] [--cuts K1,K2,...] [--resident N] [--knn K --metric METRIC]")
+    print("       python -m hw2skeleton -U <pdb directory> <matrix file> [--metric METRIC] [--workers N]")
+    print("       python -m hw2skeleton -S <pdb directory> <site store> [--workers N]")
+    print("       python -m hw2skeleton query <pdb> --library <pdb directory or site store> [-k K]")
+    print("       python -m hw2skeleton -P <pdb directory> <output file> --model <model file>")
+    print("       python -m hw2skeleton assign <pdb> --model <model file> [--update]")
+    print("A site store written with -S can be given in place of any <pdb directory>.")
+    sys.exit(0)
+
+active_sites = read_active_sites(sys.argv[2], n_jobs=n_jobs, lazy=True)
+
+if sys.argv[1][0:2] == "-S":
+    print("Writing site store")
+    write_site_store(sys.argv[3], active_sites)
+    sys.exit(0)
+
+
+def stored_similarity_matrix(filename):
+    # Loads a stored matrix and brings it up to date with the pdb directory, only computing rows of new sites
+    if not os.path.exists(filename):
+        return create_similarity_matrix(active_sites, metric, n_jobs=n_jobs)
+
+    stored, names, stored_metric = read_similarity_matrix(filename, return_metric=True)
+    return update_similarity_matrix(stored, names, active_sites, metric, n_jobs=n_jobs, stored_comparator=stored_metric)
+
+
+if sys.argv[1][0:2] == "-U":
+    print("Updating similarity matrix")
+    write_similarity_matrix(sys.argv[3], stored_similarity_matrix(sys.argv[3]), [a.name for a in active_sites],
+                            metric)
     sys.exit(0)
 
-active_sites = read_active_sites(sys.argv[2])
 
-sim_matrix = create_similarity_matrix(active_sites, "hydrophobicity")
-pic.dump(sim_matrix, open("sim_matrix.pkl", "wb"))
+def similarity_matrix(metric):
+    # Similarity matrices are cached on disk, so each one is only ever computed once per set of sites
+    return cached_similarity_matrix(active_sites, metric, cache_dir=cache_dir, n_jobs=n_jobs)
+
 
-#sim_matrix = pic.load(open("sim_matrix.pkl", "rb"))
+if knn is not None:
+    sim_matrix = knn_graph(active_sites, knn, metric)
+elif matrix_file is not None:
+    sim_matrix = stored_similarity_matrix(matrix_file)
+else:
+    sim_matrix = similarity_matrix(metric)
 
 # Choose clustering algorithm
 if sys.argv[1][0:3] == "-PC":
     print("Benchmarking Partitioning Algorithm")
-    rmsd_ssds = benchmark_clusters(active_sites, alg="P", metric="RMSD", N=1000)
-    hyd_ssds = benchmark_clusters(active_sites, alg="P", metric="hydrophobicity", N=1000)
+    rmsd_ssds = benchmark_clusters(active_sites, alg="P", sim_matrix=similarity_matrix("RMSD"), metric="RMSD", N=1000)
+    hyd_ssds = benchmark_clusters(active_sites, alg="P", sim_matrix=sim_matrix, metric=metric, N=1000)
 
     pic.dump(rmsd_ssds, open("kmeans_rmsd_ssds.pkl", "wb"))
     pic.dump(hyd_ssds, open("kmeans_hyd_ssds.pkl", "wb"))
 
 if sys.argv[1][0:3] == "-HC":
     print("Benchmarking Hierarchical Algorithm")
-    rmsd_ssds = benchmark_clusters(active_sites, alg="H", metric="RMSD", N=50)
-    hyd_ssds = benchmark_clusters(active_sites, alg="H", metric="hydrophobicity", N=50)
+    rmsd_ssds = benchmark_clusters(active_sites, alg="H", sim_matrix=similarity_matrix("RMSD"), metric="RMSD", N=50)
+    hyd_ssds = benchmark_clusters(active_sites, alg="H", sim_matrix=sim_matrix, metric=metric, N=50)
 
     pic.dump(rmsd_ssds, open("kmeans_rmsd_ssds.pkl", "wb"))
     pic.dump(hyd_ssds, open("kmeans_hyd_ssds.pkl", "wb"))
 
 if sys.argv[1][0:3] == "-PR":
     print("Computing Average Rand Index, K-means")
-    rmsd_rand = benchmark_rand(active_sites, alg="P", metric="RMSD", N=30, step=10)
-    hyd_rand = benchmark_rand(active_sites, alg="P", metric="hydrophobicity", N=30, step=10)
+    rmsd_rand = benchmark_rand(active_sites, alg="P", sim_matrix=similarity_matrix("RMSD"), metric="RMSD", N=30,
+                               step=10)
+    hyd_rand = benchmark_rand(active_sites, alg="P", sim_matrix=sim_matrix, metric=metric, N=30, step=10)
 
     pic.dump(rmsd_rand, open("kmeans_rmsd_rand.pkl", "wb"))
     pic.dump(hyd_rand, open("kmeans_hyd_rand.pkl", "wb"))
 
 if sys.argv[1][0:2] == '-P':
     print("Clustering using Partitioning method")
-    assignments = cluster_by_partitioning(active_sites, sim_matrix)
+    assignments, cost, medoids = cluster_by_partitioning(active_sites, sim_matrix, init="k-medoids++", n_init=10,
+                                                         n_jobs=n_jobs, return_cost=True, return_medoids=True)
+    print("Total distance to medoids: %f" % cost)
     clustering = convert_indices_to_active_sites(assignments, active_sites)
     write_clustering(sys.argv[3], clustering)
 
+    if model_file is not None:
+        write_cluster_model(model_file, ClusterModel.from_clustering(active_sites, assignments, medoids, metric,
+                                                                     os.path.abspath(sys.argv[2])))
+
 if sys.argv[1][0:2] == '-H':
     print("Clustering using hierarchical method")
-    assignments = cluster_hierarchically(active_sites, sim_matrix)
-    clusterings = convert_indices_to_active_sites(assignments, active_sites)
-    write_clustering(sys.argv[3], clusterings)
+    assignments, tree = cluster_hierarchically(active_sites, sim_matrix, return_tree=True)
+
+    if cuts is None:
+        clusterings = convert_indices_to_active_sites(assignments, active_sites)
+        write_clustering(sys.argv[3], clusterings)
+    else:
+        Ks = [int(K) for K in cuts.split(",")]
+        write_cuts(sys.argv[3], {K: convert_indices_to_active_sites(cut_tree(tree, K), active_sites) for K in Ks})
 
 if sys.argv[1][0:2] == "-C":
     print("Comparing Kmeans to Hierarchical")
-    hyd_rand = rand_versus(active_sites, N=20, metric="hydrophobicity")
-    rmsd_rand = rand_versus(active_sites, N=20, metric="RMSD")
+    hyd_rand = rand_versus(active_sites, N=20, sim_matrix=sim_matrix, metric=metric)
+    rmsd_rand = rand_versus(active_sites, N=20, sim_matrix=similarity_matrix("RMSD"), metric="RMSD")
 
 
     pic.dump(rmsd_rand, open("compare_rmsd_rand.pkl", "wb"))
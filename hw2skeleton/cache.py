@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import numpy as np
+from .cluster import create_similarity_matrix, update_similarity_matrix
+from .similarity import get_metric
+
+DEFAULT_CACHE_DIR = ".sim_cache"
+
+# Bump whenever a change to a metric would invalidate previously cached matrices
+CACHE_VERSION = 2
+
+# Most matrices kept per metric; every entry is a full NxN .npy file, so older ones are evicted least recently used
+# first
+DEFAULT_MAX_ENTRIES = 8
+
+
+def site_digest(active_site, coords=True):
+    """
+    Content hash of a parsed active site: its name, residues, atoms and coordinates.
+
+    :param active_site: ActiveSite object
+    :param coords: bool, whether to hash the coordinates (leaving them out keeps lazy sites from loading them)
+    :return: str, hex digest
+    """
+
+    if not active_site.is_packed():
+        active_site.pack()
+
+    h = hashlib.sha1()
+    h.update(active_site.name.encode())
+    h.update(" ".join("%s %s%d%s" % (r.type, r.chain, r.number, r.insertion) for r in active_site.residues).encode())
+    h.update(" ".join(active_site.atom_types).encode())
+    h.update(np.asarray(active_site.residue_offsets, dtype=np.int64).tobytes())
+    if coords:
+        h.update(np.ascontiguousarray(active_site.coords, dtype=np.float64).tobytes())
+
+    return h.hexdigest()
+
+
+def matrix_key(comparator, digests):
+    """
+    Key of the cache entry holding the COMPARATOR similarity matrix of the sites with the given DIGESTS.
+
+    :param comparator: str, method used to compare active sites
+    :param digests: list, site digests in matrix order
+    :return: str, hex digest
+    """
+
+    h = hashlib.sha1()
+    h.update(json.dumps([CACHE_VERSION, comparator]).encode())
+    for d in digests:
+        h.update(d.encode())
+
+    return h.hexdigest()
+
+
+def cached_similarity_matrix(active_sites, comparator="RMSD", cache_dir=DEFAULT_CACHE_DIR, n_jobs=1,
+                             max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Returns the similarity matrix of ACTIVE_SITES, computing it only if it is not already in the cache. Matrices are
+    stored as .npy files keyed by the comparator and a hash of every site, and are memory-mapped when loaded. When
+    an entry for an overlapping set of sites exists, only the rows and columns of new or changed sites are computed.
+
+    Every distinct set of sites adds a full NxN entry, so at most MAX_ENTRIES are kept per comparator: storing a
+    new one evicts the least recently used beyond that.
+
+    :param active_sites: List of ActiveSite objects of length N
+    :param comparator: str, method to use when comparing active sites
+    :param cache_dir: str, directory holding the cache
+    :param n_jobs: int, number of worker processes computing the matrix, or the rows of new sites
+    :param max_entries: int, most matrices kept for COMPARATOR, or None for no limit
+    :return: np.memmap, read-only NxN similarity matrix
+    """
+
+    # metrics such as hydrophobicity only depend on residues, so their entries are keyed without reading coordinates
+    coords = get_metric(comparator).coordinates
+    digests = [site_digest(a, coords=coords) for a in active_sites]
+    key = matrix_key(comparator, digests)
+
+    metric_dir = os.path.join(cache_dir, comparator)
+    path = os.path.join(metric_dir, key + ".npy")
+
+    if os.path.exists(path):
+        # the modification time of an entry records its last use
+        os.utime(path)
+        return np.load(path, mmap_mode="r")
+
+    previous = _closest_entry(metric_dir, digests)
+
+    if previous is None:
+        sim_matrix = create_similarity_matrix(active_sites, comparator, n_jobs=n_jobs)
+
+    else:
+        old_matrix = np.load(os.path.join(metric_dir, previous["key"] + ".npy"), mmap_mode="r")
+        old_digests = dict(zip(previous["names"], previous["digests"]))
+        changed = [a.name for a, d in zip(active_sites, digests) if a.name in old_digests and old_digests[a.name] != d]
+
+        sim_matrix = update_similarity_matrix(old_matrix, previous["names"], active_sites, comparator, changed,
+                                              n_jobs=n_jobs)
+
+    os.makedirs(metric_dir, exist_ok=True)
+    np.save(path, sim_matrix)
+    with open(os.path.join(metric_dir, key + ".json"), "w") as f:
+        json.dump({"key": key, "version": CACHE_VERSION, "comparator": comparator,
+                   "names": [a.name for a in active_sites], "digests": digests}, f)
+
+    if max_entries is not None:
+        _evict_entries(metric_dir, max_entries)
+
+    return np.load(path, mmap_mode="r")
+
+
+def _evict_entries(metric_dir, max_entries):
+    """
+    Deletes the least recently used matrices of a comparator's cache directory, keeping MAX_ENTRIES of them.
+    """
+
+    entries = [f[:-len(".npy")] for f in os.listdir(metric_dir) if f.endswith(".npy")]
+    entries.sort(key=lambda key: os.path.getmtime(os.path.join(metric_dir, key + ".npy")), reverse=True)
+
+    for key in entries[max(max_entries, 1):]:
+        for extension in (".npy", ".json"):
+            try:
+                os.remove(os.path.join(metric_dir, key + extension))
+            except OSError:
+                pass
+
+
+def _closest_entry(metric_dir, digests):
+    """
+    Finds the cache entry sharing the most sites with DIGESTS.
+
+    :param metric_dir: str, cache directory of a single comparator
+    :param digests: list, site digests
+    :return: dict, the entry's metadata, or None if no entry shares any site
+    """
+
+    if not os.path.isdir(metric_dir):
+        return None
+
+    wanted = set(digests)
+    best = None
+    best_overlap = 0
+
+    for filename in os.listdir(metric_dir):
+        if not filename.endswith(".json"):
+            continue
+
+        with open(os.path.join(metric_dir, filename)) as f:
+            entry = json.load(f)
+
+        if entry.get("version") != CACHE_VERSION:
+            continue
+
+        overlap = len(wanted.intersection(entry["digests"]))
+        if overlap > best_overlap and os.path.exists(os.path.join(metric_dir, entry["key"] + ".npy")):
+            best = entry
+            best_overlap = overlap
+
+    return best
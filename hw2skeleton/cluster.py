@@ -1,8 +1,21 @@
 from .utils import Atom, Residue, ActiveSite
-from .similarity import SimilarityComparator
+from .similarity import SimilarityComparator, get_metric
+from .condensed import CondensedMatrix, condensed_index, condensed_size
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+import multiprocessing
+import os
+import shutil
+import tempfile
 from tqdm import tqdm
 
+# State shared by the worker processes used to build a similarity matrix in parallel
+_worker_state = {}
+
+# State shared by the worker processes running k-medoids restarts in parallel
+_partition_state = {}
+
 
 def compute_similarity(site_a, site_b, comparator="RMSD"):
     """
@@ -31,111 +44,580 @@ def convert_indices_to_active_sites(clusters, active_sites):
 
     return n_clusters
 
-def cluster_by_partitioning(active_sites, sim_matrix=None, K=5, MAX_ITER=1000):
+def cluster_by_partitioning(active_sites, sim_matrix=None, K=5, MAX_ITER=1000, method="voronoi",
+                            metric="hydrophobicity", init="random", n_init=1, n_jobs=1, return_cost=False,
+                            return_medoids=False):
     """
-    Cluster a given set of ActiveSite instances using a partitioning method.
+    Cluster a given set of ActiveSite instances using a partitioning method (k-medoids). METHOD selects the
+    algorithm:
+
+        "voronoi"   alternate assignment and medoid updates (Voronoi iteration)
+        "fasterpam" swap-based optimization (FasterPAM), slower but finds better clusterings
+        "clara"     FasterPAM on random subsamples, only needing similarities to the medoids for the rest
+        "clarans"   randomized swap search, only needing the similarities of the sites it tries
+
+    "clara" and "clarans" never build the full similarity matrix when SIM_MATRIX is None; similarities are then
+    computed on demand with METRIC.
+
+    SIM_MATRIX may also be a sparse nearest neighbor graph (see index.knn_graph), for libraries too large for any
+    NxN matrix. "voronoi" then runs graph_kmedoids, with shortest path distances through the graph standing in
+    for similarities.
+
+    INIT seeds "voronoi" and "fasterpam" with "random" medoids or with "k-medoids++" (D^2-weighted) seeding. The
+    algorithm is restarted N_INIT times, on N_JOBS processes sharing one read-only similarity matrix, and the
+    clustering with the lowest total distance of the sites to their medoids is kept.
+
+    With RETURN_MEDOIDS the index of the medoid of every cluster is returned as well, so that new sites can later
+    be assigned to the clustering (see model.ClusterModel).
 
     Input: a list of ActiveSite instances
     Output: a clustering of ActiveSite instances
             (this is really a list of clusters, each of which is list of
             ActiveSite instances)
+            and, if RETURN_COST, its total distance of sites to their medoids
+            and, if RETURN_MEDOIDS, the medoid of each cluster
     """
 
-    def check_prev(c1, c2):
+    if active_sites is None:
+        return None
 
-        if c1 is None or c2 is None:
-            return False
+    N = len(active_sites)
 
-        for k in range(len(c1)):
-            if set(c1[k]) != set(c2[k]):
-                return False
+    if N <= K:
+        clusters = [[i] for i in range(N)]
+        return _partitioning_result(clusters, 0.0, np.arange(N), return_cost, return_medoids)
 
-        return True
+    if method not in ("voronoi", "fasterpam", "clara", "clarans"):
+        raise ValueError("Partitioning method not recognized")
 
-    def find_centroids(clusters, sim_matrix, K):
+    if init not in ("random", "k-medoids++"):
+        raise ValueError("Initialization method not recognized")
 
-        k_ii = np.zeros((K), dtype=int)
+    if sparse.issparse(sim_matrix) and method != "voronoi":
+        raise ValueError("Only the voronoi method clusters a sparse graph")
 
-        for k in range(K):
+    if sim_matrix is None and method in ("voronoi", "fasterpam"):
+        sim_matrix = create_similarity_matrix(active_sites, metric)
 
-            clust = clusters[k]
-            if len(clust) == 0:
-                continue
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
 
-            curr = clust[0]
-            curr_avg = np.mean(sim_matrix[curr, clust])
-            for elem in clust:
-                avg = np.mean(sim_matrix[elem, clust])
-                if avg < curr_avg:
-                    curr = elem
-                    curr_avg = avg
+    args = (active_sites, sim_matrix, K, MAX_ITER, method, metric, init)
 
-            k_ii[k] = int(curr)
+    if n_init == 1:
+        results = [_partition(*args)]
 
-        return k_ii
+    else:
+        seeds = np.random.randint(2**31 - 1, size=n_init)
 
-    if active_sites is None:
-        return None
+        if n_jobs == 1:
+            results = []
+            for seed in seeds:
+                results.append(_partition(*args, random_state=np.random.RandomState(seed)))
 
-    N = len(active_sites)
+        else:
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                shared = (active_sites, _share_matrix(sim_matrix, tmp_dir)) + args[2:]
+                with multiprocessing.Pool(min(n_jobs, n_init), _init_partition_worker, shared) as pool:
+                    results = pool.map(_partition_restart, seeds)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    if N <= K:
-        return [[a.name] for a in active_sites]
+    labels, medoids, cost = min(results, key=lambda r: r[2])
+    clusters = labels_to_clusters(labels, K)
+
+    return _partitioning_result(clusters, cost, medoids, return_cost, return_medoids)
+
+
+def _partitioning_result(clusters, cost, medoids, return_cost, return_medoids):
+    result = (clusters,)
+    if return_cost:
+        result += (cost,)
+    if return_medoids:
+        result += (np.asarray(medoids, dtype=int),)
+
+    return result if len(result) > 1 else clusters
+
+
+def kmedoids_plusplus(sim_matrix, K, random_state=None):
+    """
+    k-medoids++ seeding: the first medoid is chosen uniformly at random, and every further medoid with probability
+    proportional to the squared distance of a site to its closest medoid so far.
+
+    :param sim_matrix: np.array or CondensedMatrix, NxN similarity matrix
+    :param K: int, number of medoids
+    :param random_state: np.random.RandomState to draw from, or None for the global numpy generator
+    :return: np.array, indices of the K initial medoids
+    """
+
+    rng = np.random if random_state is None else random_state
+    N = sim_matrix.shape[0]
+
+    def row(m):
+        if sparse.issparse(sim_matrix):
+            return graph_distances(sim_matrix, [m])[0]
+        return np.array(sim_matrix[m], dtype=np.float64)
+
+    medoids = [rng.randint(N)]
+    d = row(medoids[0])
+
+    for _ in range(1, K):
+        weights = d**2
+        weights[medoids] = 0.0
+
+        unreachable = np.flatnonzero(np.isinf(weights))
+        if len(unreachable) > 0:
+            # sites of a graph component without any medoid yet
+            m = rng.choice(unreachable)
+        elif np.sum(weights) > 0:
+            m = rng.choice(N, p=weights / np.sum(weights))
+        else:
+            m = rng.choice(np.setdiff1d(np.arange(N), medoids))
+
+        medoids.append(m)
+        d = np.minimum(d, row(m))
+
+    return np.array(medoids, dtype=int)
+
+
+def _partition(active_sites, sim_matrix, K, MAX_ITER, method, metric, init, random_state=None):
+    """
+    A single run of cluster_by_partitioning, drawing its random choices from RANDOM_STATE (a np.random.RandomState,
+    or None for the global numpy generator).
+
+    :return: tuple, length N array of cluster labels, length K array of medoid indices and the total distance of
+             the sites to their medoids
+    """
+
+    if method == "clara":
+        labels, medoids = clara(active_sites, sim_matrix, K, metric, random_state=random_state)
+
+    elif method == "clarans":
+        labels, medoids = clarans(active_sites, sim_matrix, K, metric, random_state=random_state)
+
+    else:
+        # initialize clustering
+        if init == "k-medoids++":
+            medoids = kmedoids_plusplus(sim_matrix, K, random_state)
+        else:
+            rng = np.random if random_state is None else random_state
+            medoids = rng.choice(len(active_sites), size=K, replace=False)
+
+        if sparse.issparse(sim_matrix):
+            labels, medoids = graph_kmedoids(sim_matrix, medoids, MAX_ITER)
+        elif method == "voronoi":
+            labels, medoids = voronoi_kmedoids(sim_matrix, medoids, MAX_ITER)
+        else:
+            labels, medoids = fasterpam(sim_matrix, medoids, MAX_ITER)
+
+    dist = _medoid_distances(active_sites, sim_matrix, metric, medoids)
+    assigned = np.flatnonzero(labels >= 0)
+    cost = np.sum(dist[assigned, labels[assigned]])
 
+    return labels, medoids, cost
+
+
+def _init_partition_worker(active_sites, sim_matrix, K, MAX_ITER, method, metric, init):
+    """
+    Sets up a worker process to run k-medoids restarts on a shared, read-only similarity matrix.
+    """
+
+    _partition_state["args"] = (active_sites, _open_matrix(sim_matrix), K, MAX_ITER, method, metric, init)
+
+
+def _partition_restart(seed):
+    return _partition(*_partition_state["args"], random_state=np.random.RandomState(seed))
+
+
+def _share_matrix(sim_matrix, tmp_dir):
+    """
+    Describes a similarity matrix so that worker processes can memory-map it read-only, writing it to a file in
+    TMP_DIR first unless it is already memory-mapped.
+
+    :param sim_matrix: np.array, np.memmap, CondensedMatrix or None
+    :param tmp_dir: str, directory for the file
+    :return: tuple, description to pass to _open_matrix
+    """
 
     if sim_matrix is None:
-        sim_matrix = create_similarity_matrix(active_sites, "hydrophobicity")
+        return None
+
+    if sparse.issparse(sim_matrix):
+        # graphs only take O(N) memory, so they are simply copied to the workers
+        return ("sparse", sim_matrix)
+
+    if isinstance(sim_matrix, CondensedMatrix):
+        return ("condensed", sim_matrix.n, _share_matrix(sim_matrix.data, tmp_dir))
 
-    # initialize clustering
-    k_ii = np.random.choice(N, size=K, replace=False)
+    if isinstance(sim_matrix, np.memmap) and sim_matrix.filename is not None and sim_matrix.flags.c_contiguous:
+        return ("memmap", sim_matrix.filename, sim_matrix.dtype.str, sim_matrix.shape, sim_matrix.offset)
 
-    prev_assignment = None
-    _iter = 0
-    while _iter < MAX_ITER:
-        curr_assignment = [[] for i in range(K)]
+    filename = os.path.join(tmp_dir, "sim_matrix_%d.npy" % len(os.listdir(tmp_dir)))
+    np.save(filename, np.asarray(sim_matrix))
 
-        for a in range(N):
-            clust = np.argmin(sim_matrix[a, k_ii])
-            curr_assignment[clust].append(a)
+    return ("npy", filename)
+
+
+def _open_matrix(shared):
+    """
+    :param shared: tuple, description from _share_matrix
+    :return: read-only memory-mapped similarity matrix
+    """
+
+    if shared is None:
+        return None
+
+    if shared[0] == "sparse":
+        return shared[1]
+
+    if shared[0] == "condensed":
+        return CondensedMatrix(shared[1], data=_open_matrix(shared[2]))
+
+    if shared[0] == "memmap":
+        return np.memmap(shared[1], dtype=shared[2], mode="r", shape=shared[3], offset=shared[4])
+
+    return np.load(shared[1], mmap_mode="r")
+
+
+def voronoi_kmedoids(sim_matrix, medoids, MAX_ITER=1000):
+    """
+    Alternates assigning every site to its closest medoid and moving every medoid to the member of its cluster
+    with the smallest total distance to the other members, until the assignment is stable.
+
+    :param sim_matrix: np.array or CondensedMatrix, NxN similarity matrix
+    :param medoids: np.array, indices of the K initial medoids
+    :param MAX_ITER: int, maximum number of iterations
+    :return: tuple, length N array of cluster labels and length K array of medoid indices
+    """
+
+    medoids = np.array(medoids, dtype=int)
+    labels = None
+
+    for _ in range(MAX_ITER):
+        curr_labels = np.argmin(sim_matrix[:, medoids], axis=1)
 
         # If the assignment is stable, return the current assignment
-        if check_prev(prev_assignment, curr_assignment):
-            return curr_assignment
+        if labels is not None and np.array_equal(labels, curr_labels):
+            break
 
-        k_ii = find_centroids(curr_assignment, sim_matrix, K)
-        prev_assignment = curr_assignment
+        labels = curr_labels
+        medoids = update_medoids(sim_matrix, labels, medoids)
 
-        _iter += 1
+    return labels, medoids
 
-    return curr_assignment
 
+def graph_kmedoids(graph, medoids, MAX_ITER=100, n_candidates=32):
+    """
+    Voronoi iteration on a sparse nearest neighbor graph, where the distance between two sites is the length of
+    the shortest path between them. Every round assigns all sites with a single multi-source Dijkstra search from
+    the medoids, and then moves every medoid to the best of up to N_CANDIDATES members of its cluster closest to
+    it, by their total distance to the other members through the cluster. Sites that cannot reach any medoid are
+    labeled -1.
 
-def cluster_hierarchically(active_sites, sim_matrix=None, linkage="single", K=10):
+    :param graph: scipy.sparse matrix, NxN graph of similarities (see index.knn_graph)
+    :param medoids: np.array, indices of the K initial medoids
+    :param MAX_ITER: int, maximum number of iterations
+    :param n_candidates: int, most members of a cluster tried as its medoid in every iteration
+    :return: tuple, length N array of cluster labels and length K array of medoid indices
     """
-    Cluster the given set of ActiveSite instances using a hierarchical algorithm.
 
-    Input: a list of ActiveSite instances
-    Output: a list of clusterings
-            (each clustering is a list of lists of Sequence objects)
+    graph = sparse.csr_matrix(graph)
+    medoids = np.array(medoids, dtype=int)
+    labels = None
+
+    for _ in range(MAX_ITER):
+        dist, _, sources = csgraph.dijkstra(graph, directed=False, indices=medoids, min_only=True,
+                                            return_predecessors=True)
+        cluster_of = np.full(graph.shape[0], -1, dtype=int)
+        cluster_of[medoids] = np.arange(len(medoids))
+        curr_labels = np.where(sources >= 0, cluster_of[np.maximum(sources, 0)], -1)
+
+        # If the assignment is stable, return the current assignment
+        if labels is not None and np.array_equal(labels, curr_labels):
+            break
+
+        labels = curr_labels
+
+        for k in range(len(medoids)):
+            members = np.flatnonzero(labels == k)
+            if len(members) < 2:
+                continue
+
+            # candidates are the members closest to the current medoid, which is always one of them
+            candidates = members[np.argsort(dist[members], kind="mergesort")[:n_candidates]]
+            local = np.searchsorted(members, candidates)
+            costs = np.sum(csgraph.dijkstra(graph[members][:, members], directed=False, indices=local), axis=1)
+
+            if np.isfinite(np.min(costs)):
+                medoids[k] = candidates[np.argmin(costs)]
+
+    return labels, medoids
+
+
+def graph_distances(graph, sources):
+    """
+    :param graph: scipy.sparse matrix, NxN graph of similarities
+    :param sources: list, indices of S sites
+    :return: np.array, SxN shortest path distances from every source to every site (inf where unreachable)
+    """
+
+    return csgraph.dijkstra(graph, directed=False, indices=np.asarray(sources, dtype=int))
+
+
+def update_medoids(sim_matrix, labels, medoids):
+    """
+    Moves every medoid to the member of its cluster with the smallest row sum over the cluster's block of
+    the similarity matrix. The medoids of empty clusters are left where they are.
+
+    :param sim_matrix: np.array or CondensedMatrix, NxN similarity matrix
+    :param labels: np.array, length N cluster labels
+    :param medoids: np.array, indices of the K current medoids
+    :return: np.array, indices of the K updated medoids
+    """
+
+    medoids = np.array(medoids, dtype=int)
+
+    for k in range(len(medoids)):
+        members = np.flatnonzero(labels == k)
+        if len(members) == 0:
+            continue
+
+        costs = np.sum(sim_matrix[np.ix_(members, members)], axis=1)
+        medoids[k] = members[np.argmin(costs)]
+
+    return medoids
+
+
+def fasterpam(sim_matrix, medoids, MAX_ITER=100):
+    """
+    FasterPAM k-medoids (Schubert & Rousseeuw, 2021). Every non-medoid site is considered in turn as a
+    replacement for the medoid whose removal it makes cheapest, and the swap is applied eagerly as soon as it
+    lowers the total distance. Stops after a full pass over the sites without any improving swap.
+
+    :param sim_matrix: np.array or CondensedMatrix, NxN similarity matrix
+    :param medoids: np.array, indices of the K initial medoids
+    :param MAX_ITER: int, maximum number of passes over the sites
+    :return: tuple, length N array of cluster labels and length K array of medoid indices
+    """
+
+    medoids = np.array(medoids, dtype=int)
+    N = sim_matrix.shape[0]
+    K = len(medoids)
+
+    if K == 1:
+        medoids[0] = np.argmin([np.sum(sim_matrix[i]) for i in range(N)])
+        return np.zeros(N, dtype=int), medoids
+
+    dist = np.array(sim_matrix[:, medoids], dtype=np.float64)
+    nearest, d_near, d_second = _nearest_two(dist)
+    removal_loss = np.bincount(nearest, weights=d_second - d_near, minlength=K)
+
+    is_medoid = np.zeros(N, dtype=bool)
+    is_medoid[medoids] = True
+
+    tol = 1e-12 * max(1.0, np.sum(d_near))
+    since_swap = 0
+    passes = 0
+    x = 0
+
+    while since_swap < N and passes < MAX_ITER:
+        if not is_medoid[x]:
+            d_x = np.asarray(sim_matrix[x], dtype=np.float64)
+
+            # sites that would move to x, and the loss of removing each medoid given that x is added
+            closer = d_x < d_near
+            gain = np.sum(d_x[closer] - d_near[closer])
+            delta = removal_loss + np.bincount(nearest[closer], weights=d_near[closer] - d_second[closer],
+                                               minlength=K)
+            second = ~closer & (d_x < d_second)
+            delta += np.bincount(nearest[second], weights=d_x[second] - d_second[second], minlength=K)
+
+            i = np.argmin(delta)
+            if delta[i] + gain < -tol:
+                is_medoid[medoids[i]] = False
+                is_medoid[x] = True
+                medoids[i] = x
+                dist[:, i] = d_x
+
+                nearest, d_near, d_second = _nearest_two(dist)
+                removal_loss = np.bincount(nearest, weights=d_second - d_near, minlength=K)
+                since_swap = 0
+
+        since_swap += 1
+        x += 1
+        if x == N:
+            x = 0
+            passes += 1
+
+    return nearest, medoids
+
+
+def clara(active_sites, sim_matrix, K, metric="hydrophobicity", n_samples=5, sample_size=None, MAX_ITER=100,
+          random_state=None):
+    """
+    CLARA k-medoids: clusters random subsamples with FasterPAM and keeps the medoids that give the lowest total
+    distance over all sites. Only the subsample matrices and the similarities of every site to the candidate
+    medoids are needed, so memory stays bounded by the sample size when SIM_MATRIX is None.
+
+    :param active_sites: List of ActiveSite objects of length N
+    :param sim_matrix: np.array or CondensedMatrix NxN similarity matrix, or None to compute similarities on demand
+    :param K: int, number of clusters
+    :param metric: str, method to use when comparing active sites without SIM_MATRIX
+    :param n_samples: int, number of subsamples
+    :param sample_size: int, sites per subsample (default 40 + 2K)
+    :param MAX_ITER: int, maximum number of FasterPAM passes per subsample
+    :param random_state: np.random.RandomState to draw from, or None for the global numpy generator
+    :return: tuple, length N array of cluster labels and length K array of medoid indices
+    """
+
+    rng = np.random if random_state is None else random_state
+    N = len(active_sites)
+    if sample_size is None:
+        sample_size = 40 + 2 * K
+    sample_size = min(max(sample_size, K), N)
+
+    best_medoids = None
+    best_dist = None
+    best_cost = np.inf
+
+    for _ in range(n_samples):
+        sample = rng.choice(N, size=sample_size, replace=False)
+
+        # carry the best medoids so far over into every new sample
+        if best_medoids is not None:
+            others = sample[~np.isin(sample, best_medoids)]
+            sample = np.concatenate([best_medoids, others[:sample_size - K]])
+        sample = np.sort(sample)
+
+        if sim_matrix is None:
+            sub_matrix = create_similarity_matrix([active_sites[i] for i in sample], metric)
+        else:
+            sub_matrix = np.asarray(sim_matrix[np.ix_(sample, sample)])
+
+        _, sub_medoids = fasterpam(sub_matrix, rng.choice(len(sample), size=K, replace=False), MAX_ITER)
+        medoids = sample[sub_medoids]
+
+        dist = _medoid_distances(active_sites, sim_matrix, metric, medoids)
+        cost = np.sum(np.min(dist, axis=1))
+
+        if cost < best_cost:
+            best_medoids, best_dist, best_cost = medoids, dist, cost
+
+    return np.argmin(best_dist, axis=1), best_medoids
+
+
+def clarans(active_sites, sim_matrix, K, metric="hydrophobicity", numlocal=2, maxneighbor=None, random_state=None):
+    """
+    CLARANS k-medoids (Ng & Han): a randomized search over single medoid swaps. A swap is tried by computing the
+    similarities of one candidate site to every site; a local search ends after MAXNEIGHBOR consecutive
+    non-improving tries, and the best of NUMLOCAL searches is kept.
+
+    :param active_sites: List of ActiveSite objects of length N
+    :param sim_matrix: np.array or CondensedMatrix NxN similarity matrix, or None to compute similarities on demand
+    :param K: int, number of clusters
+    :param metric: str, method to use when comparing active sites without SIM_MATRIX
+    :param numlocal: int, number of local searches
+    :param maxneighbor: int, number of failed swaps ending a local search (default max(250, 1.25% of K(N-K)))
+    :param random_state: np.random.RandomState to draw from, or None for the global numpy generator
+    :return: tuple, length N array of cluster labels and length K array of medoid indices
+    """
+
+    rng = np.random if random_state is None else random_state
+    N = len(active_sites)
+    if maxneighbor is None:
+        maxneighbor = max(250, int(0.0125 * K * (N - K)))
+    maxneighbor = min(maxneighbor, K * (N - K))
+
+    best_medoids = None
+    best_dist = None
+    best_cost = np.inf
+
+    for _ in range(numlocal):
+        medoids = rng.choice(N, size=K, replace=False)
+        dist = _medoid_distances(active_sites, sim_matrix, metric, medoids)
+        cost = np.sum(np.min(dist, axis=1))
+
+        tries = 0
+        while tries < maxneighbor:
+            i = rng.randint(K)
+            x = rng.randint(N)
+            if x in medoids:
+                continue
+
+            new_dist = dist.copy()
+            new_dist[:, i] = _medoid_distances(active_sites, sim_matrix, metric, [x])[:, 0]
+            new_cost = np.sum(np.min(new_dist, axis=1))
+
+            if new_cost < cost:
+                medoids[i] = x
+                dist, cost = new_dist, new_cost
+                tries = 0
+            else:
+                tries += 1
+
+        if cost < best_cost:
+            best_medoids, best_dist, best_cost = medoids, dist, cost
+
+    return np.argmin(best_dist, axis=1), best_medoids
+
+
+def _nearest_two(dist):
+    """
+    :param dist: np.array, NxK distances of every site to every medoid, K >= 2
+    :return: tuple, the nearest medoid of every site, the distance to it, and the distance to the second nearest
+    """
+
+    rows = np.arange(len(dist))
+    nearest = np.argmin(dist, axis=1)
+    d_near = dist[rows, nearest]
+
+    masked = dist.copy()
+    masked[rows, nearest] = np.inf
+    d_second = np.min(masked, axis=1)
+
+    return nearest, d_near, d_second
+
+
+def _medoid_distances(active_sites, sim_matrix, metric, medoids):
+    """
+    :param active_sites: List of ActiveSite objects of length N
+    :param sim_matrix: np.array or CondensedMatrix NxN similarity matrix, or None to compute similarities on demand
+    :param metric: str, method to use when comparing active sites without SIM_MATRIX
+    :param medoids: list, indices of K medoids
+    :return: np.array, NxK similarities of every site to every medoid
+    """
+
+    if sparse.issparse(sim_matrix):
+        return graph_distances(sim_matrix, medoids).T
+
+    if sim_matrix is not None:
+        return np.array(sim_matrix[:, np.asarray(medoids)], dtype=np.float64)
+
+    return similarity_block(active_sites, [active_sites[m] for m in medoids], metric)
+
+
+def labels_to_clusters(labels, K):
+    """
+    :param labels: np.array, length N cluster labels in 0..K-1
+    :param K: int, number of clusters
+    :return: list of K clusters, each a list of site indices
     """
 
-    def find_clusters_to_merge(clusts, sim_matrix):
+    return [np.flatnonzero(labels == k).tolist() for k in range(K)]
 
-        C = len(clusts)
-        linkage_mat = np.zeros((C,C))
-        if linkage == "single":
 
-            # Find single linkage between all clusters
-            for i in range(C):
-                for j in range(C):
-                    if i == j:
-                        val = float("inf")
-                    else:
-                        val = np.min(sim_matrix[np.ix_(clusts[i], clusts[j])])
-                    linkage_mat[i, j] = val
+def cluster_hierarchically(active_sites, sim_matrix=None, linkage="single", K=10, return_tree=False):
+    """
+    Cluster the given set of ActiveSite instances using a hierarchical algorithm. The full agglomeration is
+    computed in O(N^2) by linkage_tree, and then cut into K clusters. With RETURN_TREE the merge tree is returned
+    as well, so that it can be cut at any other K with cut_tree without clustering again.
 
-        to_merge = np.unravel_index(np.argmin(linkage_mat), (C, C))
-        return to_merge
+    Input: a list of ActiveSite instances
+    Output: a list of clusterings
+            (each clustering is a list of lists of Sequence objects)
+            and, if RETURN_TREE, the scipy-format merge tree
+    """
 
     if active_sites is None:
         return None
@@ -147,41 +629,517 @@ def cluster_hierarchically(active_sites, sim_matrix=None, linkage="single", K=10
     if sim_matrix is None:
         sim_matrix = create_similarity_matrix(active_sites, "hydrophobicity")
 
-    clusters = []
+    tree = linkage_tree(sim_matrix, linkage)
+    clusters = cut_tree(tree, K) if N > 0 else []
+
+    if return_tree:
+        return clusters, tree
+
+    return clusters
+
+
+def cut_tree(tree, K):
+    """
+    Cuts a merge tree into K clusters by replaying its first N-K merges.
+
+    :param tree: np.array, (N-1)x4 merge tree from linkage_tree (or scipy.cluster.hierarchy.linkage)
+    :param K: int, number of clusters
+    :return: list of K clusters, each a sorted list of site indices, ordered by their first site
+    """
+
+    N = len(tree) + 1
+    K = max(1, min(K, N))
+    parent = np.arange(2 * N - 1)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+
+        # path compression: point every node on the way at the root, so the cut stays near-linear on chain-shaped
+        # (single linkage) trees
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+
+        return root
+
+    for i in range(N - K):
+        a, b = int(tree[i, 0]), int(tree[i, 1])
+        parent[a] = parent[b] = N + i
+
+    clusters = {}
     for a in range(N):
-        clusters.append([a])
+        clusters.setdefault(find(a), []).append(a)
+
+    return sorted(clusters.values())
 
-    C = len(clusters)
 
-    while C > K:
+def linkage_tree(sim_matrix, linkage="single"):
+    """
+    Agglomerates N sites all the way up to a single cluster in O(N^2) time. Single linkage is computed from a
+    minimum spanning tree (Prim's algorithm) reading one row of the matrix at a time, so a CondensedMatrix or
+    memory-mapped matrix is never copied. The other linkages use the nearest-neighbor chain algorithm and
+    Lance-Williams distance updates on a condensed working copy of the matrix, in its own dtype.
 
-        merge_ii = find_clusters_to_merge(clusters, sim_matrix)
-        clusters[merge_ii[0]] = list(clusters[merge_ii[0]] + clusters[merge_ii[1]])
-        clusters = [clusters[i] for i in range(C) if i != merge_ii[1]]
-        C = len(clusters)
+    Single linkage may also be computed from a sparse nearest neighbor graph (see index.knn_graph), in
+    O(E log N) for its E edges. Components of the graph are merged last, at infinite distance.
 
-    return clusters
+    :param sim_matrix: np.array or CondensedMatrix, NxN similarity matrix, or scipy.sparse graph
+    :param linkage: str, one of "single", "complete", "average" or "ward"
+    :return: np.array, (N-1)x4 merge tree in scipy.cluster.hierarchy linkage format. Row i merges clusters
+             tree[i, 0] and tree[i, 1] at distance tree[i, 2] into cluster N+i, holding tree[i, 3] sites
+    """
+
+    if sparse.issparse(sim_matrix):
+        if linkage != "single":
+            raise ValueError("Only single linkage clusters a sparse graph")
+        return _label_merges(_sparse_mst_merges(sim_matrix), sim_matrix.shape[0])
+
+    if not hasattr(sim_matrix, "shape"):
+        sim_matrix = np.asarray(sim_matrix, dtype=np.float64)
+
+    if linkage == "single":
+        merges = _mst_merges(sim_matrix)
+
+    elif linkage in ("complete", "average", "ward"):
+        merges = _nn_chain_merges(sim_matrix, linkage)
+
+    else:
+        raise ValueError("Linkage method not recognized")
 
+    return _label_merges(merges, sim_matrix.shape[0])
 
-def create_similarity_matrix(active_sites, comparator="RMSD"):
+
+def _mst_merges(sim_matrix):
+    """
+    Single linkage merges, as the edges of a minimum spanning tree grown with Prim's algorithm. Every row of the
+    matrix is read once, when its site joins the tree.
+
+    :param sim_matrix: np.array, np.memmap or CondensedMatrix, NxN distance matrix
+    :return: list of (site, site, distance) merges, in no particular order
     """
 
+    N = sim_matrix.shape[0]
+    merges = []
+    if N == 0:
+        return merges
+
+    in_tree = np.zeros(N, dtype=bool)
+    in_tree[0] = True
+    dist = np.array(sim_matrix[0], dtype=np.float64)
+    nearest = np.zeros(N, dtype=int)
+
+    for _ in range(N - 1):
+        nxt = int(np.argmin(np.where(in_tree, np.inf, dist)))
+        merges.append((int(nearest[nxt]), nxt, dist[nxt]))
+        in_tree[nxt] = True
+
+        row = np.asarray(sim_matrix[nxt], dtype=np.float64)
+        closer = row < dist
+        dist = np.where(closer, row, dist)
+        nearest = np.where(closer, nxt, nearest)
+
+    return merges
+
+
+def _condensed_copy(sim_matrix):
+    """
+    :param sim_matrix: np.array, np.memmap or CondensedMatrix, NxN symmetric matrix
+    :return: np.array, in-memory copy of its condensed upper triangle, in the matrix's dtype, copied row by row
+    """
+
+    if isinstance(sim_matrix, CondensedMatrix):
+        return np.array(sim_matrix.data)
+
+    N = sim_matrix.shape[0]
+    dtype = sim_matrix.dtype if np.issubdtype(sim_matrix.dtype, np.floating) else np.float64
+    data = np.empty(condensed_size(N), dtype=dtype)
+
+    for i in range(N - 1):
+        start = condensed_index(i, i + 1, N)
+        data[start:start + N - i - 1] = sim_matrix[i, i + 1:]
+
+    return data
+
+
+def _sparse_mst_merges(graph):
+    """
+    Single linkage merges, as the edges of a minimum spanning forest of a sparse graph, plus infinite distance
+    merges joining its components.
+
+    :param graph: scipy.sparse matrix, NxN graph of similarities
+    :return: list of (site, site, distance) merges, in no particular order
+    """
+
+    N = graph.shape[0]
+    graph = sparse.csr_matrix(graph, dtype=np.float64, copy=True)
+
+    # the spanning tree drops zero weight edges, so they are lifted by the smallest positive float until it is built
+    tiny = np.finfo(np.float64).tiny
+    graph.data += tiny
+    mst = csgraph.minimum_spanning_tree(graph).tocoo()
+
+    merges = [(int(i), int(j), d if d > tiny else 0.0) for i, j, d in zip(mst.row, mst.col, mst.data)]
+
+    n_components, component = csgraph.connected_components(graph, directed=False)
+    roots = np.unique(component, return_index=True)[1]
+    merges.extend((int(roots[0]), int(r), np.inf) for r in roots[1:])
+
+    return merges
+
+
+def _nn_chain_merges(sim_matrix, linkage):
+    """
+    Complete, average or Ward linkage merges using the nearest-neighbor chain algorithm, on a condensed working
+    copy of SIM_MATRIX (see _condensed_copy). Merged clusters are masked out rather than overwritten.
+
+    :param sim_matrix: np.array, np.memmap or CondensedMatrix, NxN distance matrix
+    :param linkage: str, one of "complete", "average" or "ward"
+    :return: list of (site, site, distance) merges, in no particular order
+    """
+
+    N = sim_matrix.shape[0]
+    D = _condensed_copy(sim_matrix)
+    columns = np.arange(N)
+
+    size = np.ones(N)
+    active = np.ones(N, dtype=bool)
+    chain = []
+    merges = []
+
+    def row_index(x):
+        # positions of row X in D (the diagonal entry points anywhere, and is masked)
+        index = condensed_index(x, columns, N)
+        index[x] = 0
+        return index
+
+    def row(x):
+        # row X of the working matrix, with merged clusters and the diagonal at infinity
+        distances = D[row_index(x)].astype(np.float64)
+        distances[~active] = np.inf
+        distances[x] = np.inf
+        return distances
+
+    for _ in range(N - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+
+        # follow nearest neighbors until two clusters are each other's nearest neighbor
+        while True:
+            x = chain[-1]
+            Dx = row(x)
+            y = int(np.argmin(Dx))
+            if len(chain) > 1 and Dx[chain[-2]] <= Dx[y]:
+                y = chain[-2]
+                break
+            chain.append(y)
+
+        chain = chain[:-2]
+        Dy = row(y)
+        merges.append((x, y, Dx[y]))
+
+        # the merged cluster takes the place of y
+        with np.errstate(invalid="ignore"):
+            if linkage == "complete":
+                new = np.maximum(Dx, Dy)
+
+            elif linkage == "average":
+                new = (size[x] * Dx + size[y] * Dy) / (size[x] + size[y])
+
+            else:
+                new = np.sqrt(((size + size[x]) * Dx**2 + (size + size[y]) * Dy**2 - size * Dx[y]**2) /
+                              (size + size[x] + size[y]))
+
+        active[x] = False
+        others = active.copy()
+        others[y] = False
+        D[row_index(y)[others]] = new[others]
+        size[y] += size[x]
+
+    return merges
+
+
+def _label_merges(merges, N):
+    """
+    Sorts merges by distance and converts them to a scipy-format linkage matrix.
+
+    :param merges: list of (site, site, distance) merges, each site belonging to one of the two merged clusters
+    :param N: int, number of sites
+    :return: np.array, (N-1)x4 linkage matrix
+    """
+
+    tree = np.zeros((len(merges), 4))
+
+    parent = np.arange(2 * N - 1) if N > 0 else np.arange(0)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    size = np.ones(2 * N - 1) if N > 0 else np.ones(0)
+    order = np.argsort([m[2] for m in merges], kind="mergesort")
+
+    for i, m in enumerate(order):
+        a, b, dist = merges[m]
+        a, b = find(a), find(b)
+        parent[a] = parent[b] = N + i
+        size[N + i] = size[a] + size[b]
+        tree[i] = [min(a, b), max(a, b), dist, size[N + i]]
+
+    return tree
+
+
+def create_similarity_matrix(active_sites, comparator="RMSD", n_jobs=1, tile_size=None, condensed=False,
+                             dtype=np.float64, filename=None):
+    """
+    For symmetric metrics only the upper triangle is computed and then mirrored. The matrix is split into
+    TILE_SIZE x TILE_SIZE tiles, each of which is scored with a single call to the metric's vectorized pairwise
+    hook when it has one. By default tiles are as large as the metric asks for, so that vectorized metrics such as
+    hydrophobicity usually fill the whole matrix in one tile. With N_JOBS > 1 the tiles are farmed out to a process
+    pool whose workers write directly into a memory-mapped result matrix; default tiles are then made small enough
+    that every worker gets a band of rows.
+
+    For very large N the matrix can instead be stored as a CondensedMatrix holding only the upper triangle,
+    optionally as float32 and backed by the memory-mapped file FILENAME.
+
     :param active_sites: List of ActiveSite objects of length N
-    :param comparator: str, method to use when comparing active sites
-    :return: np.array, NxN similarity matrix
+    :param comparator: str, name of the registered metric to use when comparing active sites
+    :param n_jobs: int, number of worker processes (values < 1 use every available core)
+    :param tile_size: int, number of rows and columns in each tile, or None to use the metric's tile size
+    :param condensed: bool, return a CondensedMatrix rather than a square array (symmetric metrics only)
+    :param dtype: floating point type of the entries
+    :param filename: str, file backing the result with np.memmap, or None to return an in-memory matrix
+    :return: np.array or CondensedMatrix, NxN similarity matrix
     """
     A = len(active_sites)
 
-    sim_mat = np.zeros((A, A))
-
     print("Creating Similarity Matrix")
-    for i in tqdm(range(A)):
-        for j in range(A):
-            if i == j:
-                sim_mat[i, j] = 0.0
 
+    metric = get_metric(comparator)
+
+    if condensed and not metric.symmetric:
+        raise ValueError("Only symmetric metrics can be stored as a CondensedMatrix.")
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    if tile_size is None:
+        tile_size = metric.tile_size
+        if n_jobs > 1:
+            tile_size = min(tile_size, max(1, -(-A // n_jobs)))
+
+    if tile_size >= A and not condensed and filename is None:
+        return similarity_block(active_sites, active_sites, comparator, symmetric=True).astype(dtype, copy=False)
+
+    # features are computed once here, and travel to the workers with the sites
+    metric.precompute(active_sites)
+
+    tiles = [(i, min(i + tile_size, A), j, min(j + tile_size, A))
+             for i in range(0, A, tile_size) for j in range(i if metric.symmetric else 0, A, tile_size)]
+    parallel = n_jobs > 1 and len(tiles) > 1
+
+    tmp_dir = None
+    if parallel and filename is None:
+        tmp_dir = tempfile.mkdtemp()
+
+    try:
+        spec = (A, condensed, dtype, filename or (tmp_dir and os.path.join(tmp_dir, "sim_matrix.dat")))
+        sim_mat = _allocate_matrix(*spec, mode="w+")
+        progress = tqdm(total=A * (A - 1) // 2 if metric.symmetric else A * (A - 1))
+
+        if parallel:
+            with multiprocessing.Pool(n_jobs, _init_tile_worker, (active_sites, comparator, spec)) as pool:
+                for n_pairs in pool.imap_unordered(_fill_tile, tiles):
+                    progress.update(n_pairs)
+
+        else:
+            _init_tile_worker(active_sites, comparator, sim_mat)
+            for tile in tiles:
+                progress.update(_fill_tile(tile))
+            _worker_state.clear()
+
+        progress.close()
+
+        if tmp_dir is not None:
+            # the memory map only lived in a temporary file, so bring the result into memory
+            if condensed:
+                sim_mat = CondensedMatrix(A, data=np.array(sim_mat.data))
             else:
-                sim_mat[i, j] = compute_similarity(active_sites[i], active_sites[j], comparator)
+                sim_mat = np.array(sim_mat)
+        elif filename is not None:
+            sim_mat.flush()
+
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
     return sim_mat
 
+
+def similarity_block(sites_a, sites_b, comparator="RMSD", symmetric=False):
+    """
+    Computes the similarities between every site of SITES_A and every site of SITES_B, through the fastest hook
+    of the metric (see similarity.Metric).
+
+    :param sites_a: List of ActiveSite objects of length N
+    :param sites_b: List of ActiveSite objects of length M
+    :param comparator: str, name of the registered metric to use when comparing active sites
+    :param symmetric: bool, SITES_A and SITES_B are the same list, so only the upper triangle is computed
+    :return: np.array, NxM similarity matrix
+    """
+
+    return get_metric(comparator).block(sites_a, sites_b, symmetric)
+
+
+def update_similarity_matrix(sim_matrix, names, active_sites, comparator="RMSD", changed=(), n_jobs=1,
+                             stored_comparator=None):
+    """
+    Updates a similarity matrix after sites were added to or removed from a library. Entries between sites that
+    are in both NAMES and ACTIVE_SITES are copied over, so only the rows and columns of the k new (or CHANGED) sites
+    are computed, at O(kN) cost.
+
+    :param sim_matrix: np.array, MxM similarity matrix of the sites named NAMES
+    :param names: list, names of the M sites in the order of SIM_MATRIX
+    :param active_sites: List of the N ActiveSite objects in the updated library
+    :param comparator: str, method used to compare active sites
+    :param changed: names of sites in both sets whose structure changed and whose entries must be recomputed
+    :param n_jobs: int, number of worker processes (values < 1 use every available core)
+    :param stored_comparator: str, method SIM_MATRIX was computed with, if known; it must be COMPARATOR
+    :return: np.array, NxN similarity matrix in the order of ACTIVE_SITES
+    """
+
+    if stored_comparator is not None and stored_comparator != comparator:
+        raise ValueError("The similarity matrix was computed with %s, not %s." % (stored_comparator, comparator))
+
+    old_index = {name: i for i, name in enumerate(names)}
+    changed = set(changed)
+
+    kept = [i for i, a in enumerate(active_sites) if a.name in old_index and a.name not in changed]
+    added = [i for i, a in enumerate(active_sites) if a.name not in old_index or a.name in changed]
+    print("Keeping %d sites, removing %d, computing %d" % (len(kept), len(names) - len(kept), len(added)))
+
+    A = len(active_sites)
+    updated = np.zeros((A, A))
+
+    old_kept = [old_index[active_sites[i].name] for i in kept]
+    updated[np.ix_(kept, kept)] = sim_matrix[np.ix_(old_kept, old_kept)]
+
+    kept_sites = [active_sites[i] for i in kept]
+    added_sites = [active_sites[i] for i in added]
+
+    # every pair of new sites is scored once: in the upper triangle of their own block for symmetric metrics, and
+    # with the new rows otherwise
+    if get_metric(comparator).symmetric:
+        block = _parallel_block(added_sites, kept_sites, comparator, n_jobs)
+        updated[np.ix_(added, kept)] = block
+        updated[np.ix_(kept, added)] = block.T
+        updated[np.ix_(added, added)] = similarity_block(added_sites, added_sites, comparator, symmetric=True)
+    else:
+        updated[added, :] = _parallel_block(added_sites, active_sites, comparator, n_jobs)
+        updated[np.ix_(kept, added)] = _parallel_block(kept_sites, added_sites, comparator, n_jobs)
+
+    return updated
+
+
+def _parallel_block(sites_a, sites_b, comparator, n_jobs=1):
+    """
+    similarity_block of SITES_A and SITES_B, with the columns split into tiles of the metric's tile size that are
+    scored on N_JOBS worker processes.
+    """
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    metric = get_metric(comparator)
+    B = len(sites_b)
+    columns = [(j, min(j + metric.tile_size, B)) for j in range(0, B, metric.tile_size)]
+
+    if n_jobs == 1 or len(columns) < 2:
+        return similarity_block(sites_a, sites_b, comparator)
+
+    # features are computed once here, and travel to the workers with the sites
+    metric.precompute(list(sites_a) + list(sites_b))
+
+    with multiprocessing.Pool(min(n_jobs, len(columns)), _init_block_worker, (sites_a, sites_b, comparator)) as pool:
+        blocks = pool.map(_block_columns, columns)
+
+    return np.hstack(blocks)
+
+
+def _init_block_worker(sites_a, sites_b, comparator):
+    _worker_state["sites_a"] = sites_a
+    _worker_state["sites_b"] = sites_b
+    _worker_state["comparator"] = comparator
+
+
+def _block_columns(columns):
+    j0, j1 = columns
+    return similarity_block(_worker_state["sites_a"], _worker_state["sites_b"][j0:j1], _worker_state["comparator"])
+
+
+def _allocate_matrix(A, condensed, dtype, filename, mode="r+"):
+    """
+    Allocates (or opens) the storage of an NxN similarity matrix.
+
+    :param A: int, number of active sites
+    :param condensed: bool, store only the upper triangle in a CondensedMatrix
+    :param dtype: floating point type of the entries
+    :param filename: str, file backing the matrix with np.memmap, or None for an in-memory matrix
+    :param mode: str, np.memmap mode used to open FILENAME
+    :return: np.array or CondensedMatrix
+    """
+
+    if condensed:
+        return CondensedMatrix(A, dtype, filename, mode)
+
+    if filename is not None:
+        return np.memmap(filename, dtype=dtype, mode=mode, shape=(A, A))
+
+    return np.zeros((A, A), dtype=dtype)
+
+
+def _init_tile_worker(active_sites, comparator, sim_mat):
+    """
+    Sets up a (worker) process to fill tiles of a similarity matrix.
+
+    :param active_sites: List of ActiveSite objects of length N
+    :param comparator: str, method to use when comparing active sites
+    :param sim_mat: the result matrix, or the _allocate_matrix arguments of a memory-mapped result matrix
+    """
+
+    if isinstance(sim_mat, tuple):
+        sim_mat = _allocate_matrix(*sim_mat)
+
+    _worker_state["active_sites"] = active_sites
+    _worker_state["comparator"] = comparator
+    _worker_state["sim_mat"] = sim_mat
+
+
+def _fill_tile(tile):
+    """
+    Computes the upper triangle entries of one tile of the similarity matrix, and mirrors them.
+
+    :param tile: tuple, (row start, row stop, column start, column stop)
+    :return: int, number of pairs computed
+    """
+
+    i0, i1, j0, j1 = tile
+    active_sites = _worker_state["active_sites"]
+    sim_mat = _worker_state["sim_mat"]
+    symmetric = get_metric(_worker_state["comparator"]).symmetric
+
+    if i0 == j0:
+        sites = active_sites[i0:i1]
+        block = similarity_block(sites, sites, _worker_state["comparator"], True)
+        n_pairs = (i1 - i0) * (i1 - i0 - 1) // (2 if symmetric else 1)
+    else:
+        block = similarity_block(active_sites[i0:i1], active_sites[j0:j1], _worker_state["comparator"])
+        n_pairs = (i1 - i0) * (j1 - j0)
+
+    sim_mat[i0:i1, j0:j1] = block
+    if symmetric and not isinstance(sim_mat, CondensedMatrix):
+        sim_mat[j0:j1, i0:i1] = block.T
+
+    return n_pairs
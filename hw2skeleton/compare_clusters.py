@@ -1,87 +1,158 @@
 from .utils import Atom, Residue, ActiveSite
+from .metrics import within_cluster_ssd
 from .cluster import create_similarity_matrix, cluster_by_partitioning, cluster_hierarchically, \
-        convert_indices_to_active_sites
+        convert_indices_to_active_sites, linkage_tree, cut_tree
 import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 
 def sum_of_distances(clusters, sim_matrix):
     """
 
-    :param clusters: list, list of ActiveSite objects where each item in the list is a clustering
-    :param sim_matrix: np.array NxN, similarity matrix for N ActiveSites
-    :return: float, sum of distances within a cluster
+    :param clusters: list, list of clusters where each item in the list is a list of site indices into sim_matrix
+    :param sim_matrix: np.array NxN (or CondensedMatrix), similarity matrix for N ActiveSites
+    :return: float, sum of distances within a cluster, averaged over clusters
     """
 
-    Q = 0.0
-    for c in clusters:
+    labels = np.full(sim_matrix.shape[0], -1)
+    for c in range(len(clusters)):
+        labels[np.asarray(clusters[c], dtype=int)] = c
 
-        for i in range(len(c)):
-            for j in range(len(c)):
-                Q += sim_matrix[i, j]
+    # within_cluster_ssd counts every pair once, we count both orders
+    return 2 * within_cluster_ssd(labels, sim_matrix) / len(clusters)
 
-    return Q / len(clusters)
 
-
-def rand_index(clusterings_1, clusterings_2, active_sites):
+def rand_index(clusterings_1, clusterings_2, active_sites=None):
     """
 
-    :param clusterings_1: list, list of ActiveSite objects where each item in the list is a clustering
-    :param clusterings_2: list, list of ActiveSite objects where each item in the list is a clustering
+    :param clusterings_1: list, list of ActiveSite objects where each item in the list is a clustering, or a length N
+                          array of cluster labels
+    :param clusterings_2: list, list of ActiveSite objects where each item in the list is a clustering, or a length N
+                          array of cluster labels
     :param active_sites: list, list of ActiveSite objects that were clustered in both clusterings_1 and *_2
     :return: float, rand index used as a metric for comparing similarities of clustering assignments
     """
-    tp = 0
-    tn = 0
-    fp = 0
-    fn = 0
 
-    print(active_sites)
+    l1, l2 = _paired_labels(clusterings_1, clusterings_2, active_sites)
+    n_pairs, same_both, same_1, same_2 = _pair_counts(l1, l2)
+
+    if n_pairs == 0:
+        return 1.0
+
+    # pairs together in both clusterings, plus pairs apart in both
+    return (n_pairs + 2 * same_both - same_1 - same_2) / n_pairs
+
+
+def adjusted_rand_index(clusterings_1, clusterings_2, active_sites=None):
+    """
+
+    :param clusterings_1: list, list of ActiveSite objects where each item in the list is a clustering, or a length N
+                          array of cluster labels
+    :param clusterings_2: list, list of ActiveSite objects where each item in the list is a clustering, or a length N
+                          array of cluster labels
+    :param active_sites: list, list of ActiveSite objects that were clustered in both clusterings_1 and *_2
+    :return: float, rand index adjusted for chance (Hubert & Arabie), 1 for identical clusterings
+    """
+
+    l1, l2 = _paired_labels(clusterings_1, clusterings_2, active_sites)
+    n_pairs, same_both, same_1, same_2 = _pair_counts(l1, l2)
+
+    if n_pairs == 0:
+        return 1.0
+
+    expected = same_1 * same_2 / n_pairs
+    maximum = (same_1 + same_2) / 2
+
+    if maximum == expected:
+        return 1.0
+
+    return (same_both - expected) / (maximum - expected)
+
+
+def clusters_to_labels(clusters, index):
+    """
+
+    :param clusters: list, each item in the list is a cluster of site names (or site indices), or a length N array
+                     of cluster labels
+    :param index: dict, maps every site name to its position 0..N-1
+    :return: np.array, length N integer cluster labels. Sites that are in no cluster get a cluster of their own
+    """
+
+    if _is_label_array(clusters):
+        return np.asarray(clusters, dtype=int)
+
+    N = len(index)
+    labels = np.arange(len(clusters), len(clusters) + N)
+
+    for c in range(len(clusters)):
+        for elem in clusters[c]:
+            labels[index.get(elem, elem)] = c
+
+    return labels
+
+
+def contingency_table(labels_1, labels_2):
+    """
+
+    :param labels_1: np.array, length N cluster labels
+    :param labels_2: np.array, length N cluster labels
+    :return: np.array, K1xK2 table counting the sites in every pair of clusters
+    """
+
+    _, a = np.unique(labels_1, return_inverse=True)
+    _, b = np.unique(labels_2, return_inverse=True)
+
+    k_b = b.max() + 1 if len(b) > 0 else 0
+    k_a = a.max() + 1 if len(a) > 0 else 0
 
-    # iterate over all pairs of sample
-    for a1 in active_sites:
-        for a2 in active_sites:
-            if a1.name == a2.name:
-                continue
+    return np.bincount(a * k_b + b, minlength=k_a * k_b).reshape(k_a, k_b)
 
-            # iterate over all pairs of clusterings to compare assignments of a1 and a2
-            for c1 in clusterings_1:
 
-                if a1.name in c1 and a2.name in c1:
+def _is_label_array(clusters):
+    return isinstance(clusters, np.ndarray) or (len(clusters) > 0 and np.isscalar(clusters[0]))
 
-                    same = False
 
-                    for c2 in clusterings_2:
+def _paired_labels(clusterings_1, clusterings_2, active_sites):
+    """
+    Converts two clusterings of the same sites to label arrays over a common site order: the order of
+    ACTIVE_SITES, or else the sorted site names found in either clustering.
+    """
+
+    if _is_label_array(clusterings_1) and _is_label_array(clusterings_2):
+        return np.asarray(clusterings_1, dtype=int), np.asarray(clusterings_2, dtype=int)
+
+    if active_sites is not None:
+        names = [getattr(a, "name", a) for a in active_sites]
+    else:
+        names = sorted(set(elem for c in list(clusterings_1) + list(clusterings_2)
+                           if not np.isscalar(c) for elem in c), key=str)
 
-                        # a1 and a2 are assigned to same cluster in both sets
-                        if a1.name in c2 and a2.name in c2:
-                            same = True
+    index = {name: i for i, name in enumerate(names)}
 
-                    if same:
-                        tp += 1
-                    else:
-                        fp += 1
+    return clusters_to_labels(clusterings_1, index), clusters_to_labels(clusterings_2, index)
 
 
-                if a1.name in c1 and a2.name not in c1:
-                    diff = False
+def _pair_counts(labels_1, labels_2):
+    """
+    :return: tuple, the number of site pairs, and of pairs in the same cluster in both, the first and the second
+             clustering
+    """
 
-                    for c2 in clusterings_2:
+    table = contingency_table(labels_1, labels_2)
+    N = len(labels_1)
 
-                        if a1.name in c2 and not a2.name in c2:
-                            diff = True
+    def pairs(counts):
+        counts = np.asarray(counts, dtype=np.float64)
+        return np.sum(counts * (counts - 1)) / 2
 
-                    if diff:
-                        tn += 1
-                    else:
-                        fn += 1
+    return N * (N - 1) / 2, pairs(table), pairs(np.sum(table, axis=1)), pairs(np.sum(table, axis=0))
 
-    return (tp + tn) / (tp + fp + tn + fn)
 
-def benchmark_clusters(active_sites, alg = "P", sim_matrix=None, metric="RMSD", N=1000):
+def benchmark_clusters(active_sites, alg = "P", sim_matrix=None, metric="RMSD", N=1000, n_jobs=1):
 
     if sim_matrix is None:
 
-        sim_matrix = create_similarity_matrix(active_sites, metric)
+        sim_matrix = create_similarity_matrix(active_sites, metric, n_jobs=n_jobs)
 
     ssds = []
 
@@ -100,10 +171,10 @@ def benchmark_clusters(active_sites, alg = "P", sim_matrix=None, metric="RMSD",
 
     return np.array(ssds)
 
-def benchmark_rand(active_sites, alg="P", sim_matrix=None, metric="RMSD", N=100, step=10):
+def benchmark_rand(active_sites, alg="P", sim_matrix=None, metric="RMSD", N=100, step=10, n_jobs=1):
 
     if sim_matrix is None:
-        sim_matrix = create_similarity_matrix(active_sites, metric)
+        sim_matrix = create_similarity_matrix(active_sites, metric, n_jobs=n_jobs)
 
     rs = {}
 
@@ -122,31 +193,123 @@ def benchmark_rand(active_sites, alg="P", sim_matrix=None, metric="RMSD", N=100,
     return rs
 
 def compute_avg_rand(all_clusters, active_sites):
+    """
+
+    :param all_clusters: list, R clusterings of ACTIVE_SITES (lists of clusters of names, or label arrays)
+    :param active_sites: list, list of ActiveSite objects that were clustered
+    :return: float, average rand index between all pairs of distinct clusterings
+    """
+
+    if len(all_clusters) < 2:
+        return float("nan")
+
+    index = {a.name: i for i, a in enumerate(active_sites)}
+    labels = np.array([clusters_to_labels(c, index) for c in all_clusters])
+
+    rand = agreement_matrix(labels, "rand")
+
+    return np.mean(rand[~np.eye(len(rand), dtype=bool)])
+
+
+def agreement_matrix(labels, measure="rand", chunk_size=64):
+    """
+    Compares every pair of R clusterings of the same N sites in one vectorized pass. All R^2 contingency tables
+    are blocks of H^T H, where H is the sparse NxK one-hot encoding of every cluster of every clustering; only
+    blocks on or above the diagonal are computed, CHUNK_SIZE clusterings at a time.
+
+    :param labels: np.array, RxN cluster labels, one clustering per row
+    :param measure: str, "rand", "ari" (adjusted rand index) or "nmi" (normalized mutual information)
+    :param chunk_size: int, number of clusterings per block of rows
+    :return: np.array, symmetric RxR agreement between every pair of clusterings
+    """
+
+    if measure not in ("rand", "ari", "nmi"):
+        raise ValueError("Agreement measure not recognized")
+
+    labels = np.atleast_2d(np.asarray(labels))
+    R, N = labels.shape
+
+    # relabel every clustering to 0..k-1 and give every cluster a column of H
+    dense = np.zeros(labels.shape, dtype=int)
+    n_clusters = np.zeros(R, dtype=int)
+    for r in range(R):
+        _, dense[r] = np.unique(labels[r], return_inverse=True)
+        n_clusters[r] = dense[r].max() + 1 if N > 0 else 0
+
+    offsets = np.concatenate([[0], np.cumsum(n_clusters)])
+    cols = (offsets[:-1, np.newaxis] + dense).ravel()
+    H = sparse.csc_matrix((np.ones(R * N), (np.tile(np.arange(N), R), cols)), shape=(N, offsets[-1]))
+
+    sizes = np.asarray(H.sum(axis=0)).ravel()
+    n_pairs = N * (N - 1) / 2
+
+    def pairs(counts):
+        return counts * (counts - 1) / 2
 
-    rand = []
+    def plogp(counts):
+        p = counts / N
+        return np.where(p > 0, p * np.log(np.where(p > 0, p, 1.0)), 0.0)
 
-    for i in range(len(all_clusters)):
+    # per clustering: pairs of sites in the same cluster, and entropy
+    same_self = np.add.reduceat(pairs(sizes), offsets[:-1]) if R > 0 else np.zeros(0)
+    entropy = -np.add.reduceat(plogp(sizes), offsets[:-1]) if R > 0 else np.zeros(0)
 
-        for j in range(len(all_clusters)):
+    result = np.zeros((R, R))
 
-            if i != j:
+    for r0 in range(0, R, chunk_size):
+        r1 = min(r0 + chunk_size, R)
+        c0, c1 = offsets[r0], offsets[r1]
 
-                rand.append(rand_index(all_clusters[i], all_clusters[j], active_sites))
+        # contingency tables of clusterings r0..r1 against r0..R
+        table = (H[:, c0:c1].T @ H[:, c0:]).toarray()
 
-    return np.mean(np.array(rand))
+        if measure == "nmi":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                outer = sizes[c0:c1, np.newaxis] * sizes[np.newaxis, c0:]
+                terms = np.where(table > 0, table / N * np.log(N * table / outer), 0.0)
+        else:
+            terms = pairs(table)
 
+        block = np.add.reduceat(np.add.reduceat(terms, offsets[r0:r1] - c0, axis=0), offsets[r0:-1] - c0, axis=1)
 
-def rand_versus(active_sites, sim_matrix=None, metric="RMSD", N=30, step=5):
+        if measure == "rand":
+            s_a = same_self[r0:r1, np.newaxis]
+            s_b = same_self[np.newaxis, r0:]
+            block = (n_pairs + 2 * block - s_a - s_b) / n_pairs if n_pairs > 0 else np.ones(block.shape)
+
+        elif measure == "ari":
+            s_a = same_self[r0:r1, np.newaxis]
+            s_b = same_self[np.newaxis, r0:]
+            expected = s_a * s_b / n_pairs if n_pairs > 0 else np.zeros(block.shape)
+            maximum = (s_a + s_b) / 2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                block = np.where(maximum == expected, 1.0, (block - expected) / (maximum - expected))
+
+        else:
+            h = entropy[r0:r1, np.newaxis] + entropy[np.newaxis, r0:]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                block = np.where(h > 0, 2 * block / h, 1.0)
+
+        result[r0:r1, r0:] = block
+        result[r0:, r0:r1] = block.T
+
+    return result
+
+
+def rand_versus(active_sites, sim_matrix=None, metric="RMSD", N=30, step=5, n_jobs=1):
 
     if sim_matrix is None:
-        sim_matrix = create_similarity_matrix(active_sites, metric)
+        sim_matrix = create_similarity_matrix(active_sites, metric, n_jobs=n_jobs)
 
     rs = {}
 
+    # one agglomeration serves every K
+    tree = linkage_tree(sim_matrix)
+
     for i in tqdm(range(step, N+step, step)):
 
         a1 = cluster_by_partitioning(active_sites, sim_matrix, K=i)
-        a2 = cluster_hierarchically(active_sites, sim_matrix, K=i)
+        a2 = cut_tree(tree, i)
 
         c1 = convert_indices_to_active_sites(a1, active_sites)
         c2 = convert_indices_to_active_sites(a2, active_sites)
@@ -0,0 +1,169 @@
+import numpy as np
+
+
+def condensed_size(n):
+    """
+    :param n: int, number of rows of a square matrix
+    :return: int, number of entries in the strict upper triangle of an nxn matrix
+    """
+
+    return n * (n - 1) // 2
+
+
+def condensed_index(i, j, n):
+    """
+    Position of entry (i, j) of a symmetric nxn matrix in its condensed upper triangle (the same layout as
+    scipy.spatial.distance.squareform). Works elementwise on arrays of indices.
+
+    :param i: int or np.array, row indices
+    :param j: int or np.array, column indices, with i != j
+    :param n: int, number of rows of the square matrix
+    :return: int or np.array, positions into the condensed array
+    """
+
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def square_index(k, n):
+    """
+    Inverse of condensed_index: the (i, j) entry, i < j, stored at position k of a condensed nxn matrix.
+
+    :param k: int or np.array, positions into the condensed array
+    :param n: int, number of rows of the square matrix
+    :return: tuple, row and column indices
+    """
+
+    k = np.asarray(k)
+    i = (n - 2 - np.floor(np.sqrt(-8 * k + 4 * n * (n - 1) - 7) / 2.0 - 0.5)).astype(np.intp)
+    j = (k + i + 1 - n * (n - 1) // 2 + (n - i) * ((n - i) - 1) // 2).astype(np.intp)
+
+    return i, j
+
+
+class CondensedMatrix:
+    """
+    A symmetric NxN similarity matrix with a zero diagonal, stored as its N(N-1)/2 upper triangle entries.
+    The entries may be float32 to halve memory again, and may live in a memory-mapped file so that matrices
+    larger than RAM stream from disk. Supports the square-matrix indexing used by the clustering code: scalars,
+    slices, integer arrays (broadcast against each other, e.g. np.ix_) and single rows.
+    """
+
+    def __init__(self, n, dtype=np.float64, filename=None, mode="w+", data=None):
+        """
+        :param n: int, number of rows of the square matrix
+        :param dtype: floating point type of the entries
+        :param filename: str, file backing the entries with np.memmap, or None to keep them in memory
+        :param mode: str, np.memmap mode used to open FILENAME
+        :param data: np.array, existing condensed entries to wrap
+        """
+
+        self.n = n
+        size = condensed_size(n)
+
+        if data is not None:
+            self.data = data
+        elif filename is not None and size > 0:
+            self.data = np.memmap(filename, dtype=dtype, mode=mode, shape=(size,))
+        else:
+            self.data = np.zeros(size, dtype=dtype)
+
+    @classmethod
+    def from_square(cls, square, dtype=np.float64, filename=None):
+        """
+        Condenses a square symmetric matrix.
+        """
+
+        square = np.asarray(square)
+        n = square.shape[0]
+        store = cls(n, dtype, filename)
+        store.data[:] = square[np.triu_indices(n, 1)]
+
+        return store
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __len__(self):
+        return self.n
+
+    def __array__(self, dtype=None, copy=None):
+        square = self.to_square()
+        return square if dtype is None else square.astype(dtype)
+
+    def to_square(self):
+        """
+        :return: np.array, the full NxN matrix
+        """
+
+        square = np.zeros((self.n, self.n), dtype=self.dtype)
+        rows, cols = np.triu_indices(self.n, 1)
+        square[rows, cols] = self.data
+        square[cols, rows] = self.data
+
+        return square
+
+    def row(self, i):
+        """
+        :param i: int, row index
+        :return: np.array, row I of the square matrix
+        """
+
+        return self[i, :]
+
+    def flush(self):
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+
+    def _indices(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+
+        if len(key) != 2:
+            raise IndexError("CondensedMatrix takes two indices")
+
+        idx = []
+        for k in key:
+            if isinstance(k, slice):
+                k = np.arange(self.n)[k]
+            else:
+                k = np.asarray(k, dtype=np.intp)
+                k = np.where(k < 0, k + self.n, k)
+            idx.append(k)
+
+        rows, cols = idx
+
+        # as with numpy, a slice combined with an index array selects their outer product
+        if (isinstance(key[0], slice) or isinstance(key[1], slice)) and rows.ndim > 0 and cols.ndim > 0:
+            rows = rows.reshape(-1, 1)
+            cols = cols.reshape(1, -1)
+
+        return np.broadcast_arrays(rows, cols)
+
+    def __getitem__(self, key):
+        rows, cols = self._indices(key)
+
+        values = np.zeros(rows.shape, dtype=self.dtype)
+        off_diag = rows != cols
+        values[off_diag] = self.data[condensed_index(rows[off_diag], cols[off_diag], self.n)]
+
+        if values.ndim == 0:
+            return values[()]
+
+        return values
+
+    def __setitem__(self, key, value):
+        rows, cols = self._indices(key)
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), rows.shape)
+
+        off_diag = rows != cols
+        self.data[condensed_index(rows[off_diag], cols[off_diag], self.n)] = value[off_diag]
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+from .similarity import get_metric
+
+# Neighbors first searched for a link out of every component when connecting a graph. Components of a k-nearest
+# neighbor graph are mostly small clumps of near-duplicates, so a few more neighbors than the graph's own k usually
+# reach outside of them in one batched tree query; searches from larger components are widened 4x at a time.
+COMPONENT_NEIGHBORS = 16
+
+
+class SiteIndex:
+    """
+    A k-d tree over the embedding vectors of a set of active sites (see similarity.Metric), answering nearest
+    neighbor queries in O(log N) instead of comparing against every site. Only metrics with an embedding can be
+    indexed.
+    """
+
+    def __init__(self, active_sites, metric="composition", leafsize=16):
+        """
+        :param active_sites: List of ActiveSite objects of length N
+        :param metric: str, name of a registered metric with an embedding
+        :param leafsize: int, number of sites in the leaves of the tree
+        """
+
+        self.metric = get_metric(metric)
+        if self.metric.embedding is None:
+            raise ValueError("Metric %s has no embedding to index." % metric)
+
+        self.names = [a.name for a in active_sites]
+        self.vectors = np.asarray(self.metric.embedding(active_sites), dtype=np.float64).reshape(len(active_sites), -1)
+        self.tree = cKDTree(self.vectors, leafsize=leafsize)
+
+    def __len__(self):
+        return len(self.names)
+
+    def query(self, active_sites, k=10):
+        """
+        Finds the K sites of the index most similar to each of ACTIVE_SITES.
+
+        :param active_sites: List of ActiveSite objects of length Q
+        :param k: int, number of neighbors
+        :return: tuple, QxK similarities and QxK indices of the neighbors, closest first
+        """
+
+        vectors = np.asarray(self.metric.embedding(active_sites), dtype=np.float64).reshape(len(active_sites), -1)
+
+        return self._query_vectors(vectors, k)
+
+    def _query_vectors(self, vectors, k):
+        k = min(k, len(self))
+        dist, idx = self.tree.query(vectors, k=k)
+        dist = np.asarray(dist, dtype=np.float64).reshape(len(vectors), k)
+        idx = np.asarray(idx).reshape(len(vectors), k)
+
+        return dist**self.metric.embedding_power, idx
+
+    def knn_graph(self, k=10, connect=True):
+        """
+        Sparse k-nearest neighbor graph of the indexed sites, built with N tree queries in O(N log N). Every site
+        is linked to its K nearest neighbors, and the graph is made symmetric. With CONNECT, separate components
+        are then joined by their closest links, so that every site can reach every other one.
+
+        Edges are weighted by the similarity of the sites they join. Edges of similarity 0 are stored explicitly
+        (scipy.sparse.csgraph treats them as edges).
+
+        :param k: int, number of neighbors of every site
+        :param connect: bool, join the components of the graph
+        :return: scipy.sparse.csr_matrix, NxN graph
+        """
+
+        N = len(self)
+        if N < 2:
+            return sparse.csr_matrix((N, N))
+
+        # the nearest neighbor of a site is itself (or a duplicate of it)
+        dist, idx = self._query_vectors(self.vectors, k + 1)
+        rows = np.repeat(np.arange(N), idx.shape[1])
+        graph = _symmetric_graph(rows, idx.ravel(), dist.ravel(), N)
+
+        if connect:
+            graph = self._connect_components(graph)
+
+        return graph
+
+    def _connect_components(self, graph, n_neighbors=COMPONENT_NEIGHBORS):
+        """
+        Repeatedly links one site of every component of GRAPH to its nearest site outside of the component, until
+        only one component is left. Every round at least halves the number of components. N_NEIGHBORS neighbors
+        are searched first for every component.
+        """
+
+        N = len(self)
+        n_components, component = csgraph.connected_components(graph, directed=False)
+
+        while n_components > 1:
+            # one representative site per component, and its neighbors
+            representatives = np.unique(component, return_index=True)[1]
+            k = n_neighbors
+            d, idx = self._query_vectors(self.vectors[representatives], k)
+            outside = component[idx] != component[representatives][:, np.newaxis]
+
+            # widen the search for components larger than the neighborhoods searched so far
+            for r in np.flatnonzero(~np.any(outside, axis=1)):
+                wide = k
+                while not np.any(outside[r]) and wide < N:
+                    wide *= 4
+                    d_r, idx_r = self._query_vectors(self.vectors[representatives[r:r + 1]], wide)
+                    found = component[idx_r[0]] != component[representatives[r]]
+                    j = np.argmax(found)
+                    d[r, 0], idx[r, 0], outside[r, 0] = d_r[0, j], idx_r[0, j], found[j]
+
+            j = np.argmax(outside, axis=1)
+            rows = np.arange(len(representatives))
+            links = _symmetric_graph(representatives, idx[rows, j], d[rows, j], N)
+
+            graph = _merge_graphs(graph, links)
+            n_components, component = csgraph.connected_components(graph, directed=False)
+
+        return graph
+
+
+def knn_graph(active_sites, k=10, metric="composition", connect=True):
+    """
+    Sparse k-nearest neighbor graph of ACTIVE_SITES under METRIC (see SiteIndex.knn_graph).
+
+    :param active_sites: List of ActiveSite objects of length N
+    :param k: int, number of neighbors of every site
+    :param metric: str, name of a registered metric with an embedding
+    :param connect: bool, join the components of the graph
+    :return: scipy.sparse.csr_matrix, NxN graph
+    """
+
+    return SiteIndex(active_sites, metric).knn_graph(k, connect)
+
+
+def _symmetric_graph(rows, cols, dist, N):
+    """
+    Builds a symmetric sparse graph from directed edges, dropping self loops and keeping zero weights explicitly.
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    keep = rows != cols
+    rows, cols, dist = rows[keep], cols[keep], np.asarray(dist, dtype=np.float64)[keep]
+
+    # duplicate edges (i, j) and (j, i) carry the same weight, so any one of them may be kept
+    i = np.concatenate([rows, cols])
+    j = np.concatenate([cols, rows])
+    key, first = np.unique(i * N + j, return_index=True)
+    weights = np.concatenate([dist, dist])[first]
+
+    return sparse.csr_matrix((weights, (key // N, key % N)), shape=(N, N))
+
+
+def _merge_graphs(graph, links):
+    coo_a = graph.tocoo()
+    coo_b = links.tocoo()
+
+    return _symmetric_graph(np.concatenate([coo_a.row, coo_b.row]), np.concatenate([coo_a.col, coo_b.col]),
+                            np.concatenate([coo_a.data, coo_b.data]), graph.shape[0])
@@ -1,32 +1,84 @@
+import functools
 import glob
+import json
+import multiprocessing
 import os
+import numpy as np
 from .utils import Atom, Residue, ActiveSite
+from .store import SiteStore, write_site_store
+from .model import ClusterModel
 
+# Solvent residues skipped when reading HETATM records
+WATERS = {"HOH", "WAT", "DOD", "H2O"}
 
-def read_active_sites(dir):
+
+def read_active_sites(dir, n_jobs=1, lazy=False):
     """
-    Read in all of the active sites from the given directory.
+    Read in all of the active sites from the given directory, or from a site store written by write_site_store.
 
-    Input: directory
+    Input: directory or site store, optionally the number of processes parsing files concurrently, and whether to
+           defer reading coordinates until they are used (see read_active_site)
     Output: list of ActiveSite instances
     """
-    files = glob.glob(dir + '/*.pdb')
 
-    active_sites = []
-    # iterate over each .pdb file in the given directory
-    for filepath in glob.iglob(os.path.join(dir, "*.pdb")):
-        active_sites.append(read_active_site(filepath))
+    if os.path.isfile(dir):
+        active_sites = read_site_store(dir).sites()
+        print("Read in %d active sites"%len(active_sites))
+        return active_sites
+
+    files = pdb_files(dir)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    if n_jobs == 1 or len(files) < 2:
+        active_sites = list(iter_active_sites(dir, lazy))
+    else:
+        with multiprocessing.Pool(n_jobs) as pool:
+            active_sites = pool.map(functools.partial(read_active_site, lazy=lazy), files,
+                                    chunksize=max(1, len(files) // (4 * n_jobs)))
 
     print("Read in %d active sites"%len(active_sites))
 
     return active_sites
 
 
-def read_active_site(filepath):
+def iter_active_sites(dir, lazy=False):
     """
-    Read in a single active site given a PDB file
+    Stream the active sites of the given directory, one file at a time.
 
-    Input: PDB file path
+    Input: directory, and optionally whether to defer reading coordinates
+    Output: generator of ActiveSite instances
+    """
+
+    # iterate over each .pdb file in the given directory
+    for filepath in pdb_files(dir):
+        yield read_active_site(filepath, lazy)
+
+
+def pdb_files(dir):
+    """
+    Input: directory
+    Output: list of the paths of all .pdb files in the directory
+    """
+
+    return glob.glob(os.path.join(dir, "*.pdb"))
+
+
+def read_active_site(filepath, lazy=False):
+    """
+    Read in a single active site given a PDB file, in one buffered pass over its records:
+
+    - ATOM and HETATM records are atoms (waters are skipped), all other records are ignored
+    - residues are keyed by chain, residue number and insertion code, and end at a TER card, at a change of key or
+      at the end of the file
+    - only the first alternate location of an atom is kept
+    - only the first model of a multi-model file is read
+
+    The coordinate columns of all atoms are converted to a packed array in a single NumPy call. A lazy site only
+    reads its residues and atom names now, and its coordinates the first time a metric uses them.
+
+    Input: PDB file path, and optionally whether to defer reading coordinates
     Output: ActiveSite instance
     """
     basename = os.path.basename(filepath)
@@ -35,38 +87,107 @@ def read_active_site(filepath):
     if name[1] != ".pdb":
         raise IOError("%s is not a PDB file"%filepath)
 
-    active_site = ActiveSite(name[0])
+    residues, residue_offsets, atom_lines = _read_records(filepath)
+    residue_types, residue_chains, residue_numbers, residue_insertions = residues
+    atom_types = [line[12:16].strip() for line in atom_lines]
+
+    if lazy:
+        return ActiveSite.lazy(name[0], residue_types, residue_numbers, residue_offsets, atom_types,
+                               functools.partial(read_coordinates, filepath), residue_chains, residue_insertions)
 
-    r_num = 0
+    return ActiveSite.from_arrays(name[0], residue_types, residue_numbers, residue_offsets, atom_types,
+                                  _parse_coordinates(atom_lines), residue_chains=residue_chains,
+                                  residue_insertions=residue_insertions)
+
+
+def read_coordinates(filepath):
+    """
+    Read in the atomic coordinates of the active site in a PDB file, in the order of read_active_site.
+
+    Input: PDB file path
+    Output: (A, 3) array of coordinates
+    """
+
+    return _parse_coordinates(_read_records(filepath)[2])
+
+
+def _read_records(filepath):
+    """
+    Input: PDB file path
+    Output: the types, chains, numbers and insertion codes of its residues, the atom offset of every residue and the
+            lines of all atoms (see read_active_site)
+    """
 
     # open pdb file
     with open(filepath, "r") as f:
-        # iterate over each line in the file
-        for line in f:
-            if line[0:3] != 'TER':
-                # read in an atom
-                atom_type = line[13:17].strip()
-                x_coord = float(line[30:38])
-                y_coord = float(line[38:46])
-                z_coord = float(line[46:54])
-                atom = Atom(atom_type)
-                atom.coords = (x_coord, y_coord, z_coord)
+        lines = f.read().splitlines()
+
+    residue_types = []
+    residue_numbers = []
+    residue_chains = []
+    residue_insertions = []
+    residue_offsets = [0]
+    atom_lines = []
+
+    r_key = None
+    alternates = set()
+
+    # iterate over each line in the file
+    for line in lines:
+        record = line[0:6]
+
+        if record == "ATOM  " or record == "HETATM":
+            if line[17:20] in WATERS:
+                continue
+
+            # make a new residue if needed
+            key = line[21:27]
+            if key != r_key:
+                if len(atom_lines) > residue_offsets[-1]:
+                    residue_offsets.append(len(atom_lines))
+                r_key = key
+                residue_types.append(line[17:20].strip())
+                residue_chains.append(line[21])
+                residue_numbers.append(int(line[22:26]))
+                residue_insertions.append(line[26])
+                alternates = set()
+
+            # keep the first alternate location of every atom
+            if line[16] != " ":
+                atom_name = line[12:16]
+                if atom_name in alternates:
+                    continue
+                alternates.add(atom_name)
+
+            atom_lines.append(line)
+
+        elif record[0:3] == "TER":  # I've reached a TER card
+            r_key = None
+
+        elif record[0:3] == "END":  # END, or ENDMDL of the first model
+            break
+
+    if len(atom_lines) > residue_offsets[-1]:
+        residue_offsets.append(len(atom_lines))
 
-                residue_type = line[17:20]
-                residue_number = int(line[23:26])
+    return (residue_types, residue_chains, residue_numbers, residue_insertions), residue_offsets, atom_lines
 
-                # make a new residue if needed
-                if residue_number != r_num:
-                    residue = Residue(residue_type, residue_number)
-                    r_num = residue_number
 
-                # add the atom to the residue
-                residue.atoms.append(atom)
+def _parse_coordinates(atom_lines):
+    return np.fromstring(" ".join(line[30:38] + " " + line[38:46] + " " + line[46:54] for line in atom_lines),
+                         dtype=np.float64, sep=" ").reshape(-1, 3)
 
-            else:  # I've reached a TER card
-                active_site.residues.append(residue)
 
-    return active_site
+def read_site_store(filename):
+    """
+    Open a site store written by write_site_store. The store is memory-mapped, and its active sites are only
+    built when accessed.
+
+    Input: site store path
+    Output: SiteStore, indexable by position or active site name
+    """
+
+    return SiteStore(filename)
 
 
 def write_clustering(filename, clusters):
@@ -87,11 +208,42 @@ def write_clustering(filename, clusters):
     out.close()
 
 
-def write_mult_clusterings(filename, clusterings):
+def write_cluster_model(filename, model):
+    """
+    Write a ClusterModel out to a JSON file: its metric, the library holding its sites, the name of the medoid of
+    every cluster, and the name and cluster label of every site.
+
+    Input: a filename and a ClusterModel
+    Output: none
+    """
+
+    with open(filename, "w") as out:
+        json.dump({"metric": model.metric,
+                   "library": model.library,
+                   "medoids": model.medoids,
+                   "names": model.names,
+                   "labels": model.labels.tolist()}, out, indent=1)
+
+
+def read_cluster_model(filename):
+    """
+    Read in a ClusterModel written by write_cluster_model.
+
+    Input: a filename
+    Output: ClusterModel
+    """
+
+    with open(filename, "r") as f:
+        spec = json.load(f)
+
+    return ClusterModel(spec["names"], spec["labels"], spec["medoids"], spec["metric"], spec.get("library"))
+
+
+def write_mult_clusterings(filename, clusterings, titles=None):
     """
     Write a series of clusterings of ActiveSite instances out to a file.
 
-    Input: a filename and a list of clusterings of ActiveSite instances
+    Input: a filename, a list of clusterings of ActiveSite instances, and optionally a title for each clustering
     Output: none
     """
 
@@ -100,9 +252,70 @@ def write_mult_clusterings(filename, clusterings):
     for i in range(len(clusterings)):
         clusters = clusterings[i]
 
+        if titles is not None:
+            out.write("\nClustering %s\n==============\n" % titles[i])
+
         for j in range(len(clusters)):
             out.write("\nCluster %d\n------------\n" % j)
             for k in range(len(clusters[j])):
                 out.write("%s\n" % clusters[j][k])
 
     out.close()
+
+
+def write_cuts(filename, cuts):
+    """
+    Write several cuts of one hierarchical clustering out to a single file.
+
+    Input: a filename and a dictionary mapping each number of clusters K to a clustering of ActiveSite instances
+    Output: none
+    """
+
+    Ks = sorted(cuts)
+    write_mult_clusterings(filename, [cuts[K] for K in Ks], ["K=%d" % K for K in Ks])
+
+
+def write_similarity_matrix(filename, sim_matrix, names, metric=None):
+    """
+    Write a similarity matrix out to a .npy file, the names of its active sites (one per line, in matrix order)
+    to FILENAME.names, and the name of the metric that computed it to FILENAME.metric
+
+    Input: a filename, an NxN similarity matrix, a list of N active site names, and optionally the metric name
+    Output: none
+    """
+
+    with open(filename, "wb") as out:
+        np.save(out, np.asarray(sim_matrix))
+
+    with open(filename + ".names", "w") as out:
+        for name in names:
+            out.write("%s\n" % name)
+
+    if metric is not None:
+        with open(filename + ".metric", "w") as out:
+            out.write("%s\n" % metric)
+
+
+def read_similarity_matrix(filename, mmap_mode=None, return_metric=False):
+    """
+    Read in a similarity matrix written by write_similarity_matrix.
+
+    Input: a filename, optionally a numpy memory-map mode, and whether to return the metric name
+    Output: the NxN similarity matrix and the list of N active site names
+            and, if RETURN_METRIC, the name of the metric that computed it (None if it was not recorded)
+    """
+
+    sim_matrix = np.load(filename, mmap_mode=mmap_mode)
+
+    with open(filename + ".names", "r") as f:
+        names = [line.strip() for line in f if line.strip()]
+
+    if not return_metric:
+        return sim_matrix, names
+
+    metric = None
+    if os.path.exists(filename + ".metric"):
+        with open(filename + ".metric", "r") as f:
+            metric = f.read().strip()
+
+    return sim_matrix, names, metric
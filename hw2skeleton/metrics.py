@@ -0,0 +1,194 @@
+import numpy as np
+from scipy import sparse
+
+
+def cluster_sums(labels, sim_matrix, chunk_size=None):
+    """
+    Grouped row sums of the similarity matrix: entry (i, k) is the total similarity of site i to the members of
+    cluster k. Every quality metric below is derived from this one NxK table. Condensed and memory-mapped matrices
+    are read CHUNK_SIZE rows at a time, so the full square matrix is never held in memory. For a sparse nearest
+    neighbor graph (see index.knn_graph) only the similarities along its edges are summed.
+
+    :param labels: np.array, length N cluster labels in 0..K-1 (negative labels are left out of every cluster)
+    :param sim_matrix: np.array, np.memmap, CondensedMatrix or scipy sparse matrix, NxN similarity matrix
+    :param chunk_size: int, rows per chunk (default: the whole matrix at once for in-memory arrays, else 1024)
+    :return: np.array, NxK cluster sums
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    N = len(labels)
+    K = labels.max() + 1 if N > 0 else 0
+
+    members = labels >= 0
+    one_hot = np.zeros((N, K))
+    one_hot[np.flatnonzero(members), labels[members]] = 1.0
+
+    if chunk_size is None:
+        dense = isinstance(sim_matrix, np.ndarray) and not isinstance(sim_matrix, np.memmap)
+        chunk_size = max(N, 1) if dense else 1024
+
+    sums = np.zeros((N, K))
+    for i0 in range(0, N, chunk_size):
+        i1 = min(i0 + chunk_size, N)
+        if sparse.issparse(sim_matrix):
+            sums[i0:i1] = np.asarray(sim_matrix[i0:i1] @ one_hot, dtype=np.float64)
+        else:
+            sums[i0:i1] = np.asarray(sim_matrix[i0:i1, :], dtype=np.float64) @ one_hot
+
+    return sums
+
+
+def within_cluster_ssd(labels, sim_matrix, sums=None):
+    """
+    :param labels: np.array, length N cluster labels
+    :param sim_matrix: NxN similarity matrix
+    :param sums: np.array, NxK cluster_sums, if already computed
+    :return: float, total similarity over all pairs of sites in the same cluster
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    if sums is None:
+        sums = cluster_sums(labels, sim_matrix)
+
+    members = np.flatnonzero(labels >= 0)
+
+    return np.sum(sums[members, labels[members]]) / 2
+
+
+def medoid_cost(labels, sim_matrix, medoids=None, sums=None):
+    """
+    :param labels: np.array, length N cluster labels
+    :param sim_matrix: NxN similarity matrix
+    :param medoids: np.array, index of the medoid of every cluster, or None to use the best medoid of each cluster
+    :param sums: np.array, NxK cluster_sums, if already computed
+    :return: float, total similarity of every site to the medoid of its cluster
+    """
+
+    if sums is None:
+        sums = cluster_sums(labels, sim_matrix)
+
+    if medoids is None:
+        medoids = find_medoids(labels, sim_matrix, sums)
+
+    # the similarity matrix is symmetric, so a medoid's row sum over its cluster is the cost of the cluster
+    clusters = np.flatnonzero(np.asarray(medoids) >= 0)
+
+    return np.sum(sums[np.asarray(medoids)[clusters], clusters])
+
+
+def find_medoids(labels, sim_matrix, sums=None):
+    """
+    :param labels: np.array, length N cluster labels in 0..K-1
+    :param sim_matrix: NxN similarity matrix
+    :param sums: np.array, NxK cluster_sums, if already computed
+    :return: np.array, the member of every cluster with the smallest total similarity to the rest of it (-1 for
+             empty clusters)
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    if sums is None:
+        sums = cluster_sums(labels, sim_matrix)
+
+    K = sums.shape[1]
+    medoids = np.full(K, -1, dtype=int)
+    for k in range(K):
+        members = np.flatnonzero(labels == k)
+        if len(members) > 0:
+            medoids[k] = members[np.argmin(sums[members, k])]
+
+    return medoids
+
+
+def silhouette(labels, sim_matrix, sums=None):
+    """
+    Mean silhouette width, using the similarity matrix as distances. Sites alone in their cluster score 0.
+
+    :param labels: np.array, length N cluster labels
+    :param sim_matrix: NxN similarity matrix
+    :param sums: np.array, NxK cluster_sums, if already computed
+    :return: float, mean silhouette over the clustered sites, in [-1, 1]
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    if sums is None:
+        sums = cluster_sums(labels, sim_matrix)
+
+    members = np.flatnonzero(labels >= 0)
+    sizes = np.bincount(labels[members], minlength=sums.shape[1]).astype(float)
+
+    if np.count_nonzero(sizes) < 2:
+        return 0.0
+
+    own = labels[members]
+    own_size = sizes[own]
+
+    # mean similarity to the rest of the own cluster, and to the closest other cluster
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = np.where(own_size > 1, sums[members, own] / (own_size - 1), 0.0)
+        mean_other = sums[members] / sizes[np.newaxis, :]
+    mean_other[:, sizes == 0] = np.inf
+    mean_other[np.arange(len(members)), own] = np.inf
+    b = np.min(mean_other, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = np.where((own_size > 1) & (np.maximum(a, b) > 0), (b - a) / np.maximum(a, b), 0.0)
+
+    return np.mean(s)
+
+
+def davies_bouldin(labels, sim_matrix, medoids=None, sums=None):
+    """
+    Davies-Bouldin index with medoids standing in for centroids: the scatter of a cluster is the mean similarity of
+    its members to its medoid, and the separation of two clusters the similarity of their medoids. Lower is better.
+
+    :param labels: np.array, length N cluster labels
+    :param sim_matrix: NxN similarity matrix
+    :param medoids: np.array, index of the medoid of every cluster, or None to use the best medoid of each cluster
+    :param sums: np.array, NxK cluster_sums, if already computed
+    :return: float, Davies-Bouldin index
+    """
+
+    labels = np.asarray(labels, dtype=int)
+    if medoids is None:
+        medoids = find_medoids(labels, sim_matrix, sums)
+
+    medoids = np.asarray(medoids, dtype=int)
+    clusters = np.flatnonzero(medoids >= 0)
+    K = len(clusters)
+
+    if K < 2:
+        return 0.0
+
+    members = np.flatnonzero(labels >= 0)
+    to_medoid = np.asarray(sim_matrix[members, medoids[labels[members]]], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scatter = np.bincount(labels[members], weights=to_medoid, minlength=len(medoids)) / \
+            np.bincount(labels[members], minlength=len(medoids))
+    scatter = scatter[clusters]
+    medoids = medoids[clusters]
+
+    separation = np.asarray(sim_matrix[np.ix_(medoids, medoids)], dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = (scatter[:, np.newaxis] + scatter[np.newaxis, :]) / separation
+    ratio[np.eye(K, dtype=bool)] = -np.inf
+
+    return np.mean(np.max(ratio, axis=1))
+
+
+def cluster_quality(labels, sim_matrix, chunk_size=None):
+    """
+    Scores a clustering with every metric in this module, from a single pass over the similarity matrix.
+
+    :param labels: np.array, length N cluster labels
+    :param sim_matrix: np.array, np.memmap or CondensedMatrix, NxN similarity matrix
+    :param chunk_size: int, rows of the matrix read at a time (see cluster_sums)
+    :return: dict, "ssd", "medoid_cost", "silhouette" and "davies_bouldin" scores
+    """
+
+    sums = cluster_sums(labels, sim_matrix, chunk_size)
+
+    return {"ssd": within_cluster_ssd(labels, sim_matrix, sums),
+            "medoid_cost": medoid_cost(labels, sim_matrix, sums=sums),
+            "silhouette": silhouette(labels, sim_matrix, sums),
+            "davies_bouldin": davies_bouldin(labels, sim_matrix, sums=sums)}
+
@@ -0,0 +1,131 @@
+import numpy as np
+from .similarity import get_metric
+
+
+class ClusterModel:
+    """
+    A partitioning of a library of active sites, kept so that new sites can be placed into it without clustering
+    again: the names of the clustered sites and their cluster labels, the medoid of every cluster, and the metric
+    the clustering was computed with.
+
+    A new site joins the cluster of its most similar medoid, so assigning it takes K similarities instead of the N
+    a new row of the similarity matrix would. The medoid sites are looked up in a library once, and kept with their
+    features for every later assignment.
+    """
+
+    def __init__(self, names, labels, medoids, metric="hydrophobicity", library=None):
+        """
+        :param names: list of str, names of the clustered active sites
+        :param labels: list of int, cluster of every site of NAMES
+        :param medoids: list of str, name of the medoid site of every cluster
+        :param metric: str, name of the registered metric the clustering was computed with
+        :param library: str, pdb directory or site store holding the medoid sites, or None
+        """
+
+        self.names = list(names)
+        self.labels = np.asarray(labels, dtype=int)
+        self.medoids = list(medoids)
+        self.metric = metric
+        self.library = library
+
+        self._medoid_sites = None
+
+    @classmethod
+    def from_clustering(cls, active_sites, clusters, medoids, metric="hydrophobicity", library=None):
+        """
+        :param active_sites: list of ActiveSite objects that were clustered
+        :param clusters: list of clusters, each a list of indices into ACTIVE_SITES (see cluster_by_partitioning)
+        :param medoids: list of int, index of the medoid of every cluster
+        :param metric: str, name of the registered metric the clustering was computed with
+        :param library: str, pdb directory or site store holding the sites, or None
+        :return: ClusterModel
+        """
+
+        indices = [i for cluster in clusters for i in cluster]
+        labels = [k for k, cluster in enumerate(clusters) for i in cluster]
+
+        return cls([active_sites[i].name for i in indices], labels, [active_sites[m].name for m in medoids], metric,
+                   library)
+
+    @property
+    def K(self):
+        return len(self.medoids)
+
+    def __len__(self):
+        return len(self.names)
+
+    def clusters(self):
+        """
+        :return: list of clusters, each a list of site names (see io.write_clustering)
+        """
+
+        clusters = [[] for k in range(self.K)]
+        for name, label in zip(self.names, self.labels):
+            clusters[label].append(name)
+
+        return clusters
+
+    def medoid_sites(self, library=None):
+        """
+        Looks up the medoid sites in LIBRARY the first time it is called, and returns them from then on.
+
+        :param library: list of ActiveSite objects, SiteStore, or dict of ActiveSite objects by name
+        :return: list of the K medoid ActiveSite objects
+        """
+
+        if self._medoid_sites is None:
+            if library is None:
+                raise ValueError("The medoid sites of the model have not been loaded.")
+
+            if isinstance(library, (list, tuple)):
+                library = {a.name: a for a in library}
+
+            self._medoid_sites = [library[name] for name in self.medoids]
+            get_metric(self.metric).precompute(self._medoid_sites)
+
+        return self._medoid_sites
+
+    def predict(self, active_sites, library=None):
+        """
+        Finds the cluster of every site of ACTIVE_SITES, without changing the model.
+
+        :param active_sites: list of ActiveSite objects
+        :param library: holds the medoid sites, if not looked up yet (see medoid_sites)
+        :return: tuple, length N array of cluster labels and length N array of similarities to their medoids
+        """
+
+        medoids = self.medoid_sites(library)
+
+        if len(active_sites) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+
+        dist = get_metric(self.metric).block(active_sites, medoids)
+        labels = np.argmin(dist, axis=1)
+
+        return labels, dist[np.arange(len(active_sites)), labels]
+
+    def assign(self, active_sites, library=None):
+        """
+        Places every site of ACTIVE_SITES into its cluster, adding it to the model (sites already in the model move
+        to their new cluster). The medoids are left unchanged.
+
+        :param active_sites: list of ActiveSite objects
+        :param library: holds the medoid sites, if not looked up yet (see medoid_sites)
+        :return: tuple, length N array of cluster labels and length N array of similarities to their medoids
+        """
+
+        labels, scores = self.predict(active_sites, library)
+
+        position = {name: i for i, name in enumerate(self.names)}
+        new_labels = list(self.labels)
+        for site, label in zip(active_sites, labels):
+            if site.name in position:
+                new_labels[position[site.name]] = label
+            else:
+                position[site.name] = len(self.names)
+                self.names.append(site.name)
+                new_labels.append(label)
+
+        self.labels = np.asarray(new_labels, dtype=int)
+
+        return labels, scores
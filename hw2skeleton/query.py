@@ -0,0 +1,99 @@
+import numpy as np
+from .similarity import get_metric
+
+
+class SiteSearch:
+    """
+    Finds the active sites of a library most similar to new sites, without building any similarity matrix. The
+    library's features are computed once when the search is created, so every query only scores the query site.
+
+    Sites are scored in batches with the metric's vectorized hooks. When the metric provides a lower bound (RMSD
+    does), candidates are scored in order of their bound, and the search stops as soon as no remaining bound can
+    beat the k-th best score found, so the result is exact. A cheap PREFILTER metric can additionally narrow the
+    library down to its N_CANDIDATES sites closest to the query under that metric first (which is approximate).
+    """
+
+    def __init__(self, library, metric="RMSD", prefilter=None):
+        """
+        :param library: list of ActiveSite objects, or a SiteStore
+        :param metric: str, name of the registered metric to rank sites by
+        :param prefilter: str, name of a cheap registered metric to preselect candidates with, or None
+        """
+
+        self.sites = library.sites() if hasattr(library, "sites") else list(library)
+        self.names = [a.name for a in self.sites]
+        self.metric = get_metric(metric)
+        self.prefilter = get_metric(prefilter) if prefilter is not None else None
+
+        self.metric.precompute(self.sites)
+
+        self.bounds = None
+        if self.metric.lower_bound is not None:
+            self.bounds = self.metric.bound_featurize(self.sites)
+
+        self.prefilter_features = None
+        if self.prefilter is not None:
+            self.prefilter.precompute(self.sites)
+            if self.prefilter.pairwise is not None:
+                self.prefilter_features = self.prefilter.featurize(self.sites)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def query(self, active_site, k=10, n_candidates=None, batch_size=256):
+        """
+        :param active_site: ActiveSite object to search for
+        :param k: int, number of sites to return
+        :param n_candidates: int, number of sites kept by the prefilter (default: all of them)
+        :param batch_size: int, number of sites scored at a time
+        :return: list of the (name, score) of the K library sites most similar to ACTIVE_SITE, most similar first
+        """
+
+        candidates = np.arange(len(self))
+
+        if self.prefilter is not None and n_candidates is not None and n_candidates < len(self):
+            cheap = self.prefilter.block([active_site], self.sites, features_b=self.prefilter_features)[0]
+            candidates = np.argsort(cheap, kind="mergesort")[:n_candidates]
+
+        if self.bounds is not None:
+            query_bounds = self.metric.bound_featurize([active_site])
+            bounds = self.metric.lower_bound(query_bounds, tuple(b[candidates] for b in self.bounds))
+            order = np.argsort(bounds, kind="mergesort")
+            candidates, bounds = candidates[order], bounds[order]
+        else:
+            bounds = np.zeros(len(candidates))
+
+        scored = np.empty(0, dtype=int)
+        scores = np.empty(0)
+
+        for start in range(0, len(candidates), batch_size):
+            # stop once no remaining site can score better than the k-th best so far
+            if len(scores) >= k and bounds[start] >= np.sort(scores)[k - 1]:
+                break
+
+            batch = candidates[start:start + batch_size]
+            block = self.metric.block([active_site], [self.sites[i] for i in batch])[0]
+
+            scored = np.concatenate([scored, batch])
+            scores = np.concatenate([scores, block])
+
+        best = np.argsort(scores, kind="mergesort")[:k]
+
+        return [(self.names[scored[i]], scores[i]) for i in best]
+
+
+def top_k(active_site, library, k=10, metric="RMSD", prefilter=None, n_candidates=None):
+    """
+    One-off search for the K sites of LIBRARY most similar to ACTIVE_SITE (see SiteSearch, which should be kept
+    around to run many queries against the same library).
+
+    :param active_site: ActiveSite object to search for
+    :param library: list of ActiveSite objects, or a SiteStore
+    :param k: int, number of sites to return
+    :param metric: str, name of the registered metric to rank sites by
+    :param prefilter: str, name of a cheap registered metric to preselect candidates with, or None
+    :param n_candidates: int, number of sites kept by the prefilter
+    :return: list of the (name, score) of the K most similar sites, most similar first
+    """
+
+    return SiteSearch(library, metric, prefilter).query(active_site, k, n_candidates)
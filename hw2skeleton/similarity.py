@@ -1,5 +1,6 @@
-from .utils import Atom, Residue, ActiveSite
+from .utils import Atom, Residue, ActiveSite, euclideanDist, COORDINATE_FREE_FEATURES
 import numpy as np
+from scipy.spatial.distance import cdist
 
 HYDROPHOBICITY = {"ILE": .73, "PHE": .61, "VAL": .54, "LEU": .53,
                   "TRP": .37, "MET": .26, "ALA": .25, "GLY": .16,
@@ -7,6 +8,180 @@ HYDROPHOBICITY = {"ILE": .73, "PHE": .61, "VAL": .54, "LEU": .53,
                   "SER": -.26, "HIS": -.40, "GLU": -0.62, "ASN": -.64,
                   "GLN": -0.69, "ASP": -0.72, "LYS": -1.10, "ARG": -1.80}
 
+# Residue types counted by the "composition" feature, in vector order
+AMINO_ACIDS = sorted(HYDROPHOBICITY)
+
+# Per-site features used by the comparison methods, by name. Each is computed from a single site by the registered
+# function, and cached in ActiveSite.features by get_feature, so that it is derived once per site rather than once
+# per pair of sites.
+FEATURES = {}
+
+# Registered comparison methods, by name (see register_metric)
+METRICS = {}
+
+# Rounds of core refinement of every TM-score superposition
+TM_ITERATIONS = 5
+
+
+def feature(name, coordinates=True):
+    """
+    Decorator registering a function of one ActiveSite as the per-site feature NAME. Features that do not read
+    COORDINATES are kept when a lazy site's coordinates are evicted (see utils.set_coordinate_cache_size).
+    """
+
+    def register(function):
+        FEATURES[name] = function
+        if coordinates:
+            COORDINATE_FREE_FEATURES.discard(name)
+        else:
+            COORDINATE_FREE_FEATURES.add(name)
+        return function
+
+    return register
+
+
+def get_feature(active_site, name):
+    """
+    :param active_site: ActiveSite object
+    :param name: str, name of a registered feature
+    :return: the feature of active_site, computed on first use and cached on the site afterwards
+    """
+
+    features = active_site.features
+    if name not in features:
+        if name not in FEATURES:
+            raise ValueError("Feature %s not recognized." % name)
+        features[name] = FEATURES[name](active_site)
+
+    return features[name]
+
+
+class Metric:
+    """
+    A method of comparing active sites. A metric provides a scalar COMPARE hook scoring one pair of sites, a
+    block-vectorized PAIRWISE hook scoring every pair of two featurized lists of sites at once, or both:
+
+    - featurize(active_sites) turns a list of sites into whatever PAIRWISE consumes (default: the list itself)
+    - pairwise(features_a, features_b, symmetric) returns the NxM block of scores; SYMMETRIC tells it both lists
+      are the same, so that it may compute only the upper triangle
+    - compare(a1, a2) returns the score of a single pair
+
+    Matrix builders use PAIRWISE when there is one, and fall back to calling COMPARE on every pair. Metrics that
+    are a power of the Euclidean distance between vectors may also provide an EMBEDDING, so that nearest
+    neighbors can be found with a spatial index (see index.SiteIndex) instead of a full matrix. Expensive metrics
+    may provide a cheap LOWER_BOUND on their scores, which lets searches skip most sites (see query.SiteSearch).
+    """
+
+    def __init__(self, name, compare=None, pairwise=None, featurize=None, features=(), symmetric=True,
+                 coordinates=True, tile_size=64, embedding=None, embedding_power=1, lower_bound=None,
+                 bound_featurize=None):
+        """
+        :param name: str, name the metric is registered under
+        :param compare: function (ActiveSite, ActiveSite) -> float
+        :param pairwise: function (features_a, features_b, symmetric) -> np.array
+        :param featurize: function list of ActiveSite -> features, for PAIRWISE
+        :param features: names of the per-site features (see get_feature) the metric reads, computed up front
+        :param symmetric: bool, compare(a1, a2) == compare(a2, a1), so matrix builders only compute one triangle
+        :param coordinates: bool, the scores depend on atomic coordinates (and not only on residues)
+        :param tile_size: int, smallest tile worth handing to PAIRWISE when building a large matrix
+        :param embedding: function list of ActiveSite -> NxD np.array, such that the score of two sites is the
+                          Euclidean distance between their vectors to the power EMBEDDING_POWER
+        :param embedding_power: float, see EMBEDDING
+        :param lower_bound: function (bound_features_a, bound_features_b) -> length N np.array, lower bounds on the
+                            scores of N pairs of sites, given the bound features of both sites of every pair
+        :param bound_featurize: function list of ActiveSite -> bound features, for LOWER_BOUND
+        """
+
+        if compare is None and pairwise is None:
+            raise ValueError("Metric %s needs a compare or a pairwise function." % name)
+
+        self.name = name
+        self.compare = compare if compare is not None else self._compare_pairwise
+        self.pairwise = pairwise
+        self.featurize = featurize if featurize is not None else list
+        self.features = list(features)
+        self.symmetric = symmetric
+        self.coordinates = coordinates
+        self.tile_size = tile_size
+        self.embedding = embedding
+        self.embedding_power = embedding_power
+        self.lower_bound = lower_bound
+        self.bound_featurize = bound_featurize
+
+    def _compare_pairwise(self, a1, a2):
+        return self.pairwise(self.featurize([a1]), self.featurize([a2]), False)[0, 0]
+
+    def block(self, sites_a, sites_b, symmetric=False, features_b=None):
+        """
+        Scores every site of SITES_A against every site of SITES_B through the fastest hook available.
+
+        :param sites_a: List of ActiveSite objects of length N
+        :param sites_b: List of ActiveSite objects of length M
+        :param symmetric: bool, SITES_A and SITES_B are the same list
+        :param features_b: SITES_B already featurized (with FEATURIZE, and their per-site features cached), to be
+                           reused across calls; None to featurize them here
+        :return: np.array, NxM matrix of scores
+        """
+
+        symmetric = symmetric and self.symmetric
+
+        self.precompute(sites_a)
+        if sites_b is not sites_a and features_b is None:
+            self.precompute(sites_b)
+
+        if self.pairwise is not None:
+            features_a = self.featurize(sites_a)
+            if symmetric:
+                features_b = features_a
+            elif features_b is None:
+                features_b = self.featurize(sites_b)
+            return np.asarray(self.pairwise(features_a, features_b, symmetric), dtype=float)
+
+        block = np.zeros((len(sites_a), len(sites_b)))
+
+        for i in range(len(sites_a)):
+            for j in range(i + 1 if symmetric else 0, len(sites_b)):
+                if sites_a[i] is not sites_b[j]:
+                    block[i, j] = self.compare(sites_a[i], sites_b[j])
+
+        if symmetric:
+            block += block.T
+
+        return block
+
+    def precompute(self, active_sites):
+        """
+        Caches the per-site features of the metric on every site.
+        """
+
+        for name in self.features:
+            for a in active_sites:
+                get_feature(a, name)
+
+
+def register_metric(metric):
+    """
+    Makes METRIC available by name to SimilarityComparator and to every similarity matrix builder.
+
+    :param metric: Metric object
+    :return: Metric, the registered metric
+    """
+
+    METRICS[metric.name] = metric
+    return metric
+
+
+def get_metric(name):
+    """
+    :param name: str, name of a registered metric
+    :return: Metric object
+    """
+
+    if name not in METRICS:
+        raise ValueError("Similarity method not recognized.")
+
+    return METRICS[name]
+
 
 class SimilarityComparator:
     """
@@ -19,6 +194,16 @@ class SimilarityComparator:
 
         self.method = method
 
+    def precompute(self, active_sites):
+        """
+        Caches the features SELF.METHOD compares on every site, so that comparing a pair only combines them.
+
+        :param active_sites: list of ActiveSite objects
+        :return: None
+        """
+
+        get_metric(self.method).precompute(active_sites)
+
     def compare(self, a1, a2):
         """
         Compares two active sites according to SELF.METHOD.
@@ -28,81 +213,58 @@ class SimilarityComparator:
         :return: float, degree of similarity between a1 and a2
         """
 
-        if self.method == "RMSD":
-
-            return self.RMSD(a1, a2)
+        return get_metric(self.method).compare(a1, a2)
 
-        elif self.method == "hydrophobicity":
-            return self.score_hydrophobicity(a1, a2)
-
-        raise ValueError("Similarity method not recognized.")
-
-    # MUST FIX
     def TM(self, a1, a2):
         """
         Performs an iterative structural mapping algorithm to find the best scoring alignment, which will be used
         to calculate the similarity score between active sites. Adapted from MaxCluster protein structure comparison
-        tool (http://www.sbg.bio.ic.ac.uk/maxcluster/index.html)
+        tool (http://www.sbg.bio.ic.ac.uk/maxcluster/index.html): every ungapped alignment of the shorter site
+        against the longer one is superimposed, refined on its core of well-aligned residues and TM-scored (see
+        superposition_block).
 
         :param a1: ActiveSite object 1
         :param a2: ActiveSite object 2
-        :return: returns a optimized sequence independent alignment score
+        :return: float, 1 - the best TM-score of any alignment of a1 and a2, in [0, 1]
         """
-        r1 = a1.getResidues()
-        r2 = a2.getResidues()
 
-        N = min(len(r1), len(r2))
+        return superposition_block([a1], [a2], "TM")[0, 0]
 
-        distmat = np.zeros((len(r1), len(r2)))
-
-        for i in range(len(r1)):
-            for j in range(len(r2)):
+    def superposed_RMSD(self, a1, a2):
+        """
+        RMSD of the backbone atoms after optimal superposition, minimized over every ungapped alignment of the
+        shorter site against the longer one. Unlike RMSD, it does not depend on where each site sits in its frame.
 
-                dij = r1[i].rmsd(r2[j])
-                distmat[i, j]= dij
+        :param a1: ActiveSite object 1
+        :param a2: ActiveSite object 2
+        :return: float, superposed RMSD between a1 and a2
+        """
 
-        print(distmat.shape)
+        return superposition_block([a1], [a2], "superposed_RMSD")[0, 0]
 
     def RMSD(self, a1, a2, _type="min"):
         """
-        Performs a naive RMSD search, and returns a single RMSD value (min, max, average, sum, or median). Will search over
-        all possible alignments, calculate total RMSD, and then return the _TYPE of RMSD specified.
+        Performs an exhaustive RMSD search, and returns a single RMSD value (min, max, average, sum, or median). Scores
+        all possible ungapped alignments at once with sliding_rmsd, and then returns the _TYPE of RMSD specified.
 
         :param a1: ActiveSite object 1
         :param a2: ActiveSite object 2
         :param _type: str, type of RMSD to return. Supported operations: "min", "max", "average", "median"
         :return: returns _type(RMSD) between a1 and a2
         """
-        r1 = a1.getResidues()
-        r2 = a2.getResidues()
+        b1 = get_feature(a1, "backbone")
+        b2 = get_feature(a2, "backbone")
 
-        if len(r1)  < len(r2):
-            _short = r1
-            _long = r2
+        if len(b1) < len(b2):
+            all_rmsds = sliding_rmsd(b1, b2)
         else:
-            _short = r2
-            _long = r1
-
-        N = len(_short)
-        M = len(_long)
-        all_rmsds = []
-
-        # We have M-N possible alignments
-        for i in range(M - N + 1):
-            curr_rmsd = 0.0
-
-            # Calculate RMSD for the current alignment
-            for j in range(N):
-                curr_rmsd += _short[j].rmsd(_long[i+j])
-
-            # Add current RMSD to set of alignment RMSDs
-            all_rmsds.append(curr_rmsd)
+            all_rmsds = sliding_rmsd(b2, b1)
 
         if _type == "min":
-            return min(all_rmsds)
+            return np.min(all_rmsds)
 
         elif _type == "max":
-            return max(all_rmsds)
+            return np.max(all_rmsds)
 
         elif _type == "average":
             return np.mean(all_rmsds)
@@ -127,19 +289,410 @@ class SimilarityComparator:
         """
 
         # Convert each active site sequence to a hydrophbocity score
+        h1 = get_feature(a1, "hydrophobicity")
+        h2 = get_feature(a2, "hydrophobicity")
 
-        h1 = 0.0
-        h2 = 0.0
+        return (h1 - h2)**2
+
+
+def sliding_rmsd(short, long):
+    """
+    Scores every ungapped alignment of a shorter site against a longer one in a single batched operation. The
+    score of an alignment is the sum over aligned residue pairs of Residue.rmsd.
 
-        r1 = a1.getResidues()
-        r2 = a2.getResidues()
+    :param short: np.array, (N, 3, 3) backbone coordinates of the shorter site
+    :param long: np.array, (M, 3, 3) backbone coordinates of the longer site, M >= N
+    :return: np.array, the M-N+1 alignment scores, ordered by offset into LONG
+    """
 
-        for r in r1:
-            h1 += HYDROPHOBICITY[r.type]
+    N = len(short)
+    M = len(long)
 
-        for r in r2:
-            h2 += HYDROPHOBICITY[r.type]
+    # (M-N+1, N) residue indices into LONG for each alignment
+    windows = np.arange(M - N + 1)[:, np.newaxis] + np.arange(N)[np.newaxis, :]
+    dists = euclideanDist(short[np.newaxis], long[windows])
 
-        return (h1 - h2)**2
+    return np.sum(np.sqrt(np.sum(dists, axis=-1) / short.shape[1]), axis=-1)
+
+
+def rmsd_block(sites_a, sites_b, symmetric=False, chunk_size=8192):
+    """
+    The RMSD comparison (minimum of sliding_rmsd) of every site of SITES_A with every site of SITES_B. Pairs of
+    the same shape are stacked and scored with sliding_rmsd-style batched operations of about CHUNK_SIZE
+    alignments each, which give exactly the scores of comparing them one at a time.
+
+    :param sites_a: List of ActiveSite objects of length N
+    :param sites_b: List of ActiveSite objects of length M
+    :param symmetric: bool, SITES_A and SITES_B are the same list, so only the upper triangle is computed
+    :param chunk_size: int, number of alignments scored per batch
+    :return: np.array, NxM matrix of scores
+    """
+
+    backbones_a = [get_feature(a, "backbone") for a in sites_a]
+    backbones_b = [get_feature(b, "backbone") for b in sites_b]
+
+    # group the pairs by the lengths of their shorter and longer sites
+    groups = {}
+    for i in range(len(sites_a)):
+        for j in range(i + 1 if symmetric else 0, len(sites_b)):
+            if sites_a[i] is sites_b[j]:
+                continue
+            b1, b2 = backbones_a[i], backbones_b[j]
+            key = (len(b1), len(b2)) if len(b1) < len(b2) else (len(b2), len(b1))
+            groups.setdefault(key, []).append((i, j))
+
+    block = np.zeros((len(sites_a), len(sites_b)))
+
+    for (N, M), group in groups.items():
+        windows = np.arange(M - N + 1)[:, np.newaxis] + np.arange(N)[np.newaxis, :]
+        n_pairs = max(1, chunk_size // len(windows))
+
+        for start in range(0, len(group), n_pairs):
+            pairs = group[start:start + n_pairs]
+            short = np.empty((len(pairs), N, 3, 3))
+            long = np.empty((len(pairs), M, 3, 3))
+            for p, (i, j) in enumerate(pairs):
+                b1, b2 = backbones_a[i], backbones_b[j]
+                short[p], long[p] = (b1, b2) if len(b1) < len(b2) else (b2, b1)
+
+            dists = euclideanDist(short[:, np.newaxis], long[:, windows])
+            scores = np.sum(np.sqrt(np.sum(dists, axis=-1) / 3), axis=-1)
+
+            rows, cols = zip(*pairs)
+            block[list(rows), list(cols)] = np.min(scores, axis=1)
+
+    if symmetric:
+        block += block.T
+
+    return block
+
+
+def rmsd_bound_features(active_sites):
+    """
+    Bound features of the RMSD comparison: the number of residues of every site, the centroid of its backbone
+    atoms, and the bounding box of the backbone centroids of its residues.
+
+    :param active_sites: list of ActiveSite objects of length N
+    :return: tuple, length N residue counts, Nx3 centroids, Nx3 box minima and Nx3 box maxima
+    """
+
+    centroids = [get_feature(a, "backbone_centroids") for a in active_sites]
+    empty = np.zeros((1, 3))
+
+    return (np.array([len(c) for c in centroids]),
+            np.array([np.mean(c, axis=0) if len(c) else empty[0] for c in centroids]).reshape(-1, 3),
+            np.array([np.min(c if len(c) else empty, axis=0) for c in centroids]).reshape(-1, 3),
+            np.array([np.max(c if len(c) else empty, axis=0) for c in centroids]).reshape(-1, 3))
+
+
+def rmsd_lower_bound(features_a, features_b):
+    """
+    Lower bound on the RMSD comparison of pairs of sites. A residue's term of sliding_rmsd is the square root of
+    the mean distance between its aligned atoms, which is at least the square root of the distance e between the
+    two residue centroids (triangle inequality). Summed over the N aligned residues, sum sqrt(e) >= sqrt(sum e)
+    by subadditivity of the square root, and
+    sum e >= N d by the triangle inequality, where d is the distance between the centroid of the shorter site
+    and that of the aligned window of the longer one. Every window centroid lies in the bounding box of the
+    residue centroids of the longer site, so sqrt(N d) with d the distance to that box is a lower bound.
+
+    :param features_a: tuple, rmsd_bound_features of the first sites of the pairs
+    :param features_b: tuple, rmsd_bound_features of the second sites of the pairs (broadcast against the first)
+    :return: np.array, lower bounds on the pairs' scores
+    """
+
+    n_a, c_a, lo_a, hi_a = features_a
+    n_b, c_b, lo_b, hi_b = features_b
+
+    def box_distance(point, lo, hi):
+        return np.sqrt(np.sum(np.maximum(np.maximum(lo - point, point - hi), 0)**2, axis=-1))
+
+    a_short = n_a < n_b
+    bound_a = np.sqrt(n_a * box_distance(c_a, lo_b, hi_b))
+    bound_b = np.sqrt(n_b * box_distance(c_b, lo_a, hi_a))
+
+    return np.where(a_short, bound_a, bound_b)
+
+
+def superposition_block(sites_a, sites_b, measure="TM", symmetric=False, chunk_size=8192):
+    """
+    Superposition scores between every site of SITES_A and every site of SITES_B. For each pair, every ungapped
+    alignment of the shorter site against the longer one is superimposed with kabsch, and the alignments of many
+    pairs are evaluated together in batches of about CHUNK_SIZE, padded to a common length.
+
+    "superposed_RMSD" scores an alignment by the RMSD of its backbone atoms after superposition on all of them, and
+    keeps the lowest. "TM" superimposes the alignment, then repeatedly re-superimposes it on its core of C-alpha
+    atoms closer than d0 + 3.5 (at least 3 residues), as in MaxCluster and TM-score. It keeps the highest
+    TM-score of any round and alignment, normalized by the length L of the shorter site with
+    d0 = 1.24 (L - 15)^(1/3) - 1.8 (at least 0.5), and returns 1 - TM as a distance.
+
+    :param sites_a: List of ActiveSite objects of length N
+    :param sites_b: List of ActiveSite objects of length M
+    :param measure: str, "TM" or "superposed_RMSD"
+    :param symmetric: bool, SITES_A and SITES_B are the same list, so only the upper triangle is computed
+    :param chunk_size: int, number of alignments scored per batch
+    :return: np.array, NxM matrix of distances
+    """
+
+    if measure not in ("TM", "superposed_RMSD"):
+        raise ValueError("Superposition measure not recognized.")
+
+    backbones_a = [get_feature(a, "backbone") for a in sites_a]
+    backbones_b = [get_feature(b, "backbone") for b in sites_b]
+
+    pairs = [(i, j) for i in range(len(sites_a)) for j in range(i + 1 if symmetric else 0, len(sites_b))
+             if sites_a[i] is not sites_b[j]]
+
+    # batch pairs of similar length together, so that little of each batch is padding
+    pairs.sort(key=lambda pair: min(len(backbones_a[pair[0]]), len(backbones_b[pair[1]])))
+
+    block = np.zeros((len(sites_a), len(sites_b)))
+
+    start = 0
+    while start < len(pairs):
+        # gather pairs until the batch holds CHUNK_SIZE alignments
+        stop = start
+        n_windows = 0
+        while stop < len(pairs) and (stop == start or n_windows < chunk_size):
+            i, j = pairs[stop]
+            n_windows += abs(len(backbones_a[i]) - len(backbones_b[j])) + 1
+            stop += 1
+
+        batch = []
+        for i, j in pairs[start:stop]:
+            b1, b2 = backbones_a[i], backbones_b[j]
+            batch.append((b1, b2) if len(b1) <= len(b2) else (b2, b1))
+
+        scores = _superposition_scores(batch, measure)
+        for (i, j), score in zip(pairs[start:stop], scores):
+            block[i, j] = score
+
+        start = stop
+
+    if symmetric:
+        block += block.T
+
+    return block
+
+
+def _superposition_scores(batch, measure):
+    """
+    :param batch: list of (short, long) pairs of (N, 3, 3) and (M, 3, 3) backbone arrays, N <= M
+    :param measure: str, "TM" or "superposed_RMSD"
+    :return: np.array, the score of every pair (see superposition_block)
+    """
+
+    lengths = np.array([len(short) for short, _ in batch])
+    n_windows = np.array([len(long) - len(short) + 1 for short, long in batch])
+    L = max(lengths.max(), 1)
+    W = n_windows.sum()
+
+    # every alignment of every pair, padded to L residues
+    X = np.zeros((W, L, 3, 3))
+    Y = np.zeros((W, L, 3, 3))
+    mask = np.zeros((W, L), dtype=bool)
+
+    w = 0
+    for (short, long), N, n in zip(batch, lengths, n_windows):
+        windows = np.arange(n)[:, np.newaxis] + np.arange(N)[np.newaxis, :]
+        X[w:w + n, :N] = short
+        Y[w:w + n, :N] = long[windows]
+        mask[w:w + n, :N] = True
+        w += n
+
+    first_window = np.concatenate([[0], np.cumsum(n_windows)[:-1]])
+    weights = np.repeat(mask, 3, axis=1).astype(float)
+    X_atoms = X.reshape(W, 3 * L, 3)
+    Y_atoms = Y.reshape(W, 3 * L, 3)
+
+    superposed = kabsch(X_atoms, Y_atoms, weights)
+
+    if measure == "superposed_RMSD":
+        sq = np.sum((superposed - Y_atoms)**2, axis=-1)
+        rmsd = np.sqrt(np.sum(weights * sq, axis=1) / np.maximum(np.sum(weights, axis=1), 1))
+        return np.minimum.reduceat(rmsd, first_window)
+
+    N = np.repeat(lengths, n_windows)
+    d0 = np.maximum(1.24 * np.cbrt(np.maximum(N - 15, 0)) - 1.8, 0.5)[:, np.newaxis]
+    cutoff = d0 + 3.5
+
+    best = np.zeros(W)
+    previous = mask
+    for it in range(TM_ITERATIONS + 1):
+        d = np.sqrt(np.sum((superposed.reshape(W, L, 3, 3)[:, :, 1] - Y[:, :, 1])**2, axis=-1))
+        tm = np.sum(mask / (1 + (d / d0)**2), axis=1) / N
+        best = np.maximum(best, tm)
+
+        if it == TM_ITERATIONS:
+            break
+
+        # re-superimpose every alignment on its core, or on all of it if the core is too small
+        core = mask & (d < cutoff)
+        small = np.sum(core, axis=1) < 3
+        core[small] = mask[small]
+
+        # alignments whose core did not change have converged
+        changed = np.any(core != previous, axis=1)
+        if not np.any(changed):
+            break
+
+        superposed[changed] = kabsch(X_atoms[changed], Y_atoms[changed],
+                                     np.repeat(core[changed], 3, axis=1).astype(float))
+        previous = core
+
+    return 1 - np.maximum.reduceat(best, first_window)
+
+
+def kabsch(P, Q, weights=None):
+    """
+    Optimal (least squares) rigid superposition of every point set of P onto the matching point set of Q, by the
+    Kabsch algorithm, batched over the leading axis.
+
+    :param P: np.array, (B, n, 3) point sets to move
+    :param Q: np.array, (B, n, 3) target point sets
+    :param weights: np.array, (B, n) weight of every point in the fit (default: all 1)
+    :return: np.array, (B, n, 3) the points of P after superposition
+    """
+
+    if weights is None:
+        weights = np.ones(P.shape[:2])
+
+    w = weights[:, np.newaxis, :]
+    total = np.maximum(np.sum(w, axis=2, keepdims=True), 1e-12)
+    p_center = np.matmul(w, P) / total
+    q_center = np.matmul(w, Q) / total
+    P_c = P - p_center
+    Q_c = Q - q_center
+
+    # weighted covariance of the centered point sets
+    H = np.matmul(P_c.transpose(0, 2, 1) * w, Q_c)
+    U, S, Vt = np.linalg.svd(H)
+
+    # flip the axis of the smallest singular value where needed, so that R is a proper rotation
+    sign = np.sign(np.linalg.det(np.matmul(U, Vt)))
+    sign[sign == 0] = 1
+    U[:, :, 2] *= sign[:, np.newaxis]
+
+    R = np.matmul(U, Vt)
+
+    return np.matmul(P_c, R) + q_center
+
+
+@feature("hydrophobicity", coordinates=False)
+def site_hydrophobicity(active_site):
+    """
+    Total hydrophobicity of the residues of an active site.
+
+    :param active_site: ActiveSite object
+    :return: float, sum of HYDROPHOBICITY over the residues of active_site (0 for residues not in the table)
+    """
+
+    h = 0.0
+    for r in active_site.getResidues():
+        h += HYDROPHOBICITY.get(r.type, 0.0)
+
+    return h
+
+
+def hydrophobicity_vector(active_sites):
+    """
+    Featurizes a list of active sites by their total hydrophobicity, so that the hydrophobicity similarity
+    of every pair can be computed at once.
+
+    :param active_sites: list of ActiveSite objects of length N
+    :return: np.array, length N vector of site hydrophobicities
+    """
+
+    return np.array([get_feature(a, "hydrophobicity") for a in active_sites], dtype=float)
+
+
+@feature("backbone")
+def site_backbone(active_site):
+    """
+    :param active_site: ActiveSite object
+    :return: np.array, (R, 3, 3) backbone coordinates of every residue
+    """
+
+    return active_site.getBackboneCoords()
+
+
+@feature("backbone_centroids")
+def site_backbone_centroids(active_site):
+    """
+    :param active_site: ActiveSite object
+    :return: np.array, (R, 3) centroid of the backbone atoms of every residue
+    """
+
+    return np.mean(get_feature(active_site, "backbone"), axis=1)
+
+
+@feature("composition", coordinates=False)
+def site_composition(active_site):
+    """
+    :param active_site: ActiveSite object
+    :return: np.array, number of residues of each type in AMINO_ACIDS
+    """
+
+    counts = np.zeros(len(AMINO_ACIDS))
+    for r in active_site.getResidues():
+        if r.type in HYDROPHOBICITY:
+            counts[AMINO_ACIDS.index(r.type)] += 1
+
+    return counts
+
+
+@feature("centroid")
+def site_centroid(active_site):
+    """
+    :param active_site: ActiveSite object
+    :return: np.array, mean position of the atoms of the site
+    """
+
+    return np.mean(active_site.coords, axis=0)
+
+
+def composition_matrix(active_sites):
+    """
+    Featurizes a list of active sites by their residue composition.
+
+    :param active_sites: list of ActiveSite objects of length N
+    :return: np.array, Nx20 fraction of the residues of each site of each type in AMINO_ACIDS
+    """
+
+    counts = np.array([get_feature(a, "composition") for a in active_sites], dtype=float).reshape(-1, len(AMINO_ACIDS))
+
+    return counts / np.maximum(np.sum(counts, axis=1, keepdims=True), 1)
+
+
+def _hydrophobicity_embedding(active_sites):
+    return hydrophobicity_vector(active_sites)[:, np.newaxis]
+
+
+def _squared_difference(h_a, h_b, symmetric=False):
+    return (h_a[:, np.newaxis] - h_b[np.newaxis, :])**2
+
+
+def _euclidean_distances(X_a, X_b, symmetric=False):
+    return cdist(X_a, X_b)
+
+
+def _rmsd(a1, a2):
+    return SimilarityComparator("RMSD").RMSD(a1, a2)
+
+
+def _tm_block(sites_a, sites_b, symmetric=False):
+    return superposition_block(sites_a, sites_b, "TM", symmetric)
+
+
+def _superposed_rmsd_block(sites_a, sites_b, symmetric=False):
+    return superposition_block(sites_a, sites_b, "superposed_RMSD", symmetric)
 
 
+register_metric(Metric("RMSD", compare=_rmsd, pairwise=rmsd_block, features=["backbone"], tile_size=256,
+                       lower_bound=rmsd_lower_bound, bound_featurize=rmsd_bound_features))
+register_metric(Metric("hydrophobicity", pairwise=_squared_difference, featurize=hydrophobicity_vector,
+                       features=["hydrophobicity"], coordinates=False, tile_size=2048,
+                       embedding=_hydrophobicity_embedding, embedding_power=2))
+register_metric(Metric("composition", pairwise=_euclidean_distances, featurize=composition_matrix,
+                       features=["composition"], coordinates=False, tile_size=2048, embedding=composition_matrix))
+register_metric(Metric("TM", pairwise=_tm_block, features=["backbone"], tile_size=256))
+register_metric(Metric("superposed_RMSD", pairwise=_superposed_rmsd_block, features=["backbone"], tile_size=256))
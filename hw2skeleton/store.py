@@ -0,0 +1,161 @@
+import json
+import numpy as np
+from .utils import ActiveSite
+
+# A site store is a single binary file holding every parsed active site of a library:
+#
+#   MAGIC | uint64 header length | JSON header | arrays, each starting on an ALIGNMENT byte boundary
+#
+# The header records the dtype, shape and file offset of every array, so the whole store can be memory-mapped and
+# each array viewed in place without reading or parsing anything.
+MAGIC = b"HW2SITES"
+STORE_VERSION = 2
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_site_store(filename, active_sites):
+    """
+    Packs parsed active sites into a single binary store.
+
+    :param filename: str, path of the store
+    :param active_sites: list of ActiveSite objects
+    :return: None
+    """
+
+    site_offsets = [0]
+    residue_types = []
+    residue_numbers = []
+    residue_chains = []
+    residue_insertions = []
+    residue_offsets = [0]
+    atom_types = []
+    coords = []
+
+    for site in active_sites:
+        if not site.is_packed():
+            site.pack()
+
+        residue_types.extend(r.type for r in site.residues)
+        residue_numbers.extend(r.number for r in site.residues)
+        residue_chains.extend(r.chain for r in site.residues)
+        residue_insertions.extend(r.insertion for r in site.residues)
+        residue_offsets.extend(residue_offsets[-1] + np.asarray(site.residue_offsets[1:]))
+        site_offsets.append(len(residue_types))
+        atom_types.extend(site.atom_types)
+        coords.append(np.asarray(site.coords, dtype=np.float64))
+
+    arrays = {"names": np.array([site.name for site in active_sites], dtype=str),
+              "site_offsets": np.array(site_offsets, dtype=np.int64),
+              "residue_types": np.array(residue_types, dtype=str),
+              "residue_numbers": np.array(residue_numbers, dtype=np.int64),
+              "residue_chains": np.array(residue_chains, dtype="U1"),
+              "residue_insertions": np.array(residue_insertions, dtype="U1"),
+              "residue_offsets": np.array(residue_offsets, dtype=np.int64),
+              "atom_types": np.array(atom_types, dtype=str),
+              "coords": np.concatenate(coords) if coords else np.zeros((0, 3))}
+
+    # the header is written with placeholder offsets first, so that its length (and with it the array offsets) is known
+    layout = {name: {"dtype": a.dtype.str, "shape": list(a.shape), "offset": 0} for name, a in arrays.items()}
+    header = {"version": STORE_VERSION, "arrays": layout}
+    start = len(MAGIC) + 8 + len(json.dumps(header).encode()) + 32 * len(arrays)
+
+    offset = _align(start)
+    for name, a in arrays.items():
+        layout[name]["offset"] = offset
+        offset = _align(offset + a.nbytes)
+
+    encoded = json.dumps(header).encode().ljust(_align(start) - len(MAGIC) - 8)
+
+    with open(filename, "wb") as out:
+        out.write(MAGIC)
+        out.write(np.uint64(len(encoded)).tobytes())
+        out.write(encoded)
+        for name, a in arrays.items():
+            out.seek(layout[name]["offset"])
+            out.write(np.ascontiguousarray(a).tobytes())
+        out.truncate(offset)
+
+
+class SiteStore:
+    """
+    A memory-mapped site store. Opening one only reads its header; active sites are built on access, with their
+    coordinates viewing the mapped file, so processes opening the same store share its pages.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: str, path of a store written by write_site_store
+        """
+
+        self.filename = filename
+
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not a site store" % filename)
+            length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(length).decode())
+
+        if header["version"] != STORE_VERSION:
+            raise IOError("%s has site store version %d, expected %d" % (filename, header["version"], STORE_VERSION))
+
+        # copy-on-write, so sites can be modified in memory without touching the store
+        self._mmap = np.memmap(filename, dtype=np.uint8, mode="c")
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"]))
+            view = self._mmap[spec["offset"]:spec["offset"] + count * dtype.itemsize].view(dtype)
+            setattr(self, name, view.reshape(spec["shape"]))
+
+        self._index = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        """
+        :param i: int or str, position or name of an active site
+        :return: ActiveSite
+        """
+
+        if isinstance(i, str):
+            i = self.index(i)
+        elif i < 0:
+            i += len(self)
+
+        r0, r1 = self.site_offsets[i:i + 2]
+        offsets = self.residue_offsets[r0:r1 + 1]
+        a0, a1 = offsets[0], offsets[-1]
+
+        return ActiveSite.from_arrays(str(self.names[i]), self.residue_types[r0:r1], self.residue_numbers[r0:r1],
+                                     offsets - a0, self.atom_types[a0:a1], self.coords[a0:a1],
+                                     residue_chains=self.residue_chains[r0:r1],
+                                     residue_insertions=self.residue_insertions[r0:r1])
+
+    def index(self, name):
+        """
+        :param name: str, name of an active site
+        :return: int, its position in the store
+        """
+
+        if self._index is None:
+            self._index = {str(n): i for i, n in enumerate(self.names)}
+
+        if name not in self._index:
+            raise KeyError(name)
+
+        return self._index[name]
+
+    def sites(self):
+        """
+        :return: list, every active site of the store
+        """
+
+        return list(self)
@@ -1,16 +1,77 @@
 # Some utility classes to represent a PDB structure
+from collections import OrderedDict
 import numpy as np
 
 BACKBONE = [0,1,2,]
 
+# Lazily loaded sites currently holding their coordinates, least recently used first, and the most of them allowed to
+# at once (None for no limit)
+_resident_sites = OrderedDict()
+_coordinate_cache_size = None
+
+# Names of the per-site features that do not depend on coordinates, and so survive eviction (see similarity.feature)
+COORDINATE_FREE_FEATURES = set()
+
+
+def set_coordinate_cache_size(size):
+    """
+    Caps how many lazily loaded active sites keep their coordinates in memory. Once more sites than that have loaded
+    coordinates, the least recently used ones drop theirs, to be reloaded on their next use. Eviction discards the
+    array, so coordinates of a lazy site edited in place are lost once it is evicted; assign ActiveSite.coords to
+    keep edited coordinates (which detaches the site from its loader).
+
+    :param size: int, maximum number of sites with resident coordinates, or None for no limit
+    :return: None
+    """
+
+    global _coordinate_cache_size
+    _coordinate_cache_size = size
+
+    if size is None:
+        _resident_sites.clear()
+    else:
+        _evict_coordinates()
+
+
+def _evict_coordinates():
+    if _coordinate_cache_size is None:
+        return
+
+    while len(_resident_sites) > _coordinate_cache_size:
+        site, _ = _resident_sites.popitem(last=False)
+        site._coords = None
+        for name in [name for name in site.features if name not in COORDINATE_FREE_FEATURES]:
+            del site.features[name]
+
+
 class Atom:
     """
-    A simple class for an amino acid residue
+    A simple class for an atom. An atom either holds its own coordinates, or is a lightweight view onto one
+    row of the coordinate array of the ActiveSite it belongs to.
     """
 
-    def __init__(self, type):
+    __slots__ = ("type", "_coords", "_site", "_index")
+
+    def __init__(self, type, site=None, index=None):
         self.type = type
-        self.coords = (0.0, 0.0, 0.0)
+        self._site = site
+        self._index = index
+        self._coords = (0.0, 0.0, 0.0) if site is None else None
+
+    @property
+    def coords(self):
+        if self._site is None:
+            return self._coords
+
+        return tuple(self._site.coords[self._index].tolist())
+
+    @coords.setter
+    def coords(self, value):
+        if self._site is None:
+            self._coords = tuple(value)
+        else:
+            self._site.coords[self._index] = value
+            self._site.features.clear()
 
     # Overload the __repr__ operator to make printing simpler.
     def __repr__(self):
@@ -19,13 +80,28 @@ class Atom:
 
 class Residue:
     """
-    A simple class for an amino acid residue
+    A simple class for an amino acid residue. Once its ActiveSite has been packed, a residue is a view onto
+    a slice of the site's coordinate array and its atoms are created on demand.
     """
 
-    def __init__(self, type, number):
+    __slots__ = ("type", "number", "chain", "insertion", "_atoms", "_site", "_index")
+
+    def __init__(self, type, number, site=None, index=None, chain=" ", insertion=" "):
         self.type = type
         self.number = number
-        self.atoms = []
+        self.chain = chain
+        self.insertion = insertion
+        self._site = site
+        self._index = index
+        self._atoms = [] if site is None else None
+
+    @property
+    def atoms(self):
+        if self._site is None:
+            return self._atoms
+
+        start, stop = self._site.residue_offsets[self._index:self._index + 2]
+        return [Atom(str(self._site.atom_types[k]), self._site, k) for k in range(start, stop)]
 
     # Overload the __repr__ operator to make printing simpler.
     def __repr__(self):
@@ -33,28 +109,168 @@ class Residue:
         #return "{0} {1}".format(self.type, self.number)
 
     def getCoords(self):
-        return [a.coords for a in self.atoms]
+        if self._site is None:
+            return np.array([a.coords for a in self.atoms], dtype=float)
+
+        start, stop = self._site.residue_offsets[self._index:self._index + 2]
+        return self._site.coords[start:stop]
 
     def getBackboneCoords(self):
+        if self._site is None:
+            atoms = self.atoms
+            return np.array([atoms[min(i, len(atoms) - 1)].coords for i in BACKBONE], dtype=float)
 
-        return [self.atoms[i].coords for i in BACKBONE]
+        return self._site.coords[self._site.backbone[self._index]]
 
     def rmsd(self, r2):
         c1 = self.getBackboneCoords()
         c2 = r2.getBackboneCoords()
-        dist_vec = np.array([euclideanDist(np.array(c1[i]), np.array(c2[i])) for i in range(len(c1))])
+        dist_vec = euclideanDist(c1, c2)
         rmsd = np.sum(dist_vec) / len(c2)
         return np.sqrt(rmsd)
 
 
 class ActiveSite:
     """
-    A simple class for an active site
+    A simple class for an active site. A packed site owns one contiguous (n_atoms, 3) coordinate array, along
+    with the atom types, the atom offset of every residue and the indices of every residue's backbone atoms.
+
+    A lazy site is packed without coordinates: they are loaded by its loader the first time they are used, and may
+    be dropped again (see set_coordinate_cache_size), discarding any in-place edits.
+
+    FEATURES caches quantities derived from the site by the similarity metrics (see similarity.get_feature). It is
+    cleared whenever the coordinates change.
     """
 
     def __init__(self, name):
         self.name = name
         self.residues = []
+        self.features = {}
+        self._coords = None
+        self._loader = None
+        self.atom_types = None
+        self.residue_offsets = None
+        self.backbone = None
+
+    @property
+    def coords(self):
+        if self._loader is None:
+            return self._coords
+
+        coords = self._coords
+        if coords is None:
+            coords = self._coords = self._loader()
+
+        # the site may evict its own coordinates here (with a cache size of 0), so the loaded array is returned
+        if _coordinate_cache_size is not None:
+            _resident_sites[self] = None
+            _resident_sites.move_to_end(self)
+            _evict_coordinates()
+
+        return coords
+
+    @coords.setter
+    def coords(self, value):
+        self._coords = value
+        self._loader = None
+        self.features = {}
+        _resident_sites.pop(self, None)
+
+    @classmethod
+    def lazy(cls, name, residue_types, residue_numbers, residue_offsets, atom_types, loader, residue_chains=None,
+             residue_insertions=None):
+        """
+        Builds a packed active site whose coordinates are only loaded when first used.
+
+        :param loader: callable, returns the (A, 3) coordinate array of the site
+        :return: lazy ActiveSite (see from_arrays for the other parameters)
+        """
+
+        site = cls.from_arrays(name, residue_types, residue_numbers, residue_offsets, atom_types,
+                               np.zeros((0, 3)), residue_chains=residue_chains, residue_insertions=residue_insertions)
+        site._coords = None
+        site._loader = loader
+
+        return site
+
+    @classmethod
+    def from_arrays(cls, name, residue_types, residue_numbers, residue_offsets, atom_types, coords,
+                    dtype=np.float64, residue_chains=None, residue_insertions=None):
+        """
+        Builds a packed active site directly from flat arrays.
+
+        :param name: str, name of the active site
+        :param residue_types: list, R residue types
+        :param residue_numbers: list, R residue numbers
+        :param residue_offsets: list, R+1 offsets of the first atom of every residue into ATOM_TYPES and COORDS
+        :param atom_types: list, A atom types
+        :param coords: array-like, (A, 3) atomic coordinates
+        :param dtype: floating point type of the coordinate array
+        :param residue_chains: list, R chain identifiers (default: blank)
+        :param residue_insertions: list, R insertion codes (default: blank)
+        :return: packed ActiveSite
+        """
+
+        site = cls(name)
+        site.coords = np.ascontiguousarray(coords, dtype=dtype).reshape(-1, 3)
+        site.atom_types = np.asarray(atom_types, dtype=str)
+        site.residue_offsets = np.asarray(residue_offsets, dtype=np.intp)
+
+        # residues with fewer atoms than the backbone (e.g. ions) repeat their last atom
+        sizes = np.diff(site.residue_offsets)
+        site.backbone = site.residue_offsets[:-1, np.newaxis] + \
+            np.minimum(np.array(BACKBONE, dtype=np.intp), sizes[:, np.newaxis] - 1)
+
+        R = len(residue_types)
+        chains = [" "] * R if residue_chains is None else residue_chains
+        insertions = [" "] * R if residue_insertions is None else residue_insertions
+        site.residues = [Residue(str(residue_types[r]), int(residue_numbers[r]), site, r, str(chains[r]),
+                                 str(insertions[r])) for r in range(R)]
+
+        return site
+
+    def pack(self, dtype=np.float64):
+        """
+        Moves the coordinates of all residues and atoms of this site into a single contiguous array. Residues and
+        atoms become views onto that array afterwards.
+        """
+
+        offsets = [0]
+        atom_types = []
+        coords = []
+        for r in self.residues:
+            for a in r.atoms:
+                atom_types.append(a.type)
+                coords.append(a.coords)
+            offsets.append(len(coords))
+
+        packed = ActiveSite.from_arrays(self.name, [r.type for r in self.residues], [r.number for r in self.residues],
+                                        offsets, atom_types, np.array(coords, dtype=dtype).reshape(-1, 3), dtype,
+                                        [r.chain for r in self.residues], [r.insertion for r in self.residues])
+
+        self.residues = packed.residues
+        self.coords = packed.coords
+        self.atom_types = packed.atom_types
+        self.residue_offsets = packed.residue_offsets
+        self.backbone = packed.backbone
+        for r in self.residues:
+            r._site = self
+
+        return self
+
+    def is_packed(self):
+        return self._coords is not None or self._loader is not None
+
+    def is_loaded(self):
+        return self._coords is not None
+
+    def __getstate__(self):
+        # lazy sites travel without their coordinates, and load them again on the other side
+        state = self.__dict__.copy()
+        if self._loader is not None:
+            state["_coords"] = None
+
+        return state
 
     # Overload the __repr__ operator to make printing simpler.
     def __repr__(self):
@@ -63,14 +279,21 @@ class ActiveSite:
     def getResidues(self):
         return self.residues
 
+    def getBackboneCoords(self):
+        """
+        :return: np.array, (R, 3, 3) backbone coordinates of every residue
+        """
+        if not self.is_packed():
+            self.pack()
+
+        return self.coords[self.backbone]
+
 def euclideanDist(c1, c2):
     """
 
     :param c1: list, set of atomic coordinates
     :param c2: list, second set of coordinates to compare to
-    :return: float, euclidean distance between c1 and c2
+    :return: float, euclidean distance between c1 and c2 (taken along the last axis for arrays of coordinates)
     """
 
-    return np.sqrt(np.sum( (c1 - c2)**2 ))
-
-
+    return np.sqrt(np.sum( (np.asarray(c1) - np.asarray(c2))**2, axis=-1))
@@ -0,0 +1,36 @@
+from hw2skeleton import cache
+from hw2skeleton import cluster
+from hw2skeleton import io
+import numpy as np
+import os
+
+
+def read_sites(pdb_ids):
+    return [io.read_active_site(os.path.join("data", "%i.pdb" % id)) for id in pdb_ids]
+
+
+def test_cached_similarity_matrix(tmpdir):
+    cache_dir = str(tmpdir)
+    active_sites = read_sites([276, 4629, 10701, 10814])
+
+    sim_matrix = cache.cached_similarity_matrix(active_sites, "RMSD", cache_dir=cache_dir)
+    assert np.array_equal(sim_matrix, cluster.create_similarity_matrix(active_sites, "RMSD"))
+
+    # a second request is served from the memory-mapped cache entry
+    cached = cache.cached_similarity_matrix(active_sites, "RMSD", cache_dir=cache_dir)
+    assert isinstance(cached, np.memmap)
+    assert np.array_equal(cached, sim_matrix)
+
+    # dropping a site and adding two only computes the new rows and columns
+    updated_sites = active_sites[1:] + read_sites([13052, 14181])
+    updated = cache.cached_similarity_matrix(updated_sites, "RMSD", cache_dir=cache_dir)
+    assert np.allclose(updated, cluster.create_similarity_matrix(updated_sites, "RMSD"))
+
+    assert len(os.listdir(os.path.join(cache_dir, "RMSD"))) == 4
+
+    # only the most recently used entries are kept
+    cache.cached_similarity_matrix(active_sites, "RMSD", cache_dir=cache_dir, max_entries=1)
+    assert len(os.listdir(os.path.join(cache_dir, "RMSD"))) == 4
+    newest = cache.cached_similarity_matrix(read_sites([276, 4629]), "RMSD", cache_dir=cache_dir, max_entries=1)
+    assert sorted(os.listdir(os.path.join(cache_dir, "RMSD"))) == \
+        sorted(os.path.basename(newest.filename)[:-4] + extension for extension in (".npy", ".json"))
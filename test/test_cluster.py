@@ -1,7 +1,13 @@
 from hw2skeleton import cluster
 from hw2skeleton import io
 from hw2skeleton import compare_clusters
+from hw2skeleton import similarity
+from hw2skeleton.condensed import CondensedMatrix
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import pdist, squareform
+import numpy as np
 import os
+import pytest
 
 
 def test_similarity():
@@ -23,7 +29,7 @@ def test_partition_clustering():
         filepath = os.path.join("data", "%i.pdb"%id)
         active_sites.append(io.read_active_site(filepath))
 
-    assert cluster.cluster_by_partitioning(active_sites) == [["276"], ["4629"], ["10701"]]
+    assert cluster.cluster_by_partitioning(active_sites) == [[0], [1], [2]]
 
     # check empty active sites doesn't crash
     assert cluster.cluster_by_partitioning(None) is None
@@ -65,3 +71,225 @@ def test_rand():
     c2 = [["10701", "10814"], ["276", "4629"], ["13052", "14181"]]
 
     assert compare_clusters.rand_index(c1, c2, active_sites) == 1
+
+
+def test_similarity_matrix():
+    pdb_ids = [276, 4629, 10701, 10814]
+
+    active_sites = []
+    for id in pdb_ids:
+        filepath = os.path.join("data", "%i.pdb" % id)
+        active_sites.append(io.read_active_site(filepath))
+
+    for comparator in ["hydrophobicity", "RMSD"]:
+        sim_matrix = cluster.create_similarity_matrix(active_sites, comparator)
+
+        assert sim_matrix.shape == (4, 4)
+        assert np.allclose(sim_matrix, sim_matrix.T)
+        assert np.allclose(np.diag(sim_matrix), 0.0)
+
+        for i in range(4):
+            for j in range(4):
+                if i != j:
+                    expected = cluster.compute_similarity(active_sites[i], active_sites[j], comparator)
+                    assert np.isclose(sim_matrix[i, j], expected)
+
+
+def test_sliding_rmsd():
+    pdb_ids = [276, 4629]
+
+    active_sites = []
+    for id in pdb_ids:
+        filepath = os.path.join("data", "%i.pdb" % id)
+        active_sites.append(io.read_active_site(filepath))
+
+    short, long = active_sites[0].residues, active_sites[1].residues
+    expected = [sum(short[j].rmsd(long[i + j]) for j in range(len(short)))
+                for i in range(len(long) - len(short) + 1)]
+
+    scores = similarity.sliding_rmsd(active_sites[0].getBackboneCoords(), active_sites[1].getBackboneCoords())
+    assert np.allclose(scores, expected)
+
+    comparator = similarity.SimilarityComparator("RMSD")
+    for _type, f in [("min", np.min), ("max", np.max), ("average", np.mean), ("median", np.median)]:
+        assert np.isclose(comparator.RMSD(active_sites[1], active_sites[0], _type=_type), f(expected))
+
+
+def test_parallel_similarity_matrix(monkeypatch):
+    pdb_ids = [276, 4629, 10701, 10814, 13052, 14181]
+
+    active_sites = []
+    for id in pdb_ids:
+        filepath = os.path.join("data", "%i.pdb" % id)
+        active_sites.append(io.read_active_site(filepath))
+
+    # count the process pools started
+    pools = []
+    pool = cluster.multiprocessing.Pool
+
+    def spy(*args, **kwargs):
+        pools.append(args)
+        return pool(*args, **kwargs)
+
+    monkeypatch.setattr(cluster.multiprocessing, "Pool", spy)
+
+    serial = cluster.create_similarity_matrix(active_sites, "RMSD")
+    tiled = cluster.create_similarity_matrix(active_sites, "RMSD", tile_size=4)
+    assert len(pools) == 0
+
+    parallel = cluster.create_similarity_matrix(active_sites, "RMSD", n_jobs=2, tile_size=4)
+    assert len(pools) == 1
+
+    # default tiles are split between the workers
+    default_tiles = cluster.create_similarity_matrix(active_sites, "RMSD", n_jobs=2)
+    assert len(pools) == 2
+
+    assert np.array_equal(serial, tiled)
+    assert np.array_equal(serial, parallel)
+    assert np.array_equal(serial, default_tiles)
+
+
+def test_update_similarity_matrix():
+    pdb_ids = [276, 4629, 10701, 10814, 13052, 14181]
+
+    active_sites = []
+    for id in pdb_ids:
+        filepath = os.path.join("data", "%i.pdb" % id)
+        active_sites.append(io.read_active_site(filepath))
+
+    old_sites = active_sites[:4]
+    sim_matrix = cluster.create_similarity_matrix(old_sites, "RMSD")
+
+    # remove 4629 and add 13052 and 14181
+    new_sites = [active_sites[0]] + active_sites[2:]
+    updated = cluster.update_similarity_matrix(sim_matrix, [a.name for a in old_sites], new_sites, "RMSD")
+
+    assert np.allclose(updated, cluster.create_similarity_matrix(new_sites, "RMSD"))
+
+    # the new rows can be split over worker processes, in tiles of the metric's tile size
+    similarity.register_metric(similarity.Metric("tiled_RMSD", pairwise=similarity.rmsd_block, features=["backbone"],
+                                                 tile_size=2))
+    try:
+        parallel = cluster.update_similarity_matrix(sim_matrix, [a.name for a in old_sites], new_sites, "tiled_RMSD",
+                                                    n_jobs=2)
+    finally:
+        del similarity.METRICS["tiled_RMSD"]
+    assert np.array_equal(parallel, updated)
+
+    # a matrix of another metric is not extended
+    with pytest.raises(ValueError):
+        cluster.update_similarity_matrix(sim_matrix, [a.name for a in old_sites], new_sites, "hydrophobicity",
+                                         stored_comparator="RMSD")
+
+
+@pytest.mark.parametrize("linkage", ["single", "complete", "average", "ward"])
+def test_linkage_tree(linkage):
+    points = np.random.RandomState(0).rand(40, 3)
+    distances = pdist(points)
+
+    tree = cluster.linkage_tree(squareform(distances), linkage)
+
+    assert np.allclose(tree, hierarchy.linkage(distances, linkage))
+
+    # condensed (and float32) matrices are agglomerated without expanding them to a square float64 copy
+    condensed = CondensedMatrix.from_square(squareform(distances), dtype=np.float32)
+    assert np.allclose(cluster.linkage_tree(condensed, linkage), tree, atol=1e-5)
+    assert np.array_equal(condensed.data, distances.astype(np.float32))
+
+    clusters = cluster.cluster_hierarchically(list(range(40)), squareform(distances), linkage, K=4)
+    labels = hierarchy.fcluster(hierarchy.linkage(distances, linkage), 4, "maxclust")
+    assert sorted(clusters) == sorted(sorted(np.where(labels == l)[0].tolist()) for l in set(labels))
+
+
+def test_cut_tree():
+    points = np.random.RandomState(1).rand(30, 2)
+    sim_matrix = squareform(pdist(points))
+    sites = list(range(30))
+
+    clusters, tree = cluster.cluster_hierarchically(sites, sim_matrix, "average", K=6, return_tree=True)
+
+    assert clusters == cluster.cut_tree(tree, 6)
+    for K in [1, 2, 5, 10, 30]:
+        assert cluster.cut_tree(tree, K) == cluster.cluster_hierarchically(sites, sim_matrix, "average", K=K)
+        assert len(cluster.cut_tree(tree, K)) == K
+
+    # a chain-shaped tree, every site merged into the cluster of all previous ones
+    N = 2000
+    chain = np.array([[0 if i == 0 else N + i - 1, i + 1, i, i + 2] for i in range(N - 1)], dtype=float)
+    assert cluster.cut_tree(chain, 2) == [list(range(N - 1)), [N - 1]]
+
+
+def test_voronoi_kmedoids():
+    # three well separated groups of points
+    points = np.concatenate([np.random.RandomState(2).rand(10, 2) + offset for offset in [0, 10, 20]])
+    sim_matrix = squareform(pdist(points))
+
+    labels, medoids = cluster.voronoi_kmedoids(sim_matrix, [3, 12, 27])
+
+    assert sorted(cluster.labels_to_clusters(labels, 3)) == [list(range(0, 10)), list(range(10, 20)),
+                                                            list(range(20, 30))]
+    assert np.array_equal(labels[medoids], [0, 1, 2])
+    assert np.array_equal(cluster.update_medoids(sim_matrix, labels, medoids), medoids)
+
+
+def test_fasterpam():
+    points = np.random.RandomState(3).rand(25, 2)
+    sim_matrix = squareform(pdist(points))
+
+    def cost(medoids):
+        return np.sum(np.min(sim_matrix[:, medoids], axis=1))
+
+    labels, medoids = cluster.fasterpam(sim_matrix, [0, 1, 2])
+    assert np.array_equal(labels, np.argmin(sim_matrix[:, medoids], axis=1))
+
+    # no single swap of a medoid with a non-medoid improves the clustering
+    for i in range(3):
+        for x in range(25):
+            if x not in medoids:
+                swapped = medoids.copy()
+                swapped[i] = x
+                assert cost(swapped) >= cost(medoids) - 1e-12
+
+
+@pytest.mark.parametrize("method", ["voronoi", "fasterpam", "clara", "clarans"])
+def test_partitioning_methods(method):
+    pdb_ids = [276, 4629, 10701, 10814, 13052, 14181, 15813, 17526]
+
+    active_sites = []
+    for id in pdb_ids:
+        filepath = os.path.join("data", "%i.pdb" % id)
+        active_sites.append(io.read_active_site(filepath))
+
+    np.random.seed(0)
+    clusters = cluster.cluster_by_partitioning(active_sites, K=3, method=method, metric="RMSD")
+
+    assert len(clusters) == 3
+    assert sorted(sum(clusters, [])) == list(range(8))
+
+
+def test_partitioning_restarts():
+    points = np.random.RandomState(4).rand(200, 2)
+    sim_matrix = squareform(pdist(points))
+    sites = list(range(200))
+
+    medoids = cluster.kmedoids_plusplus(sim_matrix, 8)
+    assert len(set(medoids)) == 8
+
+    np.random.seed(0)
+    serial, serial_cost = cluster.cluster_by_partitioning(sites, sim_matrix, K=8, init="k-medoids++", n_init=6,
+                                                          return_cost=True)
+    np.random.seed(0)
+    parallel, parallel_cost = cluster.cluster_by_partitioning(sites, sim_matrix, K=8, init="k-medoids++", n_init=6,
+                                                              n_jobs=2, return_cost=True)
+
+    assert serial == parallel
+    assert serial_cost == parallel_cost
+    assert serial_cost > 0
+
+    # restarts draw from their own generators: the global one only advances by the restart seeds
+    np.random.seed(1)
+    np.random.randint(2**31 - 1, size=3)
+    expected = np.random.rand()
+    np.random.seed(1)
+    cluster.cluster_by_partitioning(sites, sim_matrix, K=8, n_init=3)
+    assert np.random.rand() == expected
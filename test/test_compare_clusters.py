@@ -0,0 +1,86 @@
+from hw2skeleton import compare_clusters
+import itertools
+import numpy as np
+
+
+def brute_force_rand(labels_1, labels_2):
+    agree = 0
+    pairs = list(itertools.combinations(range(len(labels_1)), 2))
+    for i, j in pairs:
+        agree += (labels_1[i] == labels_1[j]) == (labels_2[i] == labels_2[j])
+
+    return agree / len(pairs)
+
+
+def test_rand_index_labels():
+    rng = np.random.RandomState(0)
+
+    for _ in range(5):
+        labels_1 = rng.randint(4, size=30)
+        labels_2 = rng.randint(3, size=30)
+
+        assert np.isclose(compare_clusters.rand_index(labels_1, labels_2), brute_force_rand(labels_1, labels_2))
+
+    # name lists and label arrays give the same answer
+    names = ["a", "b", "c", "d", "e", "f"]
+    c1 = [["a", "b"], ["c", "d"], ["e", "f"]]
+    c2 = [["a", "b", "c"], ["d", "e", "f"]]
+
+    assert compare_clusters.rand_index(c1, c2, names) == compare_clusters.rand_index([0, 0, 1, 1, 2, 2],
+                                                                                     [0, 0, 0, 1, 1, 1])
+    assert compare_clusters.rand_index(c1, c2) == brute_force_rand([0, 0, 1, 1, 2, 2], [0, 0, 0, 1, 1, 1])
+
+
+def test_adjusted_rand_index():
+    c1 = [0, 0, 0, 1, 1, 1]
+    c2 = [1, 1, 1, 0, 0, 0]
+
+    assert compare_clusters.adjusted_rand_index(c1, c2) == 1.0
+
+    # worked by hand: 2 pairs together in both, 1.2 expected by chance, 4.5 at most
+    assert np.isclose(compare_clusters.adjusted_rand_index([0, 0, 1, 1, 2, 2], [0, 0, 0, 1, 1, 1]),
+                      (2 - 1.2) / (4.5 - 1.2))
+
+
+def test_agreement_matrix():
+    rng = np.random.RandomState(1)
+    labels = rng.randint(4, size=(12, 40))
+    labels[5] = labels[4]
+
+    for measure, pairwise in [("rand", compare_clusters.rand_index), ("ari", compare_clusters.adjusted_rand_index)]:
+        agreement = compare_clusters.agreement_matrix(labels, measure, chunk_size=5)
+
+        assert np.allclose(agreement, agreement.T)
+        for i in range(12):
+            for j in range(12):
+                assert np.isclose(agreement[i, j], pairwise(labels[i], labels[j]))
+
+    nmi = compare_clusters.agreement_matrix(labels, "nmi", chunk_size=5)
+    assert np.allclose(np.diag(nmi), 1.0)
+    assert np.isclose(nmi[4, 5], 1.0)
+    assert np.all((nmi >= 0) & (nmi <= 1 + 1e-12))
+
+
+def test_compute_avg_rand():
+    class Site:
+        def __init__(self, name):
+            self.name = name
+
+    sites = [Site(n) for n in "abcdef"]
+    clusterings = [[["a", "b"], ["c", "d"], ["e", "f"]], [["a", "b", "c"], ["d", "e", "f"]],
+                   [["a"], ["b", "c", "d", "e", "f"]]]
+
+    expected = np.mean([compare_clusters.rand_index(c1, c2, sites)
+                        for c1 in clusterings for c2 in clusterings if c1 is not c2])
+    assert np.isclose(compare_clusters.compute_avg_rand(clusterings, sites), expected)
+
+
+def test_sum_of_distances():
+    sim_matrix = np.array([[0, 1, 2, 3],
+                           [1, 0, 4, 5],
+                           [2, 4, 0, 6],
+                           [3, 5, 6, 0]], dtype=float)
+
+    # both orders of each within-cluster pair, averaged over the clusters
+    assert compare_clusters.sum_of_distances([[0, 1], [2, 3]], sim_matrix) == (2 * 1 + 2 * 6) / 2
+    assert compare_clusters.sum_of_distances([[2], [0, 1, 3]], sim_matrix) == 2 * (1 + 3 + 5) / 2
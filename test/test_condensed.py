@@ -0,0 +1,50 @@
+from hw2skeleton import cluster
+from hw2skeleton import io
+from hw2skeleton.condensed import CondensedMatrix, condensed_index, square_index
+import numpy as np
+import os
+
+
+def test_condensed_index():
+    n = 7
+    rows, cols = np.triu_indices(n, 1)
+
+    assert np.array_equal(condensed_index(rows, cols, n), np.arange(len(rows)))
+    assert np.array_equal(condensed_index(cols, rows, n), np.arange(len(rows)))
+
+    i, j = square_index(np.arange(len(rows)), n)
+    assert np.array_equal(i, rows)
+    assert np.array_equal(j, cols)
+
+
+def test_condensed_matrix(tmpdir):
+    pdb_ids = [276, 4629, 10701, 10814, 13052, 14181]
+
+    active_sites = []
+    for id in pdb_ids:
+        filepath = os.path.join("data", "%i.pdb" % id)
+        active_sites.append(io.read_active_site(filepath))
+
+    square = cluster.create_similarity_matrix(active_sites, "RMSD")
+    store = cluster.create_similarity_matrix(active_sites, "RMSD", condensed=True, tile_size=4,
+                                             filename=str(tmpdir.join("rmsd.dat")))
+
+    assert isinstance(store.data, np.memmap)
+    assert np.array_equal(np.asarray(store), square)
+    assert np.array_equal(CondensedMatrix.from_square(square).data, store.data)
+
+    # indexing behaves like the square matrix
+    assert store[2, 4] == square[2, 4]
+    assert store[3, 3] == 0.0
+    assert np.array_equal(store[1], square[1])
+    assert np.array_equal(store[1, [0, 2, 5]], square[1, [0, 2, 5]])
+    assert np.array_equal(store[:, [0, 2]], square[:, [0, 2]])
+    assert np.array_equal(store[np.ix_([0, 4], [1, 2, 3])], square[np.ix_([0, 4], [1, 2, 3])])
+
+    hyd = cluster.create_similarity_matrix(active_sites, "hydrophobicity", condensed=True, dtype=np.float32)
+    assert hyd.dtype == np.float32
+    assert np.allclose(np.asarray(hyd), cluster.create_similarity_matrix(active_sites, "hydrophobicity"))
+
+    # clustering accepts the condensed store in place of the square matrix
+    assert cluster.cluster_hierarchically(active_sites, store, K=3) == cluster.cluster_hierarchically(active_sites,
+                                                                                                      square, K=3)
@@ -0,0 +1,90 @@
+from hw2skeleton import cluster
+from hw2skeleton import compare_clusters
+from hw2skeleton import index
+from hw2skeleton import io
+import numpy as np
+import pytest
+from scipy.sparse import csgraph
+
+
+@pytest.fixture(scope="module")
+def active_sites():
+    return io.read_active_sites("data")
+
+
+@pytest.mark.parametrize("metric", ["composition", "hydrophobicity"])
+def test_knn_graph(active_sites, metric):
+    sim_matrix = cluster.create_similarity_matrix(active_sites, metric)
+    graph = index.knn_graph(active_sites, k=5, metric=metric, connect=False)
+
+    assert (graph != graph.T).nnz == 0
+
+    # edges carry the similarities of the sites they join, and every site is linked to its 5 nearest neighbors
+    coo = graph.tocoo()
+    assert np.allclose(coo.data, sim_matrix[coo.row, coo.col])
+    for i in range(len(active_sites)):
+        row = graph.getrow(i)
+        nearest = np.sort(np.delete(sim_matrix[i], i))[:5]
+        assert np.allclose(np.sort(row.data)[:5], nearest)
+
+    # joining components leaves a single one
+    connected = index.knn_graph(active_sites, k=1, metric=metric)
+    assert csgraph.connected_components(connected, directed=False)[0] == 1
+
+
+def test_site_index_query(active_sites):
+    site_index = index.SiteIndex(active_sites, "composition")
+    sim_matrix = cluster.create_similarity_matrix(active_sites, "composition")
+
+    scores, neighbors = site_index.query(active_sites[:3], k=4)
+    assert scores.shape == neighbors.shape == (3, 4)
+    for i in range(3):
+        assert np.allclose(scores[i], np.sort(sim_matrix[i])[:4])
+        assert np.allclose(sim_matrix[i, neighbors[i]], scores[i])
+
+    with pytest.raises(ValueError):
+        index.SiteIndex(active_sites, "RMSD")
+
+
+def test_sparse_clustering(active_sites):
+    N = len(active_sites)
+    sim_matrix = cluster.create_similarity_matrix(active_sites, "composition")
+
+    # on the complete graph, sparse single linkage is dense single linkage
+    complete = index.knn_graph(active_sites, k=N - 1, metric="composition")
+    assert np.allclose(cluster.linkage_tree(complete)[:, 2], cluster.linkage_tree(sim_matrix)[:, 2])
+
+    # on a sparse graph, the merges are those of its minimum spanning forest
+    graph = index.knn_graph(active_sites, k=3, metric="composition", connect=False)
+    tree = cluster.linkage_tree(graph)
+    n_components = csgraph.connected_components(graph, directed=False)[0]
+    assert np.sum(np.isinf(tree[:, 2])) == n_components - 1
+    assert np.isclose(np.sum(tree[np.isfinite(tree[:, 2]), 2]), csgraph.minimum_spanning_tree(graph).sum())
+
+    clusters = cluster.cluster_hierarchically(active_sites, graph, K=n_components + 2)
+    assert sorted(i for c in clusters for i in c) == list(range(N))
+
+    with pytest.raises(ValueError):
+        cluster.linkage_tree(graph, "average")
+
+    # Euclidean metrics obey the triangle inequality, so on the complete graph path lengths are similarities, and
+    # every site ends up with one of its most similar medoids
+    labels, medoids = cluster.graph_kmedoids(complete, [3, 50, 100])
+    to_medoids = sim_matrix[:, medoids]
+    assert np.allclose(to_medoids[np.arange(N), labels], np.min(to_medoids, axis=1))
+    assert np.array_equal(labels[medoids], [0, 1, 2])
+
+    np.random.seed(0)
+    clusters = cluster.cluster_by_partitioning(active_sites, index.knn_graph(active_sites, k=5), K=4,
+                                               init="k-medoids++")
+    assert sorted(i for c in clusters for i in c) == list(range(N))
+
+
+def test_knn_graph_quality(active_sites):
+    graph = index.knn_graph(active_sites, k=5)
+    clusters = cluster.cluster_by_partitioning(active_sites, graph, K=4)
+
+    # only the similarities along the edges of the graph are summed
+    dense = graph.toarray()
+    assert np.isclose(compare_clusters.sum_of_distances(clusters, graph),
+                      compare_clusters.sum_of_distances(clusters, dense))
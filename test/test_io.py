@@ -1,6 +1,9 @@
 from hw2skeleton import io
+from hw2skeleton import utils
+import numpy as np
 import pytest
 import os
+import pickle
 
 @pytest.mark.parametrize("filename,names,numbers", [
     ("276.pdb", ["HIS", "HIS", "HIS", "HIS", "ASP"], [55, 57, 201, 230, 301]),
@@ -31,3 +34,154 @@ def test_atoms(filename, residue_number, atoms, xs, ys, zs):
 
     assert [atom.type for atom in residue.atoms] == atoms
     assert [atom.coords for atom in residue.atoms] == list(zip(xs, ys, zs))
+
+
+def test_packed_coords():
+    filepath = os.path.join("data", "276.pdb")
+
+    activesite = io.read_active_site(filepath)
+    n_atoms = sum(len(residue.atoms) for residue in activesite.residues)
+
+    assert activesite.coords.shape == (n_atoms, 3)
+    assert activesite.getBackboneCoords().shape == (len(activesite.residues), 3, 3)
+
+    # residues and atoms are views onto the packed coordinate array
+    residue = activesite.residues[1]
+    assert np.shares_memory(residue.getCoords(), activesite.coords)
+    assert [atom.coords for atom in residue.atoms] == [tuple(c) for c in residue.getCoords().tolist()]
+
+    # sites built by hand can be packed after the fact
+    site = utils.ActiveSite("manual")
+    for residue in activesite.residues:
+        r = utils.Residue(residue.type, residue.number)
+        for atom in residue.atoms:
+            a = utils.Atom(atom.type)
+            a.coords = atom.coords
+            r.atoms.append(a)
+        site.residues.append(r)
+
+    site.pack()
+    assert np.array_equal(site.coords, activesite.coords)
+    assert [r.type for r in site.residues] == [r.type for r in activesite.residues]
+
+
+def test_similarity_matrix_io(tmpdir):
+    filename = str(tmpdir.join("sim_matrix.npy"))
+    sim_matrix = np.arange(9, dtype=float).reshape(3, 3)
+
+    io.write_similarity_matrix(filename, sim_matrix, ["276", "4629", "10701"])
+    stored, names = io.read_similarity_matrix(filename)
+
+    assert np.array_equal(stored, sim_matrix)
+    assert names == ["276", "4629", "10701"]
+    assert io.read_similarity_matrix(filename, return_metric=True)[2] is None
+
+    # the metric that computed the matrix is stored alongside it
+    io.write_similarity_matrix(filename, sim_matrix, ["276", "4629", "10701"], "RMSD")
+    assert io.read_similarity_matrix(filename, return_metric=True)[2] == "RMSD"
+
+
+def test_parallel_read():
+    serial = io.read_active_sites("data")
+    streamed = list(io.iter_active_sites("data"))
+    parallel = io.read_active_sites("data", n_jobs=2)
+
+    assert len(serial) == 136
+    for a, b, c in zip(serial, streamed, parallel):
+        assert a.name == b.name == c.name
+        assert [r.number for r in a.residues] == [r.number for r in c.residues]
+        assert np.array_equal(a.coords, b.coords)
+        assert np.array_equal(a.coords, c.coords)
+        assert list(a.atom_types) == list(c.atom_types)
+
+
+def test_site_store(tmpdir):
+    filename = str(tmpdir.join("sites.store"))
+    active_sites = io.read_active_sites("data")
+
+    io.write_site_store(filename, active_sites)
+    store = io.read_site_store(filename)
+
+    assert len(store) == len(active_sites)
+    for site, stored in zip(active_sites, store):
+        assert stored.name == site.name
+        assert [(r.chain, r.type, r.number) for r in stored.residues] == [(r.chain, r.type, r.number) for r in site.residues]
+        assert list(stored.atom_types) == list(site.atom_types)
+        assert np.array_equal(stored.residue_offsets, site.residue_offsets)
+        assert np.array_equal(stored.coords, site.coords)
+
+    # sites can be looked up by name, view the mapped file and are copy-on-write
+    site = store["276"]
+    assert np.shares_memory(site.coords, store.coords)
+    site.residues[0].atoms[0].coords = (0.0, 0.0, 0.0)
+    assert io.read_site_store(filename)["276"].residues[0].atoms[0].coords == (42.050, 26.570, 22.707)
+
+    assert [a.name for a in io.read_active_sites(filename)] == [a.name for a in active_sites]
+
+
+def test_pdb_records(tmpdir):
+    def atom(record, serial, name, altloc, res, chain, number, icode, x):
+        return "%-6s%5d %-4s%1s%3s %1s%4d%1s   %8.3f%8.3f%8.3f  1.00  0.00\n" % (
+            record, serial, name, altloc, res, chain, number, icode, x, 0.0, 0.0)
+
+    lines = ["HEADER    HYDROLASE\n", "REMARK   2 RESOLUTION. 2.00 ANGSTROMS.\n", "MODEL        1\n",
+             atom("ATOM", 1, " N", " ", "HIS", "A", 1055, " ", 1.0),
+             atom("ATOM", 2, " CA", "A", "HIS", "A", 1055, " ", 2.0),
+             atom("ATOM", 3, " CA", "B", "HIS", "A", 1055, " ", 2.5),
+             atom("ATOM", 4, " C", " ", "HIS", "A", 1055, " ", 3.0),
+             "TER\n",
+             atom("ATOM", 5, " N", " ", "SER", "A", 1055, "A", 4.0),
+             atom("ATOM", 6, " CA", " ", "SER", "A", 1055, "A", 5.0),
+             atom("ATOM", 7, " C", " ", "SER", "A", 1055, "A", 6.0),
+             atom("HETATM", 8, " O", " ", "HOH", "A", 2001, " ", 7.0),
+             atom("HETATM", 9, "ZN", " ", " ZN", "B", 301, " ", 8.0),
+             "ENDMDL\n", "MODEL        2\n",
+             atom("ATOM", 1, " N", " ", "HIS", "A", 1055, " ", 9.0),
+             "ENDMDL\n", "END\n"]
+
+    filepath = str(tmpdir.join("records.pdb"))
+    with open(filepath, "w") as f:
+        f.writelines(lines)
+
+    activesite = io.read_active_site(filepath)
+
+    assert [(r.chain, r.type, r.number, r.insertion) for r in activesite.residues] == \
+        [("A", "HIS", 1055, " "), ("A", "SER", 1055, "A"), ("B", "ZN", 301, " ")]
+    assert list(activesite.atom_types) == ["N", "CA", "C", "N", "CA", "C", "ZN"]
+    assert activesite.coords[:, 0].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 8.0]
+
+    # a residue with fewer atoms than the backbone repeats its last atom
+    assert activesite.getBackboneCoords()[2, :, 0].tolist() == [8.0, 8.0, 8.0]
+
+
+def test_lazy_read():
+    filepath = os.path.join("data", "276.pdb")
+
+    activesite = io.read_active_site(filepath)
+    lazy = io.read_active_site(filepath, lazy=True)
+
+    # residues are read eagerly, coordinates on first use
+    assert [(r.type, r.number) for r in lazy.residues] == [(r.type, r.number) for r in activesite.residues]
+    assert list(lazy.atom_types) == list(activesite.atom_types)
+    assert lazy.is_packed() and not lazy.is_loaded()
+    assert np.array_equal(lazy.getBackboneCoords(), activesite.getBackboneCoords())
+    assert lazy.is_loaded()
+
+    # pickled lazy sites leave their coordinates behind
+    assert not pickle.loads(pickle.dumps(lazy)).is_loaded()
+
+    # only the most recently used sites keep their coordinates
+    sites = io.read_active_sites("data", lazy=True)
+    utils.set_coordinate_cache_size(2)
+    try:
+        for site in sites[:5]:
+            site.residues[0].getCoords()
+        assert [site.is_loaded() for site in sites[:5]] == [False, False, False, True, True]
+        assert np.array_equal(sites[0].coords, io.read_active_site(os.path.join("data", sites[0].name + ".pdb")).coords)
+
+        # with no coordinates resident at all, every use reloads them
+        utils.set_coordinate_cache_size(0)
+        assert np.array_equal(sites[1].coords, io.read_active_site(os.path.join("data", sites[1].name + ".pdb")).coords)
+        assert not sites[1].is_loaded()
+    finally:
+        utils.set_coordinate_cache_size(None)
@@ -0,0 +1,51 @@
+from hw2skeleton import metrics
+from hw2skeleton.condensed import CondensedMatrix
+from scipy.spatial.distance import pdist, squareform
+import numpy as np
+
+
+def brute_force_silhouette(labels, sim_matrix):
+    scores = []
+    for i in range(len(labels)):
+        own = [j for j in range(len(labels)) if labels[j] == labels[i] and j != i]
+        if len(own) == 0:
+            scores.append(0.0)
+            continue
+
+        a = np.mean(sim_matrix[i, own])
+        b = min(np.mean(sim_matrix[i, labels == k]) for k in set(labels) if k != labels[i])
+        scores.append((b - a) / max(a, b))
+
+    return np.mean(scores)
+
+
+def test_cluster_quality():
+    points = np.random.RandomState(0).rand(30, 2)
+    sim_matrix = squareform(pdist(points))
+    labels = np.random.RandomState(1).randint(4, size=30)
+    labels[7] = 4  # a singleton cluster
+
+    quality = metrics.cluster_quality(labels, sim_matrix)
+
+    ssd = sum(sim_matrix[i, j] for i in range(30) for j in range(i + 1, 30) if labels[i] == labels[j])
+    assert np.isclose(quality["ssd"], ssd)
+
+    medoids = metrics.find_medoids(labels, sim_matrix)
+    for k in range(5):
+        members = np.flatnonzero(labels == k)
+        costs = [np.sum(sim_matrix[m, members]) for m in members]
+        assert medoids[k] == members[np.argmin(costs)]
+    assert np.isclose(quality["medoid_cost"], sum(sim_matrix[i, medoids[labels[i]]] for i in range(30)))
+    assert np.isclose(metrics.medoid_cost(labels, sim_matrix, medoids), quality["medoid_cost"])
+
+    assert np.isclose(quality["silhouette"], brute_force_silhouette(labels, sim_matrix))
+
+    scatter = [np.mean(sim_matrix[labels == k, medoids[k]]) for k in range(5)]
+    db = np.mean([max((scatter[k] + scatter[l]) / sim_matrix[medoids[k], medoids[l]] for l in range(5) if l != k)
+                  for k in range(5)])
+    assert np.isclose(quality["davies_bouldin"], db)
+
+    # a condensed matrix, read a few rows at a time, gives the same scores
+    chunked = metrics.cluster_quality(labels, CondensedMatrix.from_square(sim_matrix), chunk_size=7)
+    for name in quality:
+        assert np.isclose(chunked[name], quality[name])
@@ -0,0 +1,70 @@
+from hw2skeleton import cluster
+from hw2skeleton import io
+from hw2skeleton.model import ClusterModel
+from hw2skeleton.store import SiteStore, write_site_store
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def active_sites():
+    return io.read_active_sites("data")
+
+
+def test_assign(active_sites):
+    sim_matrix = cluster.create_similarity_matrix(active_sites, "hydrophobicity")
+    clusters, medoids = cluster.cluster_by_partitioning(active_sites, sim_matrix, K=4, return_medoids=True)
+
+    assert len(medoids) == 4
+    for k, m in enumerate(medoids):
+        assert m in clusters[k]
+
+    model = ClusterModel.from_clustering(active_sites, clusters, medoids, "hydrophobicity")
+    assert model.clusters() == cluster.convert_indices_to_active_sites(clusters, active_sites)
+
+    # every site is placed with its most similar medoid, using only K similarities per site
+    labels, scores = model.predict(active_sites, active_sites)
+    assert np.array_equal(labels, np.argmin(sim_matrix[:, medoids], axis=1))
+    assert np.allclose(scores, np.min(sim_matrix[:, medoids], axis=1))
+
+    # new sites join the model, and known sites move to their predicted cluster
+    new_site = io.read_active_site("data/276.pdb")
+    new_site.name = "new"
+    model.assign([new_site, active_sites[0]])
+    assert len(model) == len(active_sites) + 1
+    assert model.labels[model.names.index("new")] == labels[[a.name for a in active_sites].index("276")]
+    assert model.labels[model.names.index(active_sites[0].name)] == labels[0]
+
+
+def test_assign_few_sites(active_sites):
+    # with no more sites than clusters, every site is its own cluster and medoid
+    sites = active_sites[:4]
+    clusters, medoids = cluster.cluster_by_partitioning(sites, K=5, return_medoids=True)
+    model = ClusterModel.from_clustering(sites, clusters, medoids)
+
+    assert model.medoids == [a.name for a in sites]
+    assert np.array_equal(model.predict(sites, sites)[0], np.arange(4))
+
+
+def test_cluster_model_io(active_sites, tmpdir):
+    clusters, medoids = cluster.cluster_by_partitioning(active_sites, K=3, return_medoids=True)
+    model = ClusterModel.from_clustering(active_sites, clusters, medoids, "hydrophobicity", library="sites.store")
+
+    filename = str(tmpdir.join("model.json"))
+    io.write_cluster_model(filename, model)
+    loaded = io.read_cluster_model(filename)
+
+    assert loaded.names == model.names
+    assert np.array_equal(loaded.labels, model.labels)
+    assert loaded.medoids == model.medoids
+    assert loaded.metric == "hydrophobicity"
+    assert loaded.library == "sites.store"
+
+    # medoids can be looked up by name in a site store
+    store_file = str(tmpdir.join("sites.store"))
+    write_site_store(store_file, active_sites)
+    assert np.array_equal(loaded.predict(active_sites, SiteStore(store_file))[0], model.predict(active_sites,
+                                                                                               active_sites)[0])
+
+    with pytest.raises(ValueError):
+        ClusterModel(model.names, model.labels, model.medoids).predict(active_sites)
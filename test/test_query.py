@@ -0,0 +1,69 @@
+from hw2skeleton import cluster
+from hw2skeleton import io
+from hw2skeleton import query
+from hw2skeleton import similarity
+from hw2skeleton.store import SiteStore, write_site_store
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def active_sites():
+    return io.read_active_sites("data")
+
+
+def test_rmsd_block(active_sites):
+    sites = active_sites[:20]
+    block = similarity.rmsd_block(sites, sites, symmetric=True)
+    comparator = similarity.SimilarityComparator()
+
+    for i in range(len(sites)):
+        for j in range(len(sites)):
+            assert block[i, j] == comparator.RMSD(sites[i], sites[j])
+
+    # scoring in small chunks gives the same block
+    assert np.array_equal(similarity.rmsd_block(sites, sites, symmetric=True, chunk_size=1), block)
+
+
+def test_rmsd_lower_bound(active_sites):
+    sim_matrix = cluster.create_similarity_matrix(active_sites, "RMSD")
+    features = similarity.rmsd_bound_features(active_sites)
+
+    for i in range(len(active_sites)):
+        bounds = similarity.rmsd_lower_bound(tuple(f[i:i + 1] for f in features), features)
+        assert np.all(bounds <= sim_matrix[i] + 1e-9)
+
+
+def test_top_k(active_sites):
+    sim_matrix = cluster.create_similarity_matrix(active_sites, "RMSD")
+    search = query.SiteSearch(active_sites, "RMSD")
+
+    for i in range(len(active_sites)):
+        result = search.query(active_sites[i], k=5)
+        assert len(result) == 5
+        assert np.allclose([score for name, score in result], np.sort(sim_matrix[i])[:5])
+
+    # a prefiltered search only scores the candidates, and is approximate
+    result = query.top_k(active_sites[0], active_sites, k=3, prefilter="composition", n_candidates=10)
+    assert len(result) == 3
+    assert result[0] == (active_sites[0].name, 0.0)
+
+    # any registered metric can prefilter, including ones with only a scalar comparison
+    def size_difference(a1, a2):
+        return abs(len(a1.residues) - len(a2.residues))
+
+    similarity.register_metric(similarity.Metric("size", compare=size_difference, coordinates=False))
+    try:
+        result = query.top_k(active_sites[0], active_sites, k=3, prefilter="size", n_candidates=10)
+    finally:
+        del similarity.METRICS["size"]
+    assert len(result) == 3
+    assert result[0] == (active_sites[0].name, 0.0)
+
+
+def test_top_k_store(active_sites, tmpdir):
+    filename = str(tmpdir.join("sites.store"))
+    write_site_store(filename, active_sites)
+
+    expected = query.top_k(active_sites[3], active_sites, k=4, metric="TM")
+    assert query.top_k(active_sites[3], SiteStore(filename), k=4, metric="TM") == expected
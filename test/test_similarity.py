@@ -0,0 +1,138 @@
+from hw2skeleton import io
+from hw2skeleton import similarity
+from hw2skeleton import cluster
+import numpy as np
+import pytest
+import os
+
+
+def test_feature_cache():
+    active_sites = [io.read_active_site(os.path.join("data", "%i.pdb" % id)) for id in [276, 4629, 10701]]
+
+    comparator = similarity.SimilarityComparator("RMSD")
+    comparator.precompute(active_sites)
+    assert all("backbone" in a.features for a in active_sites)
+
+    # cached features are the ones computed from scratch
+    site = active_sites[1]
+    assert np.array_equal(similarity.get_feature(site, "backbone"), site.getBackboneCoords())
+    assert similarity.get_feature(site, "hydrophobicity") == \
+        sum(similarity.HYDROPHOBICITY[r.type] for r in site.residues)
+    assert similarity.get_feature(site, "composition").sum() == len(site.residues)
+    assert np.allclose(similarity.get_feature(site, "centroid"), site.coords.mean(axis=0))
+
+    # moving an atom invalidates the cache
+    site.residues[0].atoms[0].coords = (0.0, 0.0, 0.0)
+    assert "backbone" not in site.features
+    assert np.array_equal(similarity.get_feature(site, "backbone")[0, 0], [0.0, 0.0, 0.0])
+
+
+def test_eviction_keeps_coordinate_free_features():
+    from hw2skeleton import utils
+
+    site = io.read_active_site(os.path.join("data", "276.pdb"), lazy=True)
+    utils.set_coordinate_cache_size(1)
+    try:
+        similarity.get_feature(site, "backbone")
+        similarity.get_feature(site, "composition")
+        similarity.get_feature(site, "hydrophobicity")
+        assert site.is_loaded()
+
+        # evicting the coordinates only drops the features computed from them
+        utils.set_coordinate_cache_size(0)
+        assert not site.is_loaded()
+        assert sorted(site.features) == ["composition", "hydrophobicity"]
+    finally:
+        utils.set_coordinate_cache_size(None)
+
+
+def test_custom_feature():
+    @similarity.feature("n_residues")
+    def n_residues(active_site):
+        return len(active_site.residues)
+
+    try:
+        site = io.read_active_site(os.path.join("data", "276.pdb"))
+        assert similarity.get_feature(site, "n_residues") == 5
+        assert site.features["n_residues"] == 5
+    finally:
+        del similarity.FEATURES["n_residues"]
+
+
+def test_kabsch():
+    rng = np.random.RandomState(0)
+    P = rng.normal(size=(4, 10, 3))
+
+    # random proper rotations and translations of P
+    Q_rot, _ = np.linalg.qr(rng.normal(size=(4, 3, 3)))
+    Q_rot *= np.sign(np.linalg.det(Q_rot))[:, np.newaxis, np.newaxis]
+    Q = np.matmul(P, Q_rot) + rng.normal(size=(4, 1, 3))
+
+    assert np.allclose(similarity.kabsch(P, Q), Q)
+
+    # points of zero weight do not affect the fit
+    weights = np.ones((4, 10))
+    weights[:, 7:] = 0
+    Q_noisy = Q.copy()
+    Q_noisy[:, 7:] += 10
+    assert np.allclose(similarity.kabsch(P, Q_noisy, weights)[:, :7], Q[:, :7])
+
+
+def test_superposition_metrics():
+    active_sites = [io.read_active_site(os.path.join("data", "%i.pdb" % id)) for id in [276, 4629, 10701, 52954]]
+
+    # a rigidly moved copy of a site is identical to it under superposition, but not under plain RMSD
+    moved = io.read_active_site(os.path.join("data", "4629.pdb"))
+    c, s = np.cos(1.0), np.sin(1.0)
+    moved.coords = moved.coords @ np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]) + 7.5
+
+    for method in ["TM", "superposed_RMSD"]:
+        comparator = similarity.SimilarityComparator(method)
+        assert comparator.compare(active_sites[1], moved) == pytest.approx(0, abs=1e-6)
+
+        # batched scores match pair by pair scores, and TM distances lie in [0, 1]
+        block = similarity.superposition_block(active_sites, active_sites, method, symmetric=True)
+        assert np.allclose(block, block.T)
+        for i in range(len(active_sites)):
+            for j in range(i + 1, len(active_sites)):
+                assert block[i, j] == pytest.approx(comparator.compare(active_sites[i], active_sites[j]))
+
+    assert similarity.SimilarityComparator("RMSD").compare(active_sites[1], moved) > 1
+    block = similarity.superposition_block(active_sites, active_sites, "TM")
+    assert np.all((block >= 0) & (block <= 1))
+
+
+def test_metric_registry():
+    active_sites = [io.read_active_site(os.path.join("data", "%i.pdb" % id)) for id in [276, 4629, 10701, 52954]]
+
+    with pytest.raises(ValueError):
+        similarity.get_metric("no such metric")
+
+    # vectorized metrics agree with their scalar comparisons
+    for name in ["hydrophobicity", "composition"]:
+        metric = similarity.get_metric(name)
+        assert not metric.coordinates
+        block = metric.block(active_sites, active_sites, symmetric=True)
+        comparator = similarity.SimilarityComparator(name)
+        assert np.allclose(block, [[comparator.compare(a, b) for b in active_sites] for a in active_sites])
+
+    # new metrics plug into the matrix builders without touching them
+    def size_difference(a1, a2):
+        return len(a1.residues) - len(a2.residues)
+
+    similarity.register_metric(similarity.Metric("size", compare=size_difference, symmetric=False,
+                                                 coordinates=False))
+    try:
+        sim_matrix = cluster.create_similarity_matrix(active_sites, "size", tile_size=1)
+        sizes = np.array([len(a.residues) for a in active_sites])
+        assert np.array_equal(sim_matrix, sizes[:, np.newaxis] - sizes[np.newaxis, :])
+
+        with pytest.raises(ValueError):
+            cluster.create_similarity_matrix(active_sites, "size", condensed=True)
+
+        # updating an asymmetric matrix fills both the new rows and the new columns
+        updated = cluster.update_similarity_matrix(sim_matrix[:2, :2], [a.name for a in active_sites[:2]],
+                                                   active_sites, "size")
+        assert np.array_equal(updated, sim_matrix)
+    finally:
+        del similarity.METRICS["size"]